@@ -0,0 +1,66 @@
+import subprocess
+import statistics
+import sys
+import time
+
+# modules which must only be loaded by the commands that need them
+HEAVY_MODULES = ["numpy", "cv2", "imagehash", "pandas", "scipy"]
+
+# median startup time allowed per command line, seconds
+BUDGET = 0.25
+RUNS = 7
+
+COMMANDS = [
+    ["--help"],
+    ["screenshot", "--help"],
+]
+
+
+def run_cli(args):
+    start_time = time.time()
+    subprocess.run(
+        [sys.executable, "-c", "import eyecatching; eyecatching.cli()"] + args,
+        stdout = subprocess.DEVNULL,
+        check = True
+    )
+    return time.time() - start_time
+
+
+def loaded_heavy_modules():
+    """
+    Heavy modules imported by eyecatching and the screenshot code path
+    """
+    code = (
+        "import sys, eyecatching, capture, eyecatchingutil\n"
+        "eyecatchingutil.FirefoxScreenshot().command('http://example.com/')\n"
+        "eyecatchingutil.ChromeScreenshot().command('http://example.com/')\n"
+        "print(' '.join(m for m in {0} if m in sys.modules))".format(HEAVY_MODULES)
+    )
+    output = subprocess.run([sys.executable, "-c", code], stdout = subprocess.PIPE, check = True)
+    return output.stdout.decode().split()
+
+
+def main():
+    failed = False
+
+    heavy = loaded_heavy_modules()
+    if len(heavy) > 0:
+        print("FAIL:\tImported on startup: {0}".format(", ".join(heavy)))
+        failed = True
+    else:
+        print("OK:\tNo heavy modules imported on startup")
+
+    for args in COMMANDS:
+        run_cli(args)   # warm up file system caches
+        times = [run_cli(args) for _ in range(RUNS)]
+        median = statistics.median(times)
+        status = "OK" if median <= BUDGET else "FAIL"
+        failed = failed or median > BUDGET
+        print("{0}:\teyecatching {1}: median {2:.3f} s (budget {3:.3f} s)".format(
+            status, " ".join(args), median, BUDGET
+        ))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
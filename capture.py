@@ -0,0 +1,196 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CaptureJob:
+    """
+    One screenshot of one URL in one browser
+    """
+
+    def __init__(self, url, screenshot):
+        self.url = url
+        self.screenshot = screenshot    # BrowserScreenshot
+        self.attempts = 0
+        self.elapsed = 0
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class CaptureOrchestrator:
+    """
+    Runs browser processes concurrently with asyncio.
+    Every shot runs in its own working directory, limited by a
+    semaphore, killed after a timeout and retried with backoff.
+    """
+
+    concurrency = 2         # browser processes at the same time
+    timeout     = 60        # seconds per shot
+    retries     = 2         # extra attempts after a failed shot
+    backoff     = 1.0       # seconds, doubled after every failed attempt
+
+    def __init__(self, concurrency = None, timeout = None, retries = None, backoff = None):
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+        self._semaphore = None
+
+    async def capture(self, job):
+        """
+        Take the screenshot of a job, retrying until it succeeds
+        or all attempts are used
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+
+        for attempt in range(self.retries + 1):
+            job.attempts = attempt + 1
+            workdir = tempfile.mkdtemp(prefix = "eyecatching_")
+            try:
+                if job.screenshot.persistent:
+                    async with self._semaphore:
+                        await self._run_persistent(job)
+                else:
+                    async with self._semaphore:
+                        data = await self._run(job, workdir)
+                    # move or decode and post-process the image outside the event loop
+                    await loop.run_in_executor(None, job.screenshot.finish_shot, workdir, data)
+                job.error = None
+                break
+            except (asyncio.TimeoutError, RuntimeError, OSError, ValueError) as e:
+                job.error = str(e) or e.__class__.__name__
+                print("Warning: \t{0} attempt {1} failed for {2}: {3}".format(
+                    job.screenshot.name, job.attempts, job.url, job.error
+                ))
+            finally:
+                shutil.rmtree(workdir, ignore_errors = True)
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+
+        job.elapsed = time.time() - start_time
+        return job
+
+    async def _run(self, job, workdir):
+        """
+        Run the browser process, returns what it wrote to stdout
+        when the screenshot is handed over in memory
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *job.screenshot.command(job.url, workdir),
+            cwd = workdir,
+            stdout = asyncio.subprocess.PIPE if job.screenshot.in_memory else asyncio.subprocess.DEVNULL,
+            stderr = asyncio.subprocess.DEVNULL
+        )
+        try:
+            (data, _) = await asyncio.wait_for(proc.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            self._kill(proc)
+            await proc.wait()
+            raise asyncio.TimeoutError("timed out after {0} seconds".format(self.timeout))
+        except asyncio.CancelledError:
+            self._kill(proc)
+            await proc.wait()
+            raise
+
+        if proc.returncode != 0:
+            raise RuntimeError("browser exited with code {0}".format(proc.returncode))
+        if not data:
+            data = None
+            if not os.path.exists(os.path.join(workdir, "screenshot.png")):
+                raise RuntimeError("browser did not write screenshot.png")
+        return data
+
+    async def _run_persistent(self, job):
+        """
+        Take the shot in a thread with a browser kept alive in-process
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, job.screenshot.take_shot, job.url)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # unblock the thread and let it finish before retrying
+            job.screenshot.abort()
+            await asyncio.gather(future, return_exceptions = True)
+            if isinstance(e, asyncio.TimeoutError):
+                raise asyncio.TimeoutError("timed out after {0} seconds".format(self.timeout))
+            raise
+
+    def _kill(self, proc):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    async def capture_all(self, jobs, on_done = None):
+        """
+        Capture all jobs. If given, on_done(job) is called in a worker
+        thread for every captured job while other captures still run.
+        """
+        if on_done is None:
+            return await asyncio.gather(*[self.capture(job) for job in jobs])
+
+        loop = asyncio.get_running_loop()
+        # a single thread, on_done is never called concurrently
+        executor = ThreadPoolExecutor(max_workers = 1)
+
+        async def capture_then(job):
+            await self.capture(job)
+            if job.ok:
+                await loop.run_in_executor(executor, on_done, job)
+            return job
+
+        try:
+            return await asyncio.gather(*[capture_then(job) for job in jobs])
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    async def capture_and_compare(self, pairs, compare, workers = 1):
+        """
+        Capture (ref, com) job pairs and call compare(ref, com) in a
+        worker thread as soon as both shots of a pair are ready, while
+        the other captures are still running.
+        Returns the compare results in the order of pairs.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers = workers)
+
+        async def run_pair(ref_job, com_job):
+            await asyncio.gather(self.capture(ref_job), self.capture(com_job))
+            if not (ref_job.ok and com_job.ok):
+                return None
+            return await loop.run_in_executor(executor, compare, ref_job, com_job)
+
+        try:
+            return await asyncio.gather(*[run_pair(ref, com) for (ref, com) in pairs])
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    def run(self, jobs, on_done = None):
+        """
+        Blocking helper to capture all jobs
+        """
+        # the semaphore belongs to the event loop it was created in
+        self._semaphore = None
+        return asyncio.run(self.capture_all(jobs, on_done))
+
+    def run_and_compare(self, pairs, compare, workers = 1):
+        """
+        Blocking helper for capture_and_compare
+        """
+        self._semaphore = None
+        return asyncio.run(self.capture_and_compare(pairs, compare, workers))
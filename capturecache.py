@@ -0,0 +1,195 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.request
+import uuid
+from PIL import Image
+
+
+def page_digest(url, timeout = 10):
+    """
+    ETag of the page, or digest of its HTML if the server sends none.
+    None if the page cannot be fetched.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout = timeout) as response:
+            etag = response.headers.get("ETag")
+            if etag:
+                return "etag:" + etag
+            return "sha1:" + hashlib.sha1(response.read()).hexdigest()
+    except (OSError, ValueError) as e:
+        print("Warning: \tCould not fetch {0} to check the capture cache: {1}".format(url, e))
+        return None
+
+
+class CaptureCache:
+    """
+    Screenshots kept on disk by (URL, browser, width, ignored selectors
+    and optionally a digest of the page), so that the same page is
+    rendered once for several comparisons. Every capture gets a file of
+    its own. Captures older than max_age are not used, the least
+    recently used ones are removed above max_bytes. The index is only
+    changed under a lock, processes may share the cache.
+    """
+
+    directory = ".eyecatching_cache"
+    max_age   = 3600                # seconds a capture is fresh
+    max_bytes = 500 * 1024 * 1024   # total size of the cached captures
+
+    def __init__(self, directory = None, max_age = None, max_bytes = None):
+        if directory is not None:
+            self.directory = directory
+        if max_age is not None:
+            self.max_age = max_age
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.index_file = os.path.join(self.directory, "index.json")
+        self.lock_file = os.path.join(self.directory, "index.lock")
+
+    def key(self, url, shot, digest = None):
+        # Firefox backends capture differently, e.g. with or without scrollbar
+        parts = [url, shot.browser, type(shot).__name__, shot.width, sorted(shot.ignore_selectors), shot.export_elements, digest]
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Context in which no other process changes the index
+        """
+        os.makedirs(self.directory, exist_ok = True)
+        with open(self.lock_file, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load_index(self):
+        """
+        key: entry of every cached capture
+        """
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        # replaced at once, a reader never sees half an index
+        temp = "{0}.{1}.tmp".format(self.index_file, uuid.uuid4().hex)
+        with open(temp, "w") as f:
+            json.dump(index, f, indent = 1)
+        os.replace(temp, self.index_file)
+
+    def get(self, url, shot, digest = None):
+        """
+        Fill shot from a fresh cached capture, returns the file
+        of the capture or None if there is none
+        """
+        if not os.path.exists(self.index_file):
+            return None
+        key = self.key(url, shot, digest)
+        with self.locked():
+            index = self.load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            filename = os.path.join(self.directory, entry["file"])
+            if time.time() - entry["created"] > self.max_age or not os.path.exists(filename):
+                return None
+
+            # decoded under the lock, eviction cannot remove it meanwhile
+            image = Image.open(filename)
+            image.load()
+            entry["used"] = time.time()
+            self.save_index(index)
+        shot.image = image
+        shot.height = image.height
+        shot.ignore_boxes = [tuple(box) for box in entry["ignore_boxes"]]
+        shot.element_boxes = [tuple(box) for box in entry["element_boxes"]]
+        print("Info: \tUsing capture of {0} from {1}, taken {2:.0f} seconds ago".format(
+            shot.name, filename, time.time() - entry["created"]
+        ))
+        return filename
+
+    def put(self, url, shot, digest = None):
+        """
+        Keep the capture of shot, from memory or its image file
+        """
+        os.makedirs(self.directory, exist_ok = True)
+        key = self.key(url, shot, digest)
+        # unique, a capture in use is never overwritten
+        filename = "{0}-{1}-{2}{3}".format(shot.browser or shot.name, key[:12], uuid.uuid4().hex[:8], shot.ext)
+        path = os.path.join(self.directory, filename)
+        if shot.image is not None:
+            shot.image.save(path)
+        else:
+            shutil.copyfile(shot.imagename, path)
+
+        with self.locked():
+            self.add_entry(key, url, shot, digest, filename, os.path.getsize(path))
+
+    def add_entry(self, key, url, shot, digest, filename, size):
+        index = self.load_index()
+        previous = index.get(key)
+        now = time.time()
+        index[key] = {
+            "file": filename,
+            "url": url,
+            "browser": shot.browser,
+            "width": shot.width,
+            "digest": digest,
+            "created": now,
+            "used": now,
+            "size": size,
+            "ignore_boxes": [list(box) for box in shot.ignore_boxes],
+            "element_boxes": [list(box) for box in shot.element_boxes],
+        }
+        if previous is not None:
+            self.remove_file(previous)
+        self.evict(index)
+        self.save_index(index)
+
+    def evict(self, index):
+        """
+        Drop expired captures, then the least recently used ones
+        until the cache fits into max_bytes
+        """
+        now = time.time()
+        for key in [key for (key, entry) in index.items() if now - entry["created"] > self.max_age]:
+            self.remove_file(index.pop(key))
+
+        # files of captures whose index entry was lost, e.g. by a crash
+        indexed = set(entry["file"] for entry in index.values())
+        for name in os.listdir(self.directory):
+            if name in indexed or name.startswith("index."):
+                continue
+            try:
+                # a capture about to be added is younger
+                if now - os.path.getmtime(os.path.join(self.directory, name)) > self.max_age:
+                    self.remove_file({"file": name})
+            except OSError:
+                pass
+
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key = lambda key: index[key]["used"]):
+            if total <= self.max_bytes:
+                break
+            entry = index.pop(key)
+            total -= entry["size"]
+            self.remove_file(entry)
+            print("Info: \tRemoved capture {0} from the cache".format(entry["file"]))
+
+    def remove_file(self, entry):
+        try:
+            os.remove(os.path.join(self.directory, entry["file"]))
+        except OSError:
+            pass
+
+    def clear(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
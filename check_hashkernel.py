@@ -0,0 +1,120 @@
+import sys
+import time
+import numpy as np
+import imagehash
+from PIL import Image
+from PIL import ImageDraw
+from hashkernel import tile_hashes
+from hashkernel import hamming
+
+# algorithm: imagehash function the kernel must reproduce bit for bit
+REFERENCES = {
+    "ahash": imagehash.average_hash,
+    "dhash": imagehash.dhash,
+}
+
+# tile edges, px: smaller than, equal to and larger than the hash size
+EDGES = [5, 8, 10, 13, 16, 20, 31, 64]
+ROWS = 6
+COLUMNS = 7
+SEED = 7
+
+
+def test_images(edge, rng):
+    """
+    (name, luminance image) pairs of a few kinds of page content
+    """
+    (width, height) = (COLUMNS * edge, ROWS * edge)
+    noise = Image.fromarray(rng.integers(0, 256, (height, width), dtype = np.uint8))
+
+    boxes = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(boxes)
+    for _ in range(30):
+        (x, y) = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        (w, h) = (int(rng.integers(1, 3 * edge)), int(rng.integers(1, 3 * edge)))
+        draw.rectangle((x, y, x + w, y + h), fill = int(rng.integers(0, 256)))
+
+    text = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(text)
+    for y in range(0, height, 12):
+        draw.text((2, y), "Eyecatching 0123456789 " * 4, fill = 0)
+
+    gradient = Image.fromarray(np.tile(np.linspace(0, 255, width).astype(np.uint8), (height, 1)))
+    return [("noise", noise), ("boxes", boxes), ("text", text), ("gradient", gradient), ("white", Image.new("L", (width, height), 255))]
+
+
+def reference_hashes(image, edge, algorithm):
+    """
+    (rows, columns) packed imagehash hashes, tile by tile as the metrics did
+    """
+    hashes = np.zeros((ROWS, COLUMNS, 1), dtype = np.uint64)
+    for ty in range(ROWS):
+        for tx in range(COLUMNS):
+            box = (tx * edge, ty * edge, (tx + 1) * edge, (ty + 1) * edge)
+            bits = REFERENCES[algorithm](image.crop(box)).hash
+            hashes[ty, tx, 0] = np.packbits(bits.ravel()).view(">u8")[0]
+    return hashes
+
+
+def check_hashes(rng):
+    failed = False
+    for algorithm in REFERENCES:
+        for edge in EDGES:
+            for (name, image) in test_images(edge, rng):
+                expected = reference_hashes(image, edge, algorithm)
+                actual = tile_hashes(np.asarray(image), edge, algorithm)
+                wrong = int((expected != actual).sum())
+                if wrong > 0:
+                    failed = True
+                    print("FAIL:\t{0} of {1} px tiles of {2}: {3} of {4} hashes differ".format(
+                        algorithm, edge, name, wrong, ROWS * COLUMNS
+                    ))
+        if not failed:
+            print("OK:\t{0} hashes equal imagehash for tiles of {1} px".format(
+                algorithm, ", ".join(str(edge) for edge in EDGES)
+            ))
+    return failed
+
+
+def check_hamming(rng):
+    a = rng.integers(0, 1 << 63, (1000, 2), dtype = np.int64).astype(np.uint64)
+    b = rng.integers(0, 1 << 63, (1000, 2), dtype = np.int64).astype(np.uint64)
+    expected = np.array([bin(int(x) ^ int(y)).count("1") + bin(int(u) ^ int(v)).count("1") for ((x, u), (y, v)) in zip(a, b)])
+    if (hamming(a, b) != expected).any():
+        print("FAIL:\tHamming distances differ from counted bits")
+        return True
+    print("OK:\tHamming distances equal counted bits")
+    return False
+
+
+def report_speed(rng):
+    """
+    Time to hash the tiles of one screen height, kernel and imagehash
+    """
+    edge = 10
+    pixels = rng.integers(0, 256, (800, 1280), dtype = np.uint8)
+    image = Image.fromarray(pixels)
+
+    start_time = time.time()
+    tile_hashes(pixels, edge)
+    kernel_time = time.time() - start_time
+
+    start_time = time.time()
+    for y in range(0, 800, edge):
+        for x in range(0, 1280, edge):
+            imagehash.average_hash(image.crop((x, y, x + edge, y + edge)))
+    imagehash_time = time.time() - start_time
+    print("Info:\t{0} tiles of {1} px: kernel {2:.4f} s, imagehash {3:.4f} s".format(
+        (800 // edge) * (1280 // edge), edge, kernel_time, imagehash_time
+    ))
+
+
+def main():
+    rng = np.random.default_rng(SEED)
+    failed = check_hashes(rng)
+    failed = check_hamming(rng) or failed
+    report_speed(rng)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,37 @@ import subprocess
 import os
 import sys
 import shutil
-import imagehash
-import cv2
-import pandas
 import time
-import numpy as np
+import hashlib
 from PIL import Image
 from urllib.parse import urlparse
 from eyecatchingutil import MetaImage
 from eyecatchingutil import FirefoxScreenshot
 from eyecatchingutil import ChromeScreenshot
 from eyecatchingutil import Coordinates
-from eyecatchingutil import ImageComparator
-from cv2 import VideoWriter, VideoWriter_fourcc, imread, resize
+from eyecatchingutil import IgnoreMask
+from eyecatchingutil import ElementRegions
+from eyecatchingutil import BandAligner
+from eyecatchingutil import LazyModule
+from eyecatchingutil import MarkedTiles
+from eyecatchingutil import peak_memory
+from eyecatchingutil import merge_boxes
+from capture import CaptureJob
+from metrics import get_metric
+from metrics import TileStability
+from metrics import StoredScores
+from capture import CaptureOrchestrator
+from progress import RegionTracker
+from capturecache import page_digest
+
+np = LazyModule("numpy")
+cv2 = LazyModule("cv2")
+
+class ComparisonStopped(Exception):
+    """
+    Raised to stop a recursive comparison once the dissimilar area is too large
+    """
+
 
 class Controller:
 
@@ -28,39 +46,110 @@ class Controller:
     ref_screenshot = None       # BrowserScreenshot
     com_screenshot = None       # BrowserScreenshot
     url            = None
+    ignore_boxes   = ()         # (x1, y1, x2, y2) regions to skip
+    ignore_selectors = ()       # CSS selectors to skip, resolved on capture
+    ignore_mask    = None       # mask image name, white = skip
+    mask           = None       # IgnoreMask
+    elements_file  = None       # json file with element boxes
+    export_elements = False     # export element boxes on capture
+    align          = "none"     # none, vertical, both
+    align_band     = 200        # band height for alignment, px
+    max_shift      = 50         # largest offset searched for, px
+    offsets        = ()         # (y1, y2, dx, dy) per band
+    capture_timeout = 60        # seconds per screenshot
+    capture_retries = 2         # extra attempts per screenshot
+    in_memory      = False      # screenshots are handed over without files
+    save_screenshots = True     # save in-memory screenshots to disk as well
+    images         = None       # imagename: decoded in-memory image
+    marked         = None       # MarkedTiles of the last comparison
+    regions        = ()         # connected dissimilar Regions
+    summary        = None       # stats of the last comparison
+    save_outputs   = True       # save the marked output image
+    hash_cache     = None       # (algorithm, size, box): reference tile hash
+    metric         = None       # Metric of the algorithm
+    grayscale      = False      # compare luminance only, colour for the output
+    output_options = {}         # extra options to save the output image with
+    shared_tiles   = None       # tile digest: score, shared across tiles and pages
+    captures       = 1          # screenshots per browser, more find unstable tiles
+    flaky_threshold = 1         # smallest score between captures of an unstable tile
+    unstable_boxes = ()         # tiles which changed between captures, masked
+    shift_pyramid  = False      # detect shapes coarse to fine
+    pyramid_factor = 4          # downscale factor of the coarse level
+    history        = None       # ResultHistory comparisons are recorded in
+    capture_time   = None       # seconds the screenshots took
+    tile_scores    = None       # (rows, columns) scores of the last linear comparison
+    progress       = None       # ProgressReporter events are streamed to
+    max_dissimilar_area = None  # dissimilar area, %, above which a comparison stops
+    capture_cache  = None       # CaptureCache single captures are reused from
+    cache_check    = True       # key cached captures by the ETag or HTML of the page
+    stored_scores  = None       # (rows, columns) tile scores of linear, computed elsewhere
 
     def recursive(self, image1 = None, image2 = None):
+        self.start_phase("prepare")
         self.normalize_images(image1, image2)
         self.set_images(image1, image2)
+        self.end_phase("prepare")
         self._rec_count = 0
         self._rec_total_diff = 0
         self._rec_total_area_marked = 0
+        self._rec_area_done = 0
+        self._rec_last_event = 0
+        self.marked = MarkedTiles()
+        self.tile_scores = None
         start_time = time.time()
-        self.divide_recursive(self.ref.coordinates.as_tuple(), 0)
+        self.set_metric()
+        masked_area = self.mask.masked_area(self.ref.coordinates.as_tuple())
+        self._rec_masked_area = masked_area
+        self.emit("start", method = "recursive", algorithm = self.algorithm,
+                  width = self.ref.width, height = self.ref.height)
+        self.start_phase("score")
+        stopped = False
+        try:
+            self.divide_recursive(self.ref.coordinates.as_tuple(), 0)
+        except ComparisonStopped:
+            stopped = True
+        self.end_phase("score")
+        self.regions = self.marked.regions(self.ref.size, self.block_size)
         stop_time = time.time()
 
-        output_filename = self.save_output(self.ref.image, "recursive")
+        self.start_phase("output")
+        output = self.output_image()
+        output_filename = self.save_output(output, "recursive")
+        self.end_phase("output")
+        self.report_regions()
 
         avg_dissimilarity = round(self._rec_total_diff / self._rec_count, 2) if self._rec_count != 0 else 0
+        self.summary = self.make_summary("recursive", {
+            "blocks_dissimilar": self._rec_count,
+            "average_dissimilarity": avg_dissimilarity,
+            "dissimilar_area": self.percent_of_unmasked(self._rec_total_area_marked, masked_area),
+            "stopped": stopped,
+        }, masked_area, stop_time - start_time, output_filename)
+        if stopped:
+            print("Done: \tStopped early, dissimilar area is above {0:.2f}%".format(self.max_dissimilar_area))
         print("Done:\tAverage dissimilarity: {0:.2f}%".format(avg_dissimilarity))
-        print("Done: \tDissimilar area: {0:.2f}%".format(
-            100 * self._rec_total_area_marked / self.ref.coordinates.get_area()
-        ))
+        print("Done: \tDissimilar area: {0:.2f}%".format(self.summary["dissimilar_area"]))
+        print("Done: \tMasked area: {0:.2f}%".format(self.summary["masked_area"]))
         print("Done: \tExecution time: {0:.4f} seconds".format(stop_time - start_time))
+        print("Done: \tPeak memory: {0:.1f} MB".format(self.summary["peak_memory"]))
+        self.emit("done", summary = self.summary)
+        self.record_history()
 
-        return Image.open(output_filename)
+        return Image.open(output_filename) if output_filename is not None else output
 
     def compare_recursive(self, patch_coords):
         """
         Compares two image slice with given coordinates
         """
-        ref_img_slice = self.ref.image.crop(patch_coords)
-        com_img_slice = self.com.image.crop(patch_coords)
-        ic = ImageComparator(ref_img_slice, com_img_slice)
-        diff = ic.hamming_diff(self.algorithm)
+        if self.mask.covers(patch_coords):
+            self.recursive_progress(patch_coords)
+            return
+        diff = self.metric.score_box(patch_coords)
 
         if diff > 0:
             self.divide_recursive(patch_coords, diff)
+        else:
+            self.recursive_progress(patch_coords)
 
     def divide_recursive(self, initial_coords, diff):
         (x1, y1, x2, y2) = initial_coords
@@ -68,7 +157,9 @@ class Controller:
 
         # return and save if image is less than block size
         if (coords.width <= self.block_size or coords.height <= self.block_size) and diff != 0:
-            self.mark_image_recursive(initial_coords, diff)
+            if not self.mask.intersects(initial_coords):
+                self.mark_image_recursive(initial_coords, diff)
+            self.recursive_progress(initial_coords)
         # Divide the image with larger side
         else:
             self.compare_recursive(coords.first_half())
@@ -76,16 +167,99 @@ class Controller:
 
     def mark_image_recursive(self, patch_coords, diff):
         (x1, y1, x2, y2) = patch_coords
-        coords = Coordinates(x1, y1, x2, y2)
-        patch = self.ref.image.crop(patch_coords)
         opacity = round((100 * float(diff) / 64) / 100, 1)
-        blended = self.blend_image(patch, opacity)
-        self.ref.image.paste(blended, patch_coords)
+        self.mark_tile(patch_coords, opacity)
         self._rec_count += 1
         self._rec_total_diff += opacity * 100
-        self._rec_total_area_marked += coords.get_area()
+        self._rec_total_area_marked += (x2 - x1) * (y2 - y1)
+        self.marked.append(x1, y1, x2, y2, round(diff))
+        self.emit("block", box = [x1, y1, x2, y2], distance = round(diff))
+
+        if self.max_dissimilar_area is None:
+            return
+        area_percent = self.percent_of_unmasked(self._rec_total_area_marked, self._rec_masked_area)
+        if area_percent > self.max_dissimilar_area:
+            self.emit("stopped", dissimilar_area = round(area_percent, 4), limit = self.max_dissimilar_area)
+            raise ComparisonStopped()
+
+    def recursive_progress(self, patch_coords):
+        """
+        Count a finished patch, emitting the share of the page done
+        at most every progress interval
+        """
+        if self.progress is None:
+            return
+        (x1, y1, x2, y2) = patch_coords
+        self._rec_area_done += (x2 - x1) * (y2 - y1)
+        now = time.time()
+        if now - self._rec_last_event < self.progress.interval:
+            return
+        self._rec_last_event = now
+        self.emit("progress", area_done = round(100 * self._rec_area_done / self.ref.coordinates.get_area(), 2),
+                  blocks_dissimilar = self._rec_count,
+                  dissimilar_area = round(self.percent_of_unmasked(self._rec_total_area_marked, self._rec_masked_area), 4))
+
+    def set_metric(self):
+        """
+        Prepare the metric of the algorithm for the current image pair
+        """
+        if self.stored_scores is not None:
+            self.metric = StoredScores(self.stored_scores)
+        else:
+            self.metric = get_metric(self.algorithm)
+        # the history keeps the tile hashes of linear comparisons
+        self.metric.keep_hashes = self.history is not None
+        self.metric.prepare(self.ref.image, self.com.image, self.hash_cache)
+
+    def make_summary(self, method, stats, masked_area, execution_time, output_filename):
+        """
+        Stats of a comparison as a plain dict, e.g. for JSON
+        """
+        summary = {
+            "method": method,
+            "algorithm": self.algorithm,
+            "block_size": self.block_size,
+            "threshold": self.threshold,
+            "width": self.ref.width,
+            "height": self.ref.height,
+        }
+        summary.update(stats)
+        summary["align"] = self.align
+        # offsets the comparable image was compensated by
+        summary["offsets"] = [list(run) for run in self.offset_runs()]
+        summary["masked_area"] = 100 * masked_area / self.ref.coordinates.get_area()
+        summary["regions"] = len(self.regions)
+        summary["execution_time"] = execution_time
+        summary["grayscale"] = self.grayscale
+        summary["peak_memory"] = peak_memory()
+        summary["output"] = output_filename
+        return summary
+
+    def record_history(self):
+        """
+        Record the last comparison in the result history, if one is kept
+        """
+        if self.history is not None:
+            self.history.add(self)
+
+    def emit(self, event, **fields):
+        """
+        Stream a progress event, if progress is reported
+        """
+        if self.progress is not None:
+            self.progress.emit(event, **fields)
+
+    def start_phase(self, phase):
+        if self.progress is not None:
+            self.progress.start_phase(phase)
+
+    def end_phase(self, phase):
+        if self.progress is not None:
+            self.progress.end_phase(phase)
 
     def save_output(self, image_obj:Image.Image, methodname:str):
+        if not self.save_outputs:
+            return None
         method = methodname[:3]
         output_name = "output_{0}_{1}_{2}_{3}_{4}.{5}".format(
             method,
@@ -95,13 +269,15 @@ class Controller:
             self.algorithm,
             self.ref.ext
         )
-        image_obj.save(output_name)
+        image_obj.save(output_name, **self.output_options)
         print("Done: \tOutput saved as: {0}".format(output_name))
         return output_name
 
     def linear(self, image1 = None, image2 = None):
+        self.start_phase("prepare")
         self.normalize_images(image1, image2)
         self.set_images(image1, image2)
+        self.end_phase("prepare")
         return self.compare_linear()
 
     def compare_linear(self):
@@ -112,94 +288,574 @@ class Controller:
 
         counter = 0
         counter_problem = 0
+        counter_masked = 0
         total_diff = 0
         dissimilar_area = 0
         edge = int(self.block_size)
+        width, height = self.com.image.size
+        self.marked = MarkedTiles()
+        self.set_metric()
+
+        skip = self.masked_tiles((width, height), edge)
+        shared = np.zeros(skip.shape, dtype = bool)
+        # keys cost more than scoring all tiles of the metrics scored in bulk
+        dedup = self.shared_tiles is not None and self.metric.scores_per_tile
+        if dedup:
+            # tiles repeated on this or earlier pages are scored once
+            keys = self.tile_keys(edge)
+            seen = set()
+            for (ty, tx) in np.argwhere(~skip).tolist():
+                key = keys[ty][tx]
+                if key in self.shared_tiles or key in seen:
+                    shared[ty, tx] = True
+                else:
+                    seen.add(key)
+        masked_area = self.mask.masked_area(self.ref.coordinates.as_tuple())
+        scores = np.zeros(skip.shape)
+        stopped = False
+        tracker = RegionTracker((width, height), edge) if self.progress is not None else None
+        self.emit("start", method = "linear", algorithm = self.algorithm, width = width, height = height,
+                  rows = skip.shape[0], tiles = int(skip.size), tiles_masked = int(skip.sum()))
+        self.start_phase("score")
+
+        # tiles are scored a band at a time, masked tiles are not scored
+        for (first, band) in self.metric.score_bands(edge, skip | shared):
+            last = first + len(band)
+            scores[first:last] = band
+            if dedup:
+                for (ty, tx) in np.argwhere(~skip[first:last] & ~shared[first:last]).tolist():
+                    self.shared_tiles[keys[first + ty][tx]] = scores[first + ty, tx]
+                for (ty, tx) in np.argwhere(shared[first:last]).tolist():
+                    scores[first + ty, tx] = self.shared_tiles[keys[first + ty][tx]]
+
+            for y in range(first * edge, min(last * edge, height), edge):
+                for x in range(0, width, edge):
+                    coords = (x, y, x + edge, y + edge)
+                    if skip[y // edge, x // edge]:
+                        counter_masked += 1
+                        continue
+                    # compare with ref tile
+                    hash_diff = scores[y // edge, x // edge]
+                    hash_diff_percent = 100 * hash_diff / 64
+                    # get an opacity value between 0 - 1
+                    opacity = float(hash_diff_percent) / 100
 
-        for x in range(0, self.com.image.width, edge):
-            for y in range(0, self.com.image.height, edge):
-                coords = (x, y, x + edge, y + edge)
-                _coords_obj = Coordinates(x, y, x + edge, y + edge)
-                ref_tile = self.ref.get_cropped(coords)
-                com_tile = self.com.get_cropped(coords)
-                # compare with ref tile
-                ic = ImageComparator(ref_tile, com_tile)
-                hash_diff =  ic.hash_diff(self.algorithm)
-                hash_diff_percent = ic.hash_diff_percent(self.algorithm)
-                # get an opacity value between 0 - 1
-                opacity = float(hash_diff_percent) / 100
-
-                if hash_diff >= self.threshold:
-                    blended = self.blend_image(ref_tile, opacity)
-                    self.ref.image.paste(blended, coords)
-                    counter_problem += 1
-                    dissimilar_area += _coords_obj.get_area()
-
-                del ref_tile, com_tile
-                total_diff += hash_diff_percent
-                counter += 1
+                    if hash_diff >= self.threshold:
+                        self.mark_tile(coords, opacity)
+                        counter_problem += 1
+                        # edge tiles are cropped at the image border
+                        x2 = min(x + edge, width)
+                        y2 = min(y + edge, height)
+                        dissimilar_area += (x2 - x) * (y2 - y)
+                        self.marked.append(x, y, x2, y2, round(hash_diff))
 
+                    total_diff += hash_diff_percent
+                    counter += 1
+
+            area_percent = self.percent_of_unmasked(dissimilar_area, masked_area)
+            if tracker is not None:
+                band_scores = scores[first:last]
+                dissimilar = (band_scores >= self.threshold) & ~skip[first:last]
+                for region in tracker.add_band(first, dissimilar, band_scores):
+                    self.progress.region(region)
+                elapsed = time.time() - start_time
+                self.emit("band", rows_done = last, rows = skip.shape[0], tiles_compared = counter,
+                          tiles_per_second = round(counter / elapsed, 1) if elapsed > 0 else None,
+                          blocks_dissimilar = counter_problem, dissimilar_area = round(area_percent, 4))
+            if self.max_dissimilar_area is not None and area_percent > self.max_dissimilar_area:
+                stopped = True
+                self.emit("stopped", rows_done = last, dissimilar_area = round(area_percent, 4),
+                          limit = self.max_dissimilar_area)
+                if tracker is not None:
+                    for region in tracker.finish():
+                        self.progress.region(region)
+                break
+        self.end_phase("score")
+
+        self.tile_scores = scores
+        self.regions = self.marked.regions(self.ref.size, edge)
         stop_time = time.time()
-        self.save_output(self.ref.image, "linear")
+        self.start_phase("output")
+        output = self.output_image()
+        output_filename = self.save_output(output, "linear")
+        self.end_phase("output")
+        self.report_regions()
+        avg_dissimilarity = round(total_diff / counter, 2) if counter != 0 else 0
+        self.summary = self.make_summary("linear", {
+            "blocks_compared": counter,
+            "blocks_dissimilar": counter_problem,
+            "blocks_masked": counter_masked,
+            "blocks_shared": int(shared.sum()),
+            "average_dissimilarity": avg_dissimilarity,
+            "dissimilar_area": self.percent_of_unmasked(dissimilar_area, masked_area),
+            "stopped": stopped,
+        }, masked_area, stop_time - start_time, output_filename)
+
+        if stopped:
+            print("Done: \tStopped early, dissimilar area is above {0:.2f}%".format(self.max_dissimilar_area))
 
         print("Done: \tTotal blocks compared: {0}.".format(counter))
         print("Done: \tNumber of blocks with dissimilarity: {0}".format(counter_problem))
-        print("Done: \tAverage dissimilarity {0:.2f}%.".format(round(total_diff / counter, 2)))
-        print("Done: \tDissimilar area: {0:.2f}%".format(
-            100 * dissimilar_area / self.ref.coordinates.get_area()
-        ))
+        print("Done: \tNumber of masked blocks skipped: {0}".format(counter_masked))
+        if dedup:
+            print("Done: \tNumber of repeated blocks, scored once: {0}".format(self.summary["blocks_shared"]))
+        print("Done: \tAverage dissimilarity {0:.2f}%.".format(avg_dissimilarity))
+        print("Done: \tDissimilar area: {0:.2f}%".format(self.summary["dissimilar_area"]))
+        print("Done: \tMasked area: {0:.2f}%".format(self.summary["masked_area"]))
         print("Done: \tExecution time: {0:.4f} seconds".format(stop_time - start_time))
+        print("Done: \tPeak memory: {0:.1f} MB".format(self.summary["peak_memory"]))
+        self.emit("done", summary = self.summary)
+        self.record_history()
+
+        return output
+
+    def tile_keys(self, edge):
+        """
+        Digest of the reference and comparable pixels of every tile,
+        as rows of keys for shared_tiles
+        """
+        ref = np.asarray(self.ref.image)
+        com = np.asarray(self.com.image)
+        prefix = "{0} {1} {2}".format(self.algorithm, self.ref.image.mode, self.com.image.mode).encode()
+        keys = []
+        for y in range(0, ref.shape[0], edge):
+            ref_band = ref[y:y + edge]
+            com_band = com[y:y + edge]
+            row = []
+            for x in range(0, ref.shape[1], edge):
+                ref_tile = ref_band[:, x:x + edge]
+                digest = hashlib.blake2b(prefix, digest_size = 16)
+                # the shape tells edge tiles apart
+                digest.update(bytes(str(ref_tile.shape), "ascii"))
+                digest.update(ref_tile.tobytes())
+                digest.update(com_band[:, x:x + edge].tobytes())
+                row.append(digest.digest())
+            keys.append(row)
+        return keys
+
+    def masked_tiles(self, size, edge):
+        """
+        Boolean (rows, columns) grid of the tiles touching the ignore mask
+        """
+        width, height = size
+        skip = np.zeros((-(-height // edge), -(-width // edge)), dtype = bool)
+        if not self.mask.is_empty():
+            for x in range(0, width, edge):
+                for y in range(0, height, edge):
+                    skip[y // edge, x // edge] = self.mask.intersects((x, y, x + edge, y + edge))
+        return skip
+
+    def element(self, image1 = None, image2 = None):
+        self.start_phase("prepare")
+        self.normalize_images(image1, image2)
+        self.set_images(image1, image2)
+        self.end_phase("prepare")
+        return self.compare_element()
+
+    def get_element_boxes(self):
+        """
+        Element boxes exported during capture, or stored next to the images
+        """
+        for shot in (self.ref_screenshot, self.com_screenshot):
+            if shot is not None and len(shot.element_boxes) > 0:
+                return shot.element_boxes
+
+        candidates = [self.elements_file, self.ref.name + ".json", self.com.name + ".json"]
+        for filename in candidates:
+            if filename is not None and os.path.exists(filename):
+                print("Info: \tUsing element boxes from {0}".format(filename))
+                return ElementRegions.load(filename)
 
-        return self.ref.image
+        return []
+
+    def compare_element(self):
+        """
+        Compare two images element by element, innermost elements first.
+        An element containing a dissimilar element is not compared again,
+        so findings are reported for the innermost dissimilar element.
+        """
+        regions = ElementRegions(self.get_element_boxes(), self.ref.size)
+        if len(regions) == 0:
+            print("Error: \tNo element boxes found! Capture with Chrome or provide --elements.")
+            exit()
+
+        start_time = time.time()
+        self.marked = MarkedTiles()
+        self.tile_scores = None
+        self.set_metric()
+
+        counter = 0
+        counter_problem = 0
+        counter_skipped = 0
+        total_diff = 0
+        has_dissimilar_child = np.zeros(len(regions), dtype = bool)
+        # union of marked boxes, overlapping elements are counted once
+        marked = IgnoreMask(self.ref.size)
+
+        for i, coords in enumerate(regions.boxes):
+            if has_dissimilar_child[i] or self.mask.covers(coords):
+                counter_skipped += 1
+                continue
+
+            hash_diff = self.metric.score_box(coords)
+            hash_diff_percent = 100 * hash_diff / 64
+            counter += 1
+            total_diff += hash_diff_percent
+
+            if hash_diff >= self.threshold:
+                counter_problem += 1
+                has_dissimilar_child |= regions.ancestors(i)
+                marked.add_box(coords)
+                self.mark_tile(coords, float(hash_diff_percent) / 100)
+                self.marked.append(*coords, round(hash_diff))
+                print("Found: \t{0} at {1}, distance {2:.1f}".format(regions.names[i], coords, hash_diff))
+
+        stop_time = time.time()
+        output = self.output_image()
+        output_filename = self.save_output(output, "element")
+        masked_area = self.mask.masked_area(self.ref.coordinates.as_tuple())
+        avg_dissimilarity = round(total_diff / counter, 2) if counter != 0 else 0
+        self.regions = []
+        self.summary = self.make_summary("element", {
+            "elements": len(regions),
+            "elements_compared": counter,
+            "elements_dissimilar": counter_problem,
+            "elements_skipped": counter_skipped,
+            "average_dissimilarity": avg_dissimilarity,
+            "dissimilar_area": self.percent_of_unmasked(marked.total_area(), masked_area),
+        }, masked_area, stop_time - start_time, output_filename)
+
+        print("Done: \tTotal elements compared: {0} of {1}.".format(counter, len(regions)))
+        print("Done: \tNumber of dissimilar elements: {0}".format(counter_problem))
+        print("Done: \tNumber of elements skipped: {0}".format(counter_skipped))
+        print("Done: \tAverage dissimilarity {0:.2f}%.".format(avg_dissimilarity))
+        print("Done: \tDissimilar area: {0:.2f}%".format(self.summary["dissimilar_area"]))
+        print("Done: \tMasked area: {0:.2f}%".format(self.summary["masked_area"]))
+        print("Done: \tExecution time: {0:.4f} seconds".format(stop_time - start_time))
+        print("Done: \tPeak memory: {0:.1f} MB".format(self.summary["peak_memory"]))
+        self.emit("done", summary = self.summary)
+        self.record_history()
+
+        return output
 
     def blend_image(self, image_obj, opacity, color = "salmon"):
         img1 = image_obj.convert("RGB")
         img2 = Image.new("RGB", img1.size, color)
         return Image.blend(img1, img2, opacity)
 
+    def mark_tile(self, coords, opacity):
+        """
+        Mark a dissimilar tile on the reference image. In grayscale mode
+        the tiles are painted on the colour reference by output_image.
+        """
+        if self.grayscale:
+            return
+        blended = self.blend_image(self.ref.get_cropped(coords), opacity)
+        self.ref.image.paste(blended, coords)
+
+    def output_image(self):
+        """
+        The marked reference image
+        """
+        if not self.grayscale:
+            return self.ref.image
+
+        # the colour reference is decoded only now, for painting
+        image = self.open_image(self.ref.imagename).image
+        for (x1, y1, x2, y2, distance) in self.marked.rows().tolist():
+            coords = (x1, y1, x2, y2)
+            image.paste(self.blend_image(image.crop(coords), distance / 64), coords)
+        return image
+
+    def report_regions(self, limit = 20):
+        """
+        Print the largest connected dissimilar regions
+        """
+        print("Done: \tDissimilar regions: {0}".format(len(self.regions)))
+        for region in self.regions[:limit]:
+            print("Found: \tRegion {0}, area {1} px, {2} tiles, max distance {3}, mean distance {4:.1f}".format(
+                region.as_tuple(), region.area, region.tiles, region.max_distance, region.mean_distance
+            ))
+        if len(self.regions) > limit:
+            print("Found: \t... and {0} smaller regions".format(len(self.regions) - limit))
+
+    def percent_of_unmasked(self, area, masked_area):
+        """
+        Percentage of the given area relative to the compared (unmasked) area
+        """
+        compared_area = self.ref.coordinates.get_area() - masked_area
+        return 100 * area / compared_area if compared_area > 0 else 0
+
     def get_screenshot(self, url):
         self.ref_screenshot.width = self.width
         self.com_screenshot.width = self.width
-        self.ref_screenshot.take_shot(url)
-        self.com_screenshot.take_shot(url)
+        self.ref_screenshot.ignore_selectors = list(self.ignore_selectors)
+        self.com_screenshot.ignore_selectors = list(self.ignore_selectors)
+        self.ref_screenshot.export_elements = self.export_elements
+        self.com_screenshot.export_elements = self.export_elements
+        for shot in (self.ref_screenshot, self.com_screenshot):
+            shot.in_memory = self.in_memory
+            shot.save_screenshot = self.save_screenshots
+        # repeated captures look for changes, they are never cached
+        cache = self.capture_cache if self.captures == 1 else None
+        digest = None
+        if cache is not None and self.cache_check:
+            digest = page_digest(url)
+            if digest is None:
+                # unknown whether the page changed, capture it again
+                cache = None
+        cached = []
+        if cache is not None:
+            for shot in (self.ref_screenshot, self.com_screenshot):
+                if self.use_cached(cache, url, shot, digest):
+                    cached.append(shot)
+        jobs = [
+            CaptureJob(url, shot)
+            for shot in (self.ref_screenshot, self.com_screenshot)
+            if shot not in cached
+        ]
+        # screenshot name: TileStability of its browser
+        stability = {}
+        browser_of = {}
+        if self.captures > 1:
+            for shot in (self.ref_screenshot, self.com_screenshot):
+                stability[shot.name] = TileStability(get_metric(self.algorithm), int(self.block_size), self.flaky_threshold)
+                browser_of[shot.name] = shot.name
+                for i in range(1, self.captures):
+                    repeat = self.repeat_screenshot(shot, i)
+                    browser_of[repeat.name] = shot.name
+                    jobs.append(CaptureJob(url, repeat))
+
+        def add_capture(job):
+            # runs while the other captures are still in progress
+            shot = job.screenshot
+            image = shot.image if shot.image is not None else Image.open(shot.imagename)
+            stability[browser_of[shot.name]].add(image)
+            if shot not in (self.ref_screenshot, self.com_screenshot):
+                shot.image = None
+
+        orchestrator = CaptureOrchestrator(
+            timeout = self.capture_timeout,
+            retries = self.capture_retries
+        )
+        if jobs:
+            print("Info: \tGetting screenshots from {0}".format(
+                " and ".join(job.screenshot.name for job in jobs[:2 - len(cached)])
+            ) + " browser")
+        start_time = time.time()
+        self.start_phase("capture")
+        if jobs:
+            orchestrator.run(jobs, add_capture if self.captures > 1 else None)
+        self.end_phase("capture")
+        self.capture_time = time.time() - start_time
+        for job in jobs[:2 - len(cached)]:
+            if not job.ok:
+                print("Error: \tCould not get screenshot from {0}: {1}".format(job.screenshot.name, job.error))
+                print("Error:\tExiting...")
+                exit()
+            if job.screenshot.image is not None:
+                self.images = self.images or {}
+                self.images[job.screenshot.imagename] = job.screenshot.image
+            if cache is not None:
+                cache.put(url, job.screenshot, digest)
+
+        boxes = []
+        for name, tiles in stability.items():
+            unstable = tiles.unstable()
+            if unstable is None:
+                print("Warning: \tOnly one capture from {0}, no tiles checked for stability".format(name))
+                continue
+            boxes += tiles.boxes()
+            print("Info: \t{0} of {1} tiles changed between {2} captures from {3}".format(
+                int(unstable.sum()), unstable.size, tiles.count + 1, name
+            ))
+        self.unstable_boxes = boxes
+
+    def use_cached(self, cache, url, shot, digest = None):
+        """
+        Take the screenshot from a fresh capture in the cache,
+        returns whether there was one
+        """
+        filename = cache.get(url, shot, digest)
+        if filename is None:
+            return False
+        self.images = self.images or {}
+        self.images[shot.imagename] = shot.image
+        if not self.in_memory or self.save_screenshots:
+            shutil.copyfile(filename, shot.imagename)
+        return True
+
+    def repeat_screenshot(self, shot, i):
+        """
+        Another capture of the same browser, kept in memory only
+        """
+        repeat = type(shot)("{0}-{1}".format(shot.name, i + 1))
+        repeat.width = shot.width
+        repeat.ignore_selectors = shot.ignore_selectors
+        repeat.in_memory = True
+        repeat.save_screenshot = False
+        return repeat
 
     def set_images(self, ref_imagename = None, com_imagename = None):
         if ref_imagename is None:
-            self.ref = MetaImage(self.ref_screenshot.imagename)
+            self.ref = self.open_working_image(self.ref_screenshot.imagename)
         else:
-            self.ref = MetaImage(ref_imagename)
+            self.ref = self.open_working_image(ref_imagename)
 
         if com_imagename is None:
-            self.com = MetaImage(self.com_screenshot.imagename)
+            self.com = self.open_working_image(self.com_screenshot.imagename)
         else:
-            self.com = MetaImage(com_imagename)
+            self.com = self.open_working_image(com_imagename)
+
+        self.offsets = ()
+        if self.align != "none":
+            self.align_images()
+        self.set_mask()
+
+    def align_images(self):
+        """
+        Compensate per-band offsets of the comparable image, so that
+        a shifted element does not mark everything below it
+        """
+        start_time = time.time()
+        aligner = BandAligner(self.ref.image, self.com.image, self.align_band, self.max_shift)
+        self.offsets = aligner.offsets(horizontal = self.align == "both")
+
+        if all(dx == 0 and dy == 0 for (_, _, dx, dy) in self.offsets):
+            print("Info: \tNo offsets found between images")
+            return
+
+        if self.com.image.mode not in ("L", "RGB", "RGBA"):
+            self.com.image = self.com.image.convert("RGB")
+        width, height = self.com.size
+        aligned = Image.new(self.com.image.mode, self.com.size, "white")
+        for (y1, y2, dx, dy) in self.offsets:
+            src = (
+                max(0, dx),                 max(0, y1 + dy),
+                min(width, width + dx),     min(height, y2 + dy)
+            )
+            if src[2] <= src[0] or src[3] <= src[1]:
+                continue
+            aligned.paste(self.com.image.crop(src), (src[0] - dx, src[1] - dy))
+        self.com.image = aligned
+
+        for (y1, y2, dx, dy) in self.offset_runs():
+            print("Found: \tRows {0} - {1} offset by {2}, {3} px".format(y1, y2, dx, dy))
+        print("Done: \tAlignment time: {0:.4f} seconds".format(time.time() - start_time))
+
+    def offset_runs(self):
+        """
+        (y1, y2, dx, dy) of the shifted rows, consecutive bands with
+        equal offset as one run
+        """
+        runs = []
+        for (y1, y2, dx, dy) in self.offsets:
+            if len(runs) > 0 and runs[-1][2:] == (dx, dy) and runs[-1][1] == y1:
+                runs[-1] = (runs[-1][0], y2, dx, dy)
+            else:
+                runs.append((y1, y2, dx, dy))
+        return [run for run in runs if run[2] != 0 or run[3] != 0]
+
+    def set_mask(self):
+        """
+        Build the ignore mask from boxes, resolved selectors and mask image.
+        Masked pixels of the comparable image are replaced with the
+        reference pixels, so masked content never affects a hash.
+        """
+        self.mask = IgnoreMask(self.ref.size)
+        boxes = list(self.ignore_boxes) + list(self.unstable_boxes)
+        for shot in (self.ref_screenshot, self.com_screenshot):
+            if shot is not None:
+                boxes += shot.ignore_boxes
+        for box in boxes:
+            self.mask.add_box(box)
+        if self.ignore_mask is not None:
+            self.mask.add_image(self.ignore_mask)
+
+        if self.mask.is_empty():
+            return
+
+        if self.com.image.mode != self.ref.image.mode:
+            self.com.image = self.com.image.convert(self.ref.image.mode)
+        self.com.image = Image.composite(self.ref.image, self.com.image, self.mask.as_image())
+        print("Info: \tIgnoring {0} region(s), {1} pixels masked".format(
+            len(boxes) + (1 if self.ignore_mask is not None else 0),
+            self.mask.total_area()
+        ))
+
+    def open_image(self, imagename):
+        """
+        MetaImage of an in-memory screenshot, or of the image file
+        """
+        if self.images and imagename in self.images:
+            # the reference image gets marked, keep the screenshot intact
+            return MetaImage(imagename, self.images[imagename].copy())
+        return MetaImage(imagename)
+
+    def open_working_image(self, imagename):
+        """
+        MetaImage to compare. In grayscale mode it holds one uint8
+        plane, the decoded colour image is dropped right away.
+        """
+        meta = self.open_image(imagename)
+        if self.grayscale:
+            meta.image = meta.image.convert("L")
+        return meta
+
+    def image_size(self, imagename):
+        """
+        Size of an in-memory screenshot, or of the image file without decoding it
+        """
+        if self.images and imagename in self.images:
+            return self.images[imagename].size
+        with Image.open(imagename) as img:
+            return img.size
+
+    def store_image(self, imagename, image_obj):
+        """
+        Replace an in-memory screenshot, or the image file
+        """
+        if self.images and imagename in self.images:
+            self.images[imagename] = image_obj
+        else:
+            image_obj.save(imagename)
+
+    def read_cv2_image(self, imagename):
+        """
+        BGR array of an in-memory screenshot, or of the image file
+        """
+        if self.images and imagename in self.images:
+            rgb = np.asarray(self.images[imagename].convert("RGB"))
+            return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+        return cv2.imread(imagename)
 
     def normalize_images(self, image1, image2):
         """
         Make 2 images equal height by adding white background to the smaller image
         """
-        img1 = MetaImage(image1)
-        img2 = MetaImage(image2)
+        # only the image which gets padded is decoded
+        size1 = self.image_size(image1)
+        size2 = self.image_size(image2)
 
-        print("Info: \t{0} image size: {1}x{2}".format(image1, img1.width, img1.height))
-        print("Info: \t{0} image size: {1}x{2}".format(image2, img2.width, img2.height))
+        print("Info: \t{0} image size: {1}x{2}".format(image1, size1[0], size1[1]))
+        print("Info: \t{0} image size: {1}x{2}".format(image2, size2[0], size2[1]))
         print("Work:\tMaking both image size equal (as larger image)")
 
-        if img1.size == img2.size:
+        if size1 == size2:
             print("Info: \tImage sizes are already equal")
             return
 
-        bigger_ht = img1.height if (img1.height >= img2.height) else img2.height
-        bigger_wd = img1.width if (img1.width >= img2.width) else img2.width
+        bigger_ht = size1[1] if (size1[1] >= size2[1]) else size2[1]
+        bigger_wd = size1[0] if (size1[0] >= size2[0]) else size2[0]
 
         newimg = Image.new("RGB", (bigger_wd, bigger_ht), "white")
         # which one is smaller
-        if img1.size == (bigger_wd, bigger_ht):
-            newimg.paste(img2.image)
-            newimg.save(image2)
+        if size1 == (bigger_wd, bigger_ht):
+            newimg.paste(self.open_image(image2).image)
+            self.store_image(image2, newimg)
         else:
-            newimg.paste(img1.image)
-            newimg.save(image1)
+            newimg.paste(self.open_image(image1).image)
+            self.store_image(image1, newimg)
 
         print("Done: \t{0} and {1} both are now {2}x{3} pixels.".format(
             image1, image2, bigger_wd, bigger_ht
@@ -213,35 +869,11 @@ class Controller:
         self.set_images(image1, image2)
 
         print("Work:\tStarting shift detection process")
-        fourcc = VideoWriter_fourcc(*"XVID")
-        img1 = imread(image1)
-        img2 = imread(image2)
+        img1 = self.read_cv2_image(image1)
+        img2 = self.read_cv2_image(image2)
         size = img1.shape[1], img1.shape[0]
-        output_vid = VideoWriter(
-            "output_vid.avi",       # output_filename
-            fourcc,                 # codec
-            float(40),              # fps
-            size,                   # framesize
-            True                    # write color frames
-        )
-        # make a white image for comparing
-        img_white = np.zeros((size[1], size[0], 3), np.uint8)
-        img_white.fill(255)
 
         start_time = time.time()
-
-        # add frames to output video
-        output_vid.write(img_white)
-        output_vid.write(img1)
-        output_vid.write(img2)
-        output_vid.write(img1)
-        
-        output_vid.release()
-
-        first_frame = None
-
-        video = cv2.VideoCapture("output_vid.avi")
-        step = 1
         objects_ref = []
         objects_com = []
 
@@ -270,50 +902,7 @@ class Controller:
                     )
             return frame
 
-        while True:
-            is_being_read, frame = video.read()
-
-            if is_being_read is True:
-                current_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            else:
-                break
-
-            # remove blur and noise 
-            # kernel size (21, 21), std deviation = 0
-            current_frame = cv2.GaussianBlur(current_frame, (21, 21), 0)
-
-            if first_frame is None:
-                first_frame = current_frame
-                continue
-
-            # get the differences between current and ref frame
-            delta_frame = cv2.absdiff(first_frame, current_frame)
-            # convert background above threshold to white
-            threshold_frame = cv2.threshold(delta_frame, 30, 255, cv2.THRESH_BINARY)[1]
-            # smoothen to remove sharp edges
-            # this frame now holds closed shapes with objects against background
-            threshold_frame = cv2.dilate(threshold_frame, None, iterations = 2)
-
-            (_, contours, _) = cv2.findContours(
-                threshold_frame.copy(),
-                cv2.RETR_EXTERNAL,          # ignore inside contours
-                cv2.CHAIN_APPROX_SIMPLE     # method for locating contours
-            )
-
-            # bigger for big objects, smaller for small
-            # 100 = 10 x 10px
-            shape_size_factor = 100
-            for contour in contours:
-                if cv2.contourArea(contour) < shape_size_factor:
-                    continue
-                
-                # get corresponding bounding for the detected contour
-                (x, y, w, h) = cv2.boundingRect(contour)
-                if step == 1:
-                    objects_ref.append((x, y, w, h))
-                elif step == 2:
-                    objects_com.append((x, y, w, h))
-            
+        def write_step(frame, step):
             if step == 1:
                 frame = draw_rectangles(frame, True)
                 output_filename = "output_struct_{0}_{1}.{2}".format(
@@ -340,6 +929,69 @@ class Controller:
                 )
 
             cv2.imwrite(output_filename, frame)
+            return output_filename
+
+        if self.shift_pyramid:
+            # images are read directly, without the video round trip
+            objects_ref.extend(self.find_shapes_pyramid(cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)))
+            objects_com.extend(self.find_shapes_pyramid(cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)))
+            for step, frame in ((1, img1.copy()), (2, img2), (3, img1)):
+                output_filename = write_step(frame, step)
+
+            stop_time = time.time()
+            print("Done:\tShift detection process completed")
+            print("Done:\tExecution time: {0:.4f} seconds".format(stop_time - start_time))
+            return Image.open(output_filename)
+
+        fourcc = cv2.VideoWriter_fourcc(*"XVID")
+        output_vid = cv2.VideoWriter(
+            "output_vid.avi",       # output_filename
+            fourcc,                 # codec
+            float(40),              # fps
+            size,                   # framesize
+            True                    # write color frames
+        )
+        # make a white image for comparing
+        img_white = np.zeros((size[1], size[0], 3), np.uint8)
+        img_white.fill(255)
+
+        # add frames to output video
+        output_vid.write(img_white)
+        output_vid.write(img1)
+        output_vid.write(img2)
+        output_vid.write(img1)
+        
+        output_vid.release()
+
+        first_frame = None
+
+        video = cv2.VideoCapture("output_vid.avi")
+        step = 1
+
+        while True:
+            is_being_read, frame = video.read()
+
+            if is_being_read is True:
+                current_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            else:
+                break
+
+            # remove blur and noise 
+            # kernel size (21, 21), std deviation = 0
+            current_frame = cv2.GaussianBlur(current_frame, (21, 21), 0)
+
+            if first_frame is None:
+                first_frame = current_frame
+                continue
+
+            # get the differences between current and ref frame
+            delta_frame = cv2.absdiff(first_frame, current_frame)
+            if step == 1:
+                objects_ref.extend(self.find_shapes(delta_frame))
+            elif step == 2:
+                objects_com.extend(self.find_shapes(delta_frame))
+
+            output_filename = write_step(frame, step)
             step += 1
 
         cv2.destroyAllWindows()
@@ -350,3 +1002,73 @@ class Controller:
         print("Done:\tExecution time: {0:.4f} seconds".format(stop_time - start_time))
         return Image.open(output_filename)
 
+    def find_shapes(self, delta_frame, box = None):
+        """
+        Bounding boxes (x, y, w, h) of the closed shapes in a frame of
+        differences to a white page. box is the part of the page the
+        frame covers, the whole page by default.
+        """
+        (x1, y1, x2, y2) = box or (0, 0, delta_frame.shape[1], delta_frame.shape[0])
+        # masked regions never produce shapes
+        delta_frame[self.mask.mask[y1:y2, x1:x2]] = 0
+        # convert background above threshold to white
+        threshold_frame = cv2.threshold(delta_frame, 30, 255, cv2.THRESH_BINARY)[1]
+        # smoothen to remove sharp edges
+        # this frame now holds closed shapes with objects against background
+        threshold_frame = cv2.dilate(threshold_frame, None, iterations = 2)
+
+        # OpenCV 3 returns (image, contours, hierarchy), later versions (contours, hierarchy)
+        contours = cv2.findContours(
+            threshold_frame,
+            cv2.RETR_EXTERNAL,          # ignore inside contours
+            cv2.CHAIN_APPROX_SIMPLE     # method for locating contours
+        )[-2]
+
+        # bigger for big objects, smaller for small
+        # 100 = 10 x 10px
+        shape_size_factor = 100
+        shapes = []
+        for contour in contours:
+            if cv2.contourArea(contour) < shape_size_factor:
+                continue
+            
+            # get corresponding bounding for the detected contour
+            (x, y, w, h) = cv2.boundingRect(contour)
+            shapes.append((x + x1, y + y1, w, h))
+        return shapes
+
+    def find_shapes_pyramid(self, gray):
+        """
+        Find shapes in a grayscale page coarse to fine: candidate regions
+        are detected on a downscaled page, contours are then traced at
+        full resolution only inside those regions
+        """
+        height, width = gray.shape
+        f = self.pyramid_factor
+        small = cv2.resize(gray, (-(-width // f), -(-height // f)), interpolation = cv2.INTER_AREA)
+        # blur of the same extent as 21 x 21 at full resolution
+        k = max(3, (21 // f) | 1)
+        delta = 255 - cv2.GaussianBlur(small, (k, k), 0)
+        if not self.mask.is_empty():
+            coarse_mask = cv2.resize(self.mask.mask.astype(np.uint8), small.shape[::-1], interpolation = cv2.INTER_AREA)
+            delta[coarse_mask > 0] = 0
+        # lower threshold and wider dilation, so no shape is missed
+        coarse = cv2.threshold(delta, 15, 255, cv2.THRESH_BINARY)[1]
+        coarse = cv2.dilate(coarse, None, iterations = 2)
+        (count, _, stats, _) = cv2.connectedComponentsWithStats(coarse, connectivity = 8)
+
+        # blur radius, dilation and rounding of the downscale
+        margin = 2 * (10 + 2 + f)
+        boxes = [
+            (
+                max(0, x * f - margin),             max(0, y * f - margin),
+                min(width, (x + w) * f + margin),   min(height, (y + h) * f + margin)
+            )
+            for (x, y, w, h, _) in stats[1:count].tolist()
+        ]
+
+        shapes = []
+        for (x1, y1, x2, y2) in merge_boxes(boxes):
+            blurred = cv2.GaussianBlur(gray[y1:y2, x1:x2], (21, 21), 0)
+            shapes.extend(self.find_shapes(255 - blurred, (x1, y1, x2, y2)))
+        return shapes
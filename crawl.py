@@ -0,0 +1,173 @@
+import hashlib
+import json
+import urllib.request
+from collections import deque
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urldefrag, urlparse
+
+
+class LinkParser(HTMLParser):
+    """
+    Collects the href values of <a> elements
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        for (name, value) in attrs:
+            if name == "href" and value:
+                self.links.append(value)
+
+
+class SiteCrawler:
+    """
+    Discovers the pages of a site breadth first, following links
+    to the same origin (scheme, host and port) only. Links are read
+    from the HTML as served, links added by scripts are not followed.
+    """
+
+    timeout = 10    # seconds per page
+    skipped_extensions = (
+        ".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".ico",
+        ".pdf", ".zip", ".css", ".js", ".json", ".xml", ".mp4"
+    )
+
+    def __init__(self, start_url, max_depth = 2, max_pages = 20):
+        self.start_url = self.normalize(start_url)
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+
+    def pages(self):
+        """
+        URLs of the discovered HTML pages, start page first
+        """
+        seen = {self.start_url}
+        # the same page under another URL, like / and /index.html
+        seen_content = set()
+        queue = deque([(self.start_url, 0)])
+        pages = []
+        while len(queue) > 0 and len(pages) < self.max_pages:
+            (url, depth) = queue.popleft()
+            html = self.fetch(url)
+            if html is None:
+                continue
+            digest = hashlib.sha1(html.encode("utf-8")).digest()
+            if digest in seen_content:
+                continue
+            seen_content.add(digest)
+            pages.append(url)
+            print("Info: \tFound page {0} (depth {1})".format(url, depth))
+            if depth >= self.max_depth:
+                continue
+            for link in self.links(url, html):
+                if link not in seen:
+                    seen.add(link)
+                    queue.append((link, depth + 1))
+        return pages
+
+    def fetch(self, url):
+        """
+        HTML of the page, or None if it is no HTML page
+        """
+        try:
+            with urllib.request.urlopen(url, timeout = self.timeout) as response:
+                if "html" not in response.headers.get("Content-Type", ""):
+                    return None
+                charset = response.headers.get_content_charset() or "utf-8"
+                return response.read().decode(charset, errors = "replace")
+        except (OSError, ValueError) as e:
+            print("Warning: \tCould not fetch {0}: {1}".format(url, e))
+            return None
+
+    def links(self, base_url, html):
+        parser = LinkParser()
+        parser.feed(html)
+        for href in parser.links:
+            url = self.normalize(urljoin(base_url, href))
+            if self.origin(url) != self.origin(self.start_url):
+                continue
+            if urlparse(url).path.lower().endswith(self.skipped_extensions):
+                continue
+            yield url
+
+    def normalize(self, url):
+        """
+        URL without fragment, with at least / as path
+        """
+        parts = urlparse(urldefrag(url)[0])
+        return parts._replace(path = parts.path or "/").geturl()
+
+    def origin(self, url):
+        parts = urlparse(url)
+        return (parts.scheme, parts.netloc.lower())
+
+
+class SiteReport:
+    """
+    Summaries of the compared pages of a crawl and the site-wide totals
+    """
+
+    def __init__(self, start_url, urls):
+        self.start_url = start_url
+        self.urls = list(urls)
+        self.summaries = {}     # url: summary of the comparison
+        self.errors = {}        # url: why it was not compared
+
+    def add(self, url, summary):
+        self.summaries[url] = summary
+
+    def add_error(self, url, error):
+        self.errors[url] = str(error)
+
+    def totals(self):
+        summaries = list(self.summaries.values())
+        compared = sum(s["blocks_compared"] for s in summaries)
+        shared = sum(s["blocks_shared"] for s in summaries)
+        return {
+            "start_url": self.start_url,
+            "pages": len(self.urls),
+            "pages_compared": len(summaries),
+            "pages_failed": len(self.errors),
+            "pages_dissimilar": sum(1 for s in summaries if s["blocks_dissimilar"] > 0),
+            "blocks_compared": compared,
+            "blocks_shared": shared,
+            "shared": 100 * shared / compared if compared > 0 else 0,
+            "blocks_dissimilar": sum(s["blocks_dissimilar"] for s in summaries),
+            "dissimilar_area": sum(s["dissimilar_area"] for s in summaries) / len(summaries) if len(summaries) > 0 else 0,
+            "execution_time": sum(s["execution_time"] for s in summaries),
+        }
+
+    def print_report(self):
+        print("Done: \tPages:")
+        for url in self.urls:
+            if url in self.summaries:
+                s = self.summaries[url]
+                print("Done: \t{0:6.2f}% dissimilar, {1} regions, {2} of {3} blocks repeated\t{4}".format(
+                    s["dissimilar_area"], s["regions"], s["blocks_shared"], s["blocks_compared"], url
+                ))
+            elif url in self.errors:
+                print("Error: \tnot compared: {0}\t{1}".format(self.errors[url], url))
+
+        totals = self.totals()
+        print("Done: \tPages compared: {0} of {1}, {2} with dissimilar blocks".format(
+            totals["pages_compared"], totals["pages"], totals["pages_dissimilar"]
+        ))
+        print("Done: \tRepeated blocks, scored once per site: {0:.2f}%".format(totals["shared"]))
+        print("Done: \tAverage dissimilar area: {0:.2f}%".format(totals["dissimilar_area"]))
+        print("Done: \tComparison time: {0:.4f} seconds".format(totals["execution_time"]))
+
+    def save(self, filename):
+        report = {
+            "site": self.totals(),
+            "pages": [
+                dict(url = url, summary = self.summaries.get(url), error = self.errors.get(url))
+                for url in self.urls
+            ],
+        }
+        with open(filename, "w") as f:
+            json.dump(report, f, indent = 2)
+        print("Done: \tReport saved as: {0}".format(filename))
@@ -2,7 +2,7 @@ import subprocess
 import os
 import sys
 import shutil
-import imagehash
+import contextlib
 import click
 import time
 from PIL import Image
@@ -10,7 +10,22 @@ from urllib.parse import urlparse
 from controller import Controller
 from eyecatchingutil import MetaImage
 from eyecatchingutil import FirefoxScreenshot
+from eyecatchingutil import MarionetteFirefoxScreenshot
 from eyecatchingutil import ChromeScreenshot
+from capture import CaptureJob
+from capture import CaptureOrchestrator
+from metrics import METRICS
+from watch import ComparisonWatcher
+from crawl import SiteCrawler
+from crawl import SiteReport
+from history import ResultHistory
+from progress import ProgressReporter
+from capturecache import CaptureCache
+from shard import WorkQueue
+from shard import ShardWorker
+from shard import ShardMerge
+from shard import plan_comparisons
+from shard import plan_bands
 
 pass_controller = click.make_pass_decorator(Controller, ensure = True)
 
@@ -22,7 +37,8 @@ def cli(controller):
     captured from different browsers (at present Chrome and Firefox).
 
         $ eyecatching linear <URL> [--option value]\n
-        $ eyecatching recursive <URL> [--option value]
+        $ eyecatching recursive <URL> [--option value]\n
+        $ eyecatching element <URL> [--option value]
 
     For example:
 
@@ -42,7 +58,7 @@ def cli(controller):
             help="Tile block size, px. \n(Default: 20)")
 @click.option('--algorithm',
             default="ahash",
-            help="Perceptual hashing algorithm to be used. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash")
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
 @click.option('--ref-browser',
             default="chrome",
             help="Reference browser \n(Default: chrome) \nAvailable: chrome, firefox")
@@ -55,6 +71,61 @@ def cli(controller):
 @click.option('--threshold',
             default=10,
             help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--align',
+            default="none",
+            help="Compensate offsets between images before comparison. \n(Default: none) \nAvailable: none, vertical, both")
+@click.option('--max-shift',
+            default=50,
+            help="Largest offset searched for by --align, px. \n(Default: 50)")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--in-memory',
+            is_flag=True,
+            help="Hand screenshots over from the browser process without temporary files.")
+@click.option('--save-screenshots/--no-save-screenshots',
+            default=True,
+            help="Save in-memory screenshots to disk as well. \n(Default: save)")
+@click.option('--captures',
+            default=1,
+            help="Screenshots per browser. Tiles which change between them are masked as unstable. \n(Default: 1)")
+@click.option('--flaky-threshold',
+            default=1,
+            help="Smallest score between captures of one browser to mask a tile as unstable. \n(Default: 1)")
+@click.option('--progress',
+            default="none",
+            help="Report progress while comparing. \n(Default: none) \nAvailable: none, ndjson (one JSON event per line on stdout, the log goes to stderr)")
+@click.option('--max-dissimilar-area',
+            default=None,
+            type=float,
+            help="Stop comparing once the dissimilar area exceeds this share of the page, %.")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+@click.option('--cache/--no-cache',
+            default=False,
+            help="Reuse a fresh capture of the same page, browser and width instead of capturing again. \n(Default: capture again)")
+@click.option('--cache-max-age',
+            default=3600,
+            help="Seconds a cached capture is reused for. \n(Default: 3600)")
+@click.option('--cache-check/--no-cache-check',
+            default=True,
+            help="Fetch the page and reuse a capture only if its ETag or HTML is unchanged. --no-cache-check reuses captures by age only. \n(Default: check)")
+@click.option('--cache-size',
+            default=500,
+            help="Size of the capture cache, MB. The least recently used captures are removed above it. \n(Default: 500)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
 @pass_controller
 def linear(
     controller,
@@ -64,7 +135,25 @@ def linear(
     ref_browser,
     output_id,
     width,
-    threshold
+    threshold,
+    ignore,
+    ignore_mask,
+    align,
+    max_shift,
+    in_memory,
+    save_screenshots,
+    grayscale,
+    firefox_backend,
+    captures,
+    flaky_threshold,
+    progress,
+    max_dissimilar_area,
+    history,
+    history_file,
+    cache,
+    cache_max_age,
+    cache_check,
+    cache_size
     ):
     """
     Test two screenshots using block comparison
@@ -74,33 +163,52 @@ def linear(
     validate_width(width)
     validate_block_size(block_size, width)
     validate_threshold(threshold)
+    validate_algorithm(algorithm)
 
-    print('Eyecatching is working....')
+    validate_align(align)
+    validate_firefox_backend(firefox_backend)
+    validate_captures(captures)
+    validate_progress(progress)
 
-    controller.algorithm = algorithm
-    controller.width = width
-    controller.url = url
-    controller.block_size = block_size
-    controller.output_id = output_id
-    controller.threshold = threshold
+    # events go to stdout, which carries the log otherwise
+    set_progress(controller, progress, max_dissimilar_area)
+    with progress_output(progress):
+        print('Eyecatching is working....')
 
-    if ref_browser == "chrome":
-        controller.ref_screenshot = ChromeScreenshot()
-        controller.com_screenshot = FirefoxScreenshot()
-    if ref_browser == "firefox":
-        controller.ref_screenshot = FirefoxScreenshot()
-        controller.com_screenshot = ChromeScreenshot()
+        controller.algorithm = algorithm
+        controller.width = width
+        controller.url = url
+        controller.block_size = block_size
+        controller.output_id = output_id
+        controller.threshold = threshold
+        controller.align = align
+        controller.in_memory = in_memory
+        controller.grayscale = grayscale
+        controller.save_screenshots = save_screenshots
+        controller.max_shift = max_shift
+        controller.captures = captures
+        controller.flaky_threshold = flaky_threshold
+        set_history(controller, history, history_file)
+        set_cache(controller, cache, cache_max_age, cache_check, cache_size)
+        set_ignore(controller, ignore, ignore_mask)
 
-    # get screenshots
-    controller.get_screenshot(url)
-    # start compare process
-    output = controller.linear(
-        controller.ref_screenshot.imagename,
-        controller.com_screenshot.imagename,
-    )
+        if ref_browser == "chrome":
+            controller.ref_screenshot = ChromeScreenshot()
+            controller.com_screenshot = firefox_screenshot(firefox_backend)
+        if ref_browser == "firefox":
+            controller.ref_screenshot = firefox_screenshot(firefox_backend)
+            controller.com_screenshot = ChromeScreenshot()
 
-    print("Eyecathing process completed.")
-    output.show()
+        # get screenshots
+        controller.get_screenshot(url)
+        # start compare process
+        output = controller.linear(
+            controller.ref_screenshot.imagename,
+            controller.com_screenshot.imagename,
+        )
+
+        print("Eyecathing process completed.")
+        output.show()
 
 ##########################################################################
 #                         RECURSIVE METHOD                               #
@@ -112,7 +220,7 @@ def linear(
             help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
 @click.option('--algorithm',
             default="ahash",
-            help="Perceptual hashing algorithm to be used. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash")
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
 @click.option('--ref-browser',
             default="chrome",
             help="Reference browser \n(Default: chrome) \nAvailable: chrome, firefox")
@@ -125,6 +233,61 @@ def linear(
 @click.option('--block-size',
             default=8,
             help="Smallest block size to reach recursively, px. \nLower value means more accurate but more time consuming. Min: 8\n(Default: 8)")
+@click.option('--align',
+            default="none",
+            help="Compensate offsets between images before comparison. \n(Default: none) \nAvailable: none, vertical, both")
+@click.option('--max-shift',
+            default=50,
+            help="Largest offset searched for by --align, px. \n(Default: 50)")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--in-memory',
+            is_flag=True,
+            help="Hand screenshots over from the browser process without temporary files.")
+@click.option('--save-screenshots/--no-save-screenshots',
+            default=True,
+            help="Save in-memory screenshots to disk as well. \n(Default: save)")
+@click.option('--captures',
+            default=1,
+            help="Screenshots per browser. Tiles which change between them are masked as unstable. \n(Default: 1)")
+@click.option('--flaky-threshold',
+            default=1,
+            help="Smallest score between captures of one browser to mask a tile as unstable. \n(Default: 1)")
+@click.option('--progress',
+            default="none",
+            help="Report progress while comparing. \n(Default: none) \nAvailable: none, ndjson (one JSON event per line on stdout, the log goes to stderr)")
+@click.option('--max-dissimilar-area',
+            default=None,
+            type=float,
+            help="Stop comparing once the dissimilar area exceeds this share of the page, %.")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+@click.option('--cache/--no-cache',
+            default=False,
+            help="Reuse a fresh capture of the same page, browser and width instead of capturing again. \n(Default: capture again)")
+@click.option('--cache-max-age',
+            default=3600,
+            help="Seconds a cached capture is reused for. \n(Default: 3600)")
+@click.option('--cache-check/--no-cache-check',
+            default=True,
+            help="Fetch the page and reuse a capture only if its ETag or HTML is unchanged. --no-cache-check reuses captures by age only. \n(Default: check)")
+@click.option('--cache-size',
+            default=500,
+            help="Size of the capture cache, MB. The least recently used captures are removed above it. \n(Default: 500)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
 @pass_controller
 def recursive(
     controller,
@@ -134,7 +297,25 @@ def recursive(
     output_id,
     threshold,
     block_size,
-    width
+    width,
+    ignore,
+    ignore_mask,
+    align,
+    max_shift,
+    in_memory,
+    save_screenshots,
+    grayscale,
+    firefox_backend,
+    captures,
+    flaky_threshold,
+    progress,
+    max_dissimilar_area,
+    history,
+    history_file,
+    cache,
+    cache_max_age,
+    cache_check,
+    cache_size
     ):
     """
     Test two screenshots using recursive approach
@@ -144,6 +325,145 @@ def recursive(
     validate_width(width)
     validate_block_size(block_size, width)
     validate_threshold(threshold)
+    validate_algorithm(algorithm)
+
+    validate_align(align)
+    validate_firefox_backend(firefox_backend)
+    validate_captures(captures)
+    validate_progress(progress)
+
+    # events go to stdout, which carries the log otherwise
+    set_progress(controller, progress, max_dissimilar_area)
+    with progress_output(progress):
+        print('Eyecatching is working....')
+
+        controller.algorithm = algorithm
+        controller.width = width
+        controller.url = url
+        controller.output_id = output_id
+        controller.threshold = threshold
+        controller.block_size = block_size
+        controller.align = align
+        controller.in_memory = in_memory
+        controller.grayscale = grayscale
+        controller.save_screenshots = save_screenshots
+        controller.max_shift = max_shift
+        controller.captures = captures
+        controller.flaky_threshold = flaky_threshold
+        set_history(controller, history, history_file)
+        set_cache(controller, cache, cache_max_age, cache_check, cache_size)
+        set_ignore(controller, ignore, ignore_mask)
+
+        if ref_browser == "chrome":
+            controller.ref_screenshot = ChromeScreenshot()
+            controller.com_screenshot = firefox_screenshot(firefox_backend)
+        if ref_browser == "firefox":
+            controller.ref_screenshot = firefox_screenshot(firefox_backend)
+            controller.com_screenshot = ChromeScreenshot()
+
+        # get screenshots
+        controller.get_screenshot(url)
+        output = controller.recursive(
+            controller.ref_screenshot.imagename,
+            controller.com_screenshot.imagename,
+        )
+
+        output.show()
+
+        print("Eyecathing process completed.")
+
+
+
+##########################################################################
+#                           ELEMENT METHOD                               #
+##########################################################################
+@cli.command()
+@click.argument('url')
+@click.option('--threshold',
+            default=10,
+            help="Hamming distance or threshold to consider an element dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--algorithm',
+            default="ahash",
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
+@click.option('--ref-browser',
+            default="chrome",
+            help="Reference browser \n(Default: chrome) \nAvailable: chrome, firefox")
+@click.option('--output-id',
+            default="_",
+            help="An identifieable name to be added in the output file.")
+@click.option('--width',
+            default=1280,
+            help="Viewport width, px. \n(Default: 1280)")
+@click.option('--align',
+            default="none",
+            help="Compensate offsets between images before comparison. \n(Default: none) \nAvailable: none, vertical, both")
+@click.option('--max-shift',
+            default=50,
+            help="Largest offset searched for by --align, px. \n(Default: 50)")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--in-memory',
+            is_flag=True,
+            help="Hand screenshots over from the browser process without temporary files.")
+@click.option('--save-screenshots/--no-save-screenshots',
+            default=True,
+            help="Save in-memory screenshots to disk as well. \n(Default: save)")
+@click.option('--captures',
+            default=1,
+            help="Screenshots per browser. Tiles which change between them are masked as unstable. \n(Default: 1)")
+@click.option('--flaky-threshold',
+            default=1,
+            help="Smallest score between captures of one browser to mask a tile as unstable. \n(Default: 1)")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
+@pass_controller
+def element(
+    controller,
+    url,
+    threshold,
+    algorithm,
+    ref_browser,
+    output_id,
+    width,
+    ignore,
+    ignore_mask,
+    align,
+    max_shift,
+    in_memory,
+    save_screenshots,
+    grayscale,
+    firefox_backend,
+    captures,
+    flaky_threshold,
+    history,
+    history_file
+    ):
+    """
+    Test two screenshots element by element using DOM element boxes
+    """
+
+    validate_url(url)
+    validate_width(width)
+    validate_threshold(threshold)
+    validate_algorithm(algorithm)
+
+    validate_align(align)
+    validate_firefox_backend(firefox_backend)
+    validate_captures(captures)
 
     print('Eyecatching is working....')
 
@@ -152,18 +472,27 @@ def recursive(
     controller.url = url
     controller.output_id = output_id
     controller.threshold = threshold
-    controller.block_size = block_size
+    controller.export_elements = True
+    controller.align = align
+    controller.in_memory = in_memory
+    controller.grayscale = grayscale
+    controller.save_screenshots = save_screenshots
+    controller.max_shift = max_shift
+    controller.captures = captures
+    controller.flaky_threshold = flaky_threshold
+    set_history(controller, history, history_file)
+    set_ignore(controller, ignore, ignore_mask)
 
     if ref_browser == "chrome":
         controller.ref_screenshot = ChromeScreenshot()
-        controller.com_screenshot = FirefoxScreenshot()
+        controller.com_screenshot = firefox_screenshot(firefox_backend)
     if ref_browser == "firefox":
-        controller.ref_screenshot = FirefoxScreenshot()
+        controller.ref_screenshot = firefox_screenshot(firefox_backend)
         controller.com_screenshot = ChromeScreenshot()
 
-    # get screenshots
+    # get screenshots, chrome exports the element boxes
     controller.get_screenshot(url)
-    output = controller.recursive(
+    output = controller.element(
         controller.ref_screenshot.imagename,
         controller.com_screenshot.imagename,
     )
@@ -172,29 +501,45 @@ def recursive(
 
     print("Eyecathing process completed.")
 
-
-
 ##########################################################################
 #                          GET SCREENSHOT                                #
 ##########################################################################
 @cli.command()
-@click.argument('url')
+@click.argument('urls', nargs=-1, required=True)
 @click.option('--browser',
             default="chrome, firefox",
             help="Browser to be used. \n(Default: chrome, firefox)")
 @click.option('--width',
             default=1280,
             help="Viewport width, px. \n(Default: 1280)")
+@click.option('--concurrency',
+            default=2,
+            help="Browser processes running at the same time. \n(Default: 2)")
+@click.option('--timeout',
+            default=60,
+            help="Seconds before a screenshot is aborted. \n(Default: 60)")
+@click.option('--retries',
+            default=2,
+            help="Extra attempts for a failed screenshot. \n(Default: 2)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
 def screenshot(
-    url,
+    urls,
     width,
+    concurrency,
+    timeout,
+    retries,
+    firefox_backend,
     browser = "chrome, firefox",
     ):
     """
-    Get screenshot of the given webpage URL
+    Get screenshot of the given webpage URL(s)
     """
-    validate_url(url)
+    for url in urls:
+        validate_url(url)
     validate_width(width)
+    validate_firefox_backend(firefox_backend)
 
     if browser != "":
         list = browser.split(",")
@@ -207,15 +552,307 @@ def screenshot(
         print("Error: \tNo browser provided!")
         exit()
 
-    if has_firefox:
-        ff = FirefoxScreenshot()
-        ff.width = width
-        ff.take_shot(url)
-    
-    if has_chrome:
-        ch = ChromeScreenshot()
+    jobs = []
+    for i, url in enumerate(urls):
+        # firefox.png, chrome.png for one URL, firefox_1.png, ... for more
+        suffix = "" if len(urls) == 1 else "_{0}".format(i + 1)
+        if has_firefox:
+            ff = firefox_screenshot(firefox_backend, "firefox" + suffix)
+            ff.width = width
+            jobs.append(CaptureJob(url, ff))
+        if has_chrome:
+            ch = ChromeScreenshot("chrome" + suffix)
+            ch.width = width
+            jobs.append(CaptureJob(url, ch))
+
+    orchestrator = CaptureOrchestrator(concurrency, timeout, retries)
+    orchestrator.run(jobs)
+
+    for job in jobs:
+        if job.ok:
+            print("Done: \t{0} saved as {1} in {2:.2f} seconds".format(job.url, job.screenshot.imagename, job.elapsed))
+        else:
+            print("Error: \t{0} failed in {1} after {2} attempt(s): {3}".format(
+                job.url, job.screenshot.name, job.attempts, job.error
+            ))
+
+##########################################################################
+#                             BATCH METHOD                               #
+##########################################################################
+@cli.command()
+@click.argument('method')
+@click.argument('urls', nargs=-1, required=True)
+@click.option('--block-size',
+            default=10,
+            help="Tile block size, px. \n(Default: 10)")
+@click.option('--algorithm',
+            default="ahash",
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
+@click.option('--ref-browser',
+            default="chrome",
+            help="Reference browser \n(Default: chrome) \nAvailable: chrome, firefox")
+@click.option('--width',
+            default=1280,
+            help="Viewport width, px. \n(Default: 1280)")
+@click.option('--threshold',
+            default=10,
+            help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--concurrency',
+            default=2,
+            help="Browser processes running at the same time. \n(Default: 2)")
+@click.option('--timeout',
+            default=60,
+            help="Seconds before a screenshot is aborted. \n(Default: 60)")
+@click.option('--retries',
+            default=2,
+            help="Extra attempts for a failed screenshot. \n(Default: 2)")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--in-memory',
+            is_flag=True,
+            help="Hand screenshots over from the browser process without temporary files.")
+@click.option('--save-screenshots/--no-save-screenshots',
+            default=True,
+            help="Save in-memory screenshots to disk as well. \n(Default: save)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+def batch(
+    method,
+    urls,
+    block_size,
+    algorithm,
+    ref_browser,
+    width,
+    threshold,
+    concurrency,
+    timeout,
+    retries,
+    in_memory,
+    save_screenshots,
+    grayscale,
+    firefox_backend,
+    history,
+    history_file
+    ):
+    """
+    Test several URLs, comparing pages while others are still captured
+    """
+    for url in urls:
+        validate_url(url)
+    validate_width(width)
+    validate_firefox_backend(firefox_backend)
+    validate_block_size(block_size, width)
+    validate_threshold(threshold)
+    validate_algorithm(algorithm)
+    if method not in ("linear", "recursive", "element"):
+        print("Error: \tUnknown method {0}! Please use one of: linear, recursive, element".format(method))
+        exit()
+
+    print('Eyecatching is working....')
+
+    result_history = ResultHistory(history_file) if history else None
+    pairs = []
+    for i, url in enumerate(urls):
+        suffix = "_{0}".format(i + 1)
+        ch = ChromeScreenshot("chrome" + suffix)
+        ff = firefox_screenshot(firefox_backend, "firefox" + suffix)
+        ch.export_elements = method == "element"
         ch.width = width
-        ch.take_shot(url)
+        ff.width = width
+        for shot in (ch, ff):
+            shot.in_memory = in_memory
+            shot.save_screenshot = save_screenshots
+        if ref_browser == "firefox":
+            pairs.append((CaptureJob(url, ff), CaptureJob(url, ch)))
+        else:
+            pairs.append((CaptureJob(url, ch), CaptureJob(url, ff)))
+
+    def compare_pair(ref_job, com_job):
+        controller = Controller()
+        controller.algorithm = algorithm
+        controller.width = width
+        controller.url = ref_job.url
+        controller.block_size = block_size
+        controller.threshold = threshold
+        controller.output_id = ref_job.screenshot.name.split("_")[-1]
+        controller.ref_screenshot = ref_job.screenshot
+        controller.com_screenshot = com_job.screenshot
+        controller.grayscale = grayscale
+        controller.history = result_history
+        if in_memory:
+            controller.images = {
+                ref_job.screenshot.imagename: ref_job.screenshot.image,
+                com_job.screenshot.imagename: com_job.screenshot.image
+            }
+        if method == "linear":
+            controller.linear(ref_job.screenshot.imagename, com_job.screenshot.imagename)
+        if method == "recursive":
+            controller.recursive(ref_job.screenshot.imagename, com_job.screenshot.imagename)
+        if method == "element":
+            controller.element(ref_job.screenshot.imagename, com_job.screenshot.imagename)
+        return ref_job.url
+
+    orchestrator = CaptureOrchestrator(concurrency, timeout, retries)
+    results = orchestrator.run_and_compare(pairs, compare_pair)
+
+    for (ref_job, com_job), result in zip(pairs, results):
+        if result is None:
+            print("Error: \t{0} could not be captured: {1}".format(ref_job.url, ref_job.error or com_job.error))
+
+    print("Eyecathing process completed.")
+
+##########################################################################
+#                              SITE CRAWL                                #
+##########################################################################
+@cli.command()
+@click.argument('start_url')
+@click.option('--depth',
+            default=2,
+            help="Largest number of links followed from the start page. \n(Default: 2)")
+@click.option('--max-pages',
+            default=20,
+            help="Largest number of pages compared. \n(Default: 20)")
+@click.option('--block-size',
+            default=10,
+            help="Tile block size, px. \n(Default: 10)")
+@click.option('--algorithm',
+            default="ahash",
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
+@click.option('--ref-browser',
+            default="chrome",
+            help="Reference browser \n(Default: chrome) \nAvailable: chrome, firefox")
+@click.option('--width',
+            default=1280,
+            help="Viewport width, px. \n(Default: 1280)")
+@click.option('--threshold',
+            default=10,
+            help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--concurrency',
+            default=2,
+            help="Browser processes running at the same time. \n(Default: 2)")
+@click.option('--timeout',
+            default=60,
+            help="Seconds before a screenshot is aborted. \n(Default: 60)")
+@click.option('--retries',
+            default=2,
+            help="Extra attempts for a failed screenshot. \n(Default: 2)")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--save-screenshots/--no-save-screenshots',
+            default=False,
+            help="Save the screenshots of every page to disk. \n(Default: no-save)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
+@click.option('--report',
+            default="crawl_report.json",
+            help="File the per-page and site-wide report is saved to. \n(Default: crawl_report.json)")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+def crawl(
+    start_url,
+    depth,
+    max_pages,
+    block_size,
+    algorithm,
+    ref_browser,
+    width,
+    threshold,
+    concurrency,
+    timeout,
+    retries,
+    grayscale,
+    save_screenshots,
+    firefox_backend,
+    report,
+    history,
+    history_file
+    ):
+    """
+    Compare the pages of a site, following same-origin links from the
+    start page. With per-tile metrics (phash, whash) blocks repeated
+    across pages are compared only once.
+    """
+    validate_url(start_url)
+    validate_width(width)
+    validate_firefox_backend(firefox_backend)
+    validate_block_size(block_size, width)
+    validate_threshold(threshold)
+    validate_algorithm(algorithm)
+
+    print('Eyecatching is working....')
+
+    urls = SiteCrawler(start_url, depth, max_pages).pages()
+    if len(urls) == 0:
+        print("Error: \tNo pages found at {0}".format(start_url))
+        exit()
+
+    pairs = []
+    for i, url in enumerate(urls):
+        suffix = "_{0}".format(i + 1)
+        ch = ChromeScreenshot("chrome" + suffix)
+        ff = firefox_screenshot(firefox_backend, "firefox" + suffix)
+        for shot in (ch, ff):
+            shot.width = width
+            shot.in_memory = True
+            shot.save_screenshot = save_screenshots
+        if ref_browser == "firefox":
+            pairs.append((CaptureJob(url, ff), CaptureJob(url, ch)))
+        else:
+            pairs.append((CaptureJob(url, ch), CaptureJob(url, ff)))
+
+    site_report = SiteReport(start_url, urls)
+    result_history = ResultHistory(history_file) if history else None
+    # tile digest: score, for all pages of the site
+    shared_tiles = {}
+
+    def compare_page(ref_job, com_job):
+        controller = Controller()
+        controller.algorithm = algorithm
+        controller.width = width
+        controller.url = ref_job.url
+        controller.block_size = block_size
+        controller.threshold = threshold
+        controller.grayscale = grayscale
+        controller.shared_tiles = shared_tiles
+        controller.history = result_history
+        controller.output_id = ref_job.screenshot.name.split("_")[-1]
+        controller.ref_screenshot = ref_job.screenshot
+        controller.com_screenshot = com_job.screenshot
+        controller.images = {
+            ref_job.screenshot.imagename: ref_job.screenshot.image,
+            com_job.screenshot.imagename: com_job.screenshot.image
+        }
+        controller.linear(ref_job.screenshot.imagename, com_job.screenshot.imagename)
+        site_report.add(ref_job.url, controller.summary)
+        # the page is done, do not keep its screenshots
+        ref_job.screenshot.image = None
+        com_job.screenshot.image = None
+        return ref_job.url
+
+    orchestrator = CaptureOrchestrator(concurrency, timeout, retries)
+    results = orchestrator.run_and_compare(pairs, compare_page)
+
+    for (ref_job, com_job), result in zip(pairs, results):
+        if result is None:
+            site_report.add_error(ref_job.url, ref_job.error or com_job.error)
+
+    site_report.print_report()
+    site_report.save(report)
+    print("Eyecathing process completed.")
 
 ##########################################################################
 #                           MANUAL COMPARE                               #
@@ -229,13 +866,44 @@ def screenshot(
             help="Tile block size, px. \n(Default: 10)")
 @click.option('--algorithm',
             default="ahash",
-            help="Perceptual hashing algorithm to be used. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash")
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
 @click.option('--output-id',
             default="_",
             help="An identifieable name to be added in the output file.")
 @click.option('--threshold',
             default=10,
             help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--align',
+            default="none",
+            help="Compensate offsets between images before comparison. \n(Default: none) \nAvailable: none, vertical, both")
+@click.option('--max-shift',
+            default=50,
+            help="Largest offset searched for by --align, px. \n(Default: 50)")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--elements',
+            default=None,
+            help="JSON file with element boxes for the element method. \n(Default: <image>.json exported on capture)")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--progress',
+            default="none",
+            help="Report progress while comparing. \n(Default: none) \nAvailable: none, ndjson (one JSON event per line on stdout, the log goes to stderr)")
+@click.option('--max-dissimilar-area',
+            default=None,
+            type=float,
+            help="Stop comparing once the dissimilar area exceeds this share of the page, %.")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record the result in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
 @pass_controller
 def compare(
     controller,
@@ -245,30 +913,345 @@ def compare(
     block_size,
     algorithm,
     output_id,
-    threshold
+    threshold,
+    ignore,
+    ignore_mask,
+    align,
+    max_shift,
+    elements,
+    grayscale,
+    progress,
+    max_dissimilar_area,
+    history,
+    history_file
     ):
     """
-    Test two images with given method
+    Test two images with given method (linear, recursive or element)
     """
     validate_threshold(threshold)
+    validate_algorithm(algorithm)
+    validate_block_size(block_size, Image.open(image1).width)
+    validate_align(align)
+    validate_progress(progress)
+
+    # events go to stdout, which carries the log otherwise
+    set_progress(controller, progress, max_dissimilar_area)
+    with progress_output(progress):
+        print('Eyecatching is working....')
+
+        controller.algorithm = algorithm
+        controller.output_id = output_id
+        controller.threshold = threshold
+        controller.block_size = block_size
+        controller.elements_file = elements
+        controller.align = align
+        controller.max_shift = max_shift
+        controller.grayscale = grayscale
+        set_history(controller, history, history_file)
+        set_ignore(controller, ignore, ignore_mask, can_resolve_selectors = False)
+
+        # start compare process
+        if method == "linear":
+            output = controller.linear(image1, image2)
+        if method == "recursive":
+            output = controller.recursive(image1, image2)
+        if method == "element":
+            output = controller.element(image1, image2)
+        
+        output.show()
+
+        print("Eyecathing process completed.")
+
+##########################################################################
+#                                WATCH                                   #
+##########################################################################
+@cli.command()
+@click.argument('image1')
+@click.argument('image2')
+@click.option('--block-size',
+            default=10,
+            help="Tile block size, px. \n(Default: 10)")
+@click.option('--algorithm',
+            default="ahash",
+            help="Algorithm to score blocks with. \n(Default: ahash) \nAvailable: ahash, phash, dhash, whash (perceptual hashes), pixel (exact pixel difference), mae (mean absolute error), ssim (block structural similarity)")
+@click.option('--output-id',
+            default="_",
+            help="An identifieable name to be added in the output file.")
+@click.option('--threshold',
+            default=10,
+            help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2. Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@click.option('--interval',
+            default=0.5,
+            help="Seconds between checks for changed files. \n(Default: 0.5)")
+@pass_controller
+def watch(
+    controller,
+    image1,
+    image2,
+    block_size,
+    algorithm,
+    output_id,
+    threshold,
+    ignore,
+    ignore_mask,
+    grayscale,
+    interval
+    ):
+    """
+    Compare two images block by block again whenever one of them changes
+    """
+    validate_threshold(threshold)
+    validate_algorithm(algorithm)
     validate_block_size(block_size, Image.open(image1).width)
-    
-    print('Eyecatching is working....')
 
     controller.algorithm = algorithm
     controller.output_id = output_id
     controller.threshold = threshold
     controller.block_size = block_size
+    controller.grayscale = grayscale
+    set_ignore(controller, ignore, ignore_mask, can_resolve_selectors = False)
 
-    # start compare process
-    if method == "linear":
-        output = controller.linear(image1, image2)
-    if method == "recursive":
-        output = controller.recursive(image1, image2)
-        
-    output.show()
+    watcher = ComparisonWatcher(controller, image1, image2)
+    watcher.interval = interval
+    watcher.run()
 
-    print("Eyecathing process completed.")
+##########################################################################
+#                            RESULT HISTORY                              #
+##########################################################################
+@cli.command()
+@click.argument('url', required=False)
+@click.option('--ref-browser',
+            default=None,
+            help="Only runs with this reference browser (or reference image name).")
+@click.option('--com-browser',
+            default=None,
+            help="Only runs with this comparable browser (or comparable image name).")
+@click.option('--width',
+            default=None,
+            type=int,
+            help="Only runs with this page width, px.")
+@click.option('--limit',
+            default=20,
+            help="Number of runs listed, newest first. \n(Default: 20)")
+@click.option('--good-area',
+            default=0.0,
+            help="Largest dissimilar area of a good run, %. \n(Default: 0)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+def history(url, ref_browser, com_browser, width, limit, good_area, history_file):
+    """
+    List recorded runs and compare the newest with the last good run
+    """
+    if not os.path.exists(history_file):
+        print("Error: \tNo result history found at {0}!".format(history_file))
+        exit()
+
+    result_history = ResultHistory(history_file)
+    runs = result_history.runs(url, ref_browser, com_browser, width, limit)
+    if len(runs) == 0:
+        print("Info: \tNo runs recorded{0}".format(" for " + url if url is not None else ""))
+        return
+    result_history.print_trend(runs)
+    result_history.print_against_last_good(runs[0], good_area)
+
+##########################################################################
+#                          SHARDED WORK QUEUE                            #
+##########################################################################
+@cli.command()
+@click.argument('queue_dir')
+@click.option('--pair',
+            multiple=True,
+            help="Image pair to compare, as ref.png,com.png. Can be repeated.")
+@click.option('--url',
+            multiple=True,
+            help="Page to capture and compare on a worker. Can be repeated.")
+@click.option('--width',
+            multiple=True,
+            type=int,
+            help="Viewport width of the pages, px. Can be repeated. \n(Default: 1280)")
+@click.option('--algorithm',
+            multiple=True,
+            help="Algorithm to score blocks with. Can be repeated. \n(Default: ahash)")
+@click.option('--method',
+            default="linear",
+            help="Comparison method. \n(Default: linear) \nAvailable: linear, recursive")
+@click.option('--band-height',
+            default=0,
+            help="Split the one --pair into bands of this height, px, scored by separate jobs (linear only). 0 queues whole comparisons. \n(Default: 0)")
+@click.option('--ref-browser',
+            default="chrome",
+            help="Reference browser of --url pages \n(Default: chrome) \nAvailable: chrome, firefox")
+@click.option('--block-size',
+            default=10,
+            help="Tile block size, px. \n(Default: 10)")
+@click.option('--threshold',
+            default=10,
+            help="Hamming distance or threshold to consider a block dissimilar. \n(Default: 10) \tAvailable: 0 - 63")
+@click.option('--output-id',
+            default="_",
+            help="An identifieable name to be added in the output file of a banded comparison.")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--grayscale',
+            is_flag=True,
+            help="Compare luminance only to save memory. The output is still marked in colour.")
+@pass_controller
+def shard(
+    controller,
+    queue_dir,
+    pair,
+    url,
+    width,
+    algorithm,
+    method,
+    band_height,
+    ref_browser,
+    block_size,
+    threshold,
+    output_id,
+    ignore,
+    ignore_mask,
+    grayscale
+    ):
+    """
+    Queue comparisons as jobs for eyecatching worker processes
+    """
+    widths = width or (1280,)
+    algorithms = algorithm or ("ahash",)
+    for u in url:
+        validate_url(u)
+    for w in widths:
+        validate_width(w)
+        validate_block_size(block_size, w)
+    for a in algorithms:
+        validate_algorithm(a)
+    validate_threshold(threshold)
+    if method not in ("linear", "recursive"):
+        print("Error: \tUnknown method {0}! Please use one of: linear, recursive".format(method))
+        exit()
+
+    pairs = []
+    for value in pair:
+        images = value.split(",")
+        if len(images) != 2:
+            print("Error: \tPair {0} is not ref.png,com.png!".format(value))
+            exit()
+        for image in images:
+            if not os.path.exists(image):
+                print("Error: \tImage {0} not found!".format(image))
+                exit()
+        pairs.append(tuple(images))
+    if len(pairs) + len(url) == 0:
+        print("Error: \tNothing to queue! Please give --pair or --url.")
+        exit()
+    if band_height > 0 and (len(pairs) != 1 or len(url) > 0 or len(algorithms) > 1 or method != "linear"):
+        print("Error: \t--band-height splits one --pair with one algorithm, compared linear.")
+        exit()
+
+    queue = WorkQueue(queue_dir)
+    if queue.exists():
+        print("Error: \tQueue {0} has a plan already! Please use another directory.".format(queue_dir))
+        exit()
+
+    set_ignore(controller, ignore, ignore_mask, can_resolve_selectors = len(url) > 0)
+    params = {
+        "method": method,
+        "ref_browser": ref_browser,
+        "block_size": block_size,
+        "threshold": threshold,
+        "grayscale": grayscale,
+        "output_id": output_id,
+        "ignore_boxes": [list(box) for box in controller.ignore_boxes],
+        "ignore_selectors": list(controller.ignore_selectors),
+        "ignore_mask": queue.add_input(ignore_mask, "mask") if ignore_mask is not None else None,
+    }
+    if band_height > 0:
+        params["algorithm"] = algorithms[0]
+        plan_bands(queue, params, pairs[0][0], pairs[0][1], band_height)
+    else:
+        plan_comparisons(queue, params, pairs, url, widths, algorithms)
+    print("Info: \tStart workers with: eyecatching worker {0}".format(queue_dir))
+
+
+@cli.command()
+@click.argument('queue_dir')
+@click.option('--name',
+            default=None,
+            help="Name of the worker in results. \n(Default: host-pid)")
+@click.option('--wait',
+            is_flag=True,
+            help="Keep polling until every job of the queue is done, to take over stale or retried jobs.")
+@click.option('--max-jobs',
+            default=None,
+            type=int,
+            help="Stop after this number of jobs.")
+@click.option('--stale-after',
+            default=1800,
+            help="Seconds after which a claimed, unfinished job is queued again. \n(Default: 1800)")
+@click.option('--retries',
+            default=1,
+            help="Extra attempts of a failed job. \n(Default: 1)")
+@click.option('--firefox-backend',
+            default="cli",
+            help="How Firefox screenshots are taken. \n(Default: cli) \nAvailable: cli (firefox -screenshot per URL), marionette (one persistent headless Firefox)")
+def worker(queue_dir, name, wait, max_jobs, stale_after, retries, firefox_backend):
+    """
+    Process jobs of a queue created with eyecatching shard
+    """
+    validate_firefox_backend(firefox_backend)
+    queue = WorkQueue(queue_dir)
+    if not queue.exists():
+        print("Error: \tNo queue found at {0}!".format(queue_dir))
+        exit()
+    queue.stale_after = stale_after
+    queue.retries = retries
+
+    def make_screenshots(ref_browser):
+        if ref_browser == "firefox":
+            return (firefox_screenshot(firefox_backend), ChromeScreenshot())
+        return (ChromeScreenshot(), firefox_screenshot(firefox_backend))
+
+    ShardWorker(queue, name, make_screenshots).run(wait, max_jobs)
+
+
+@cli.command()
+@click.argument('queue_dir')
+@click.option('--output-dir',
+            default=".",
+            help="Directory the output images and report are saved in. \n(Default: .)")
+@click.option('--report',
+            default="shard_report.json",
+            help="File name of the merged report. \n(Default: shard_report.json)")
+@click.option('--history/--no-history',
+            default=True,
+            help="Record a banded comparison in the result history. \n(Default: record)")
+@click.option('--history-file',
+            default="eyecatching_history.db",
+            help="SQLite file of the result history. \n(Default: eyecatching_history.db)")
+def merge(queue_dir, output_dir, report, history, history_file):
+    """
+    Assemble the results of the workers of a queue
+    """
+    queue = WorkQueue(queue_dir)
+    if not queue.exists():
+        print("Error: \tNo queue found at {0}!".format(queue_dir))
+        exit()
+    result_history = ResultHistory(history_file) if history else None
+    ShardMerge(queue).run(output_dir, report, result_history)
 
 ##########################################################################
 #                             SHIFT DETECT                               #
@@ -279,12 +1262,23 @@ def compare(
 @click.option('--output-id',
             default="_",
             help="An identifieable name to be added in the output file.")
+@click.option('--ignore',
+            multiple=True,
+            help="Region to skip in comparison, as x1,y1,x2,y2 or a CSS selector (resolved during capture). Can be repeated.")
+@click.option('--ignore-mask',
+            default=None,
+            help="Mask image. White (non-black) pixels are skipped in comparison.")
+@click.option('--pyramid',
+            is_flag=True,
+            help="Detect shapes on a downscaled page first, then trace them at full resolution only where found.")
 @pass_controller
-def shift(controller, image1, image2, output_id):
+def shift(controller, image1, image2, output_id, ignore, ignore_mask, pyramid):
     """
     Detect shift of objects between two images
     """
     controller.output_id = output_id
+    controller.shift_pyramid = pyramid
+    set_ignore(controller, ignore, ignore_mask, can_resolve_selectors = False)
     output = controller.detect_shift(image1, image2)
     output.show()
 
@@ -301,6 +1295,26 @@ def normalize(controller, image1, image2):
     """
     controller.normalize_images(image1, image2)
 
+##########################################################################
+#                           COMPARISON SERVICE                           #
+##########################################################################
+@cli.command()
+@click.option('--host',
+            default="127.0.0.1",
+            help="Address to listen on. \n(Default: 127.0.0.1)")
+@click.option('--port',
+            default=8765,
+            help="Port to listen on. \n(Default: 8765)")
+@click.option('--workers',
+            default=2,
+            help="Number of pre-forked worker processes. \n(Default: 2)")
+def serve(host, port, workers):
+    """
+    Serve comparisons over a local HTTP API (POST /compare)
+    """
+    from server import serve as serve_http
+    serve_http(host, port, workers)
+
 ##########################################################################
 #                              FIRST RUN                                 #
 ##########################################################################
@@ -325,12 +1339,78 @@ def reset():
         if (f.endswith(".jpg")
         or f.endswith(".jpeg")
         or f.endswith(".png")
-        or f.endswith(".avi")):
+        or f.endswith(".avi")
+        or f in ("chrome.json", "firefox.json")):
             os.remove(f)
             folder = f.split(".")[0]
             if os.path.exists(folder):
                 shutil.rmtree(folder)
-    print('All input/output images and directories removed.')
+    CaptureCache().clear()
+    print('All input/output images, directories and cached captures removed.')
+
+
+def set_ignore(controller, ignore, ignore_mask, can_resolve_selectors = True):
+    """
+    Split --ignore values into boxes and CSS selectors and set them to controller
+    """
+    boxes = []
+    selectors = []
+    for value in ignore:
+        parts = value.split(",")
+        if len(parts) == 4 and all(p.strip().isdigit() for p in parts):
+            boxes.append(tuple(int(p) for p in parts))
+        else:
+            selectors.append(value)
+
+    if len(selectors) > 0 and not can_resolve_selectors:
+        print("Warning: \tCSS selectors need a capture to be resolved, ignoring: {0}".format(", ".join(selectors)))
+        selectors = []
+
+    if ignore_mask is not None and not os.path.exists(ignore_mask):
+        print("Error: \tMask image {0} not found!".format(ignore_mask))
+        exit()
+
+    controller.ignore_boxes = boxes
+    controller.ignore_selectors = selectors
+    controller.ignore_mask = ignore_mask
+
+
+def set_history(controller, history, history_file):
+    """
+    Record the comparison of controller in the result history, if asked to
+    """
+    controller.history = ResultHistory(history_file) if history else None
+
+
+def set_cache(controller, cache, max_age, check, size):
+    """
+    Reuse fresh captures of controller from the capture cache, if asked to
+    """
+    controller.capture_cache = CaptureCache(max_age = max_age, max_bytes = size * 1024 * 1024) if cache else None
+    controller.cache_check = check
+
+
+def set_progress(controller, progress, max_dissimilar_area):
+    """
+    Stream progress events of controller to stdout, if asked to
+    """
+    controller.progress = ProgressReporter(sys.stdout) if progress == "ndjson" else None
+    controller.max_dissimilar_area = max_dissimilar_area
+
+
+def progress_output(progress):
+    """
+    Context in which the log goes to stderr if stdout carries progress events
+    """
+    if progress == "ndjson":
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
+
+
+def firefox_screenshot(backend, name = "firefox"):
+    if backend == "marionette":
+        return MarionetteFirefoxScreenshot(name)
+    return FirefoxScreenshot(name)
 
 
 def is_valid_url(url):
@@ -376,6 +1456,46 @@ def validate_threshold(threshold):
     print("Error:\tExiting...")
     exit()
 
+def validate_algorithm(algorithm):
+    if algorithm in METRICS:
+        return
+
+    print("Error: \tUnknown algorithm {0}! Please use one of: {1}".format(algorithm, ", ".join(METRICS)))
+    print("Error:\tExiting...")
+    exit()
+
+def validate_captures(captures):
+    if captures >= 1:
+        return
+
+    print("Error: \tCaptures must be at least 1!")
+    print("Error:\tExiting...")
+    exit()
+
+def validate_progress(progress):
+    if progress in ("none", "ndjson"):
+        return
+
+    print("Error: \tUnknown progress format {0}! Please use one of: none, ndjson".format(progress))
+    print("Error:\tExiting...")
+    exit()
+
+def validate_align(align):
+    if align in ("none", "vertical", "both"):
+        return
+
+    print("Error: \tUnknown alignment {0}! Please use one of: none, vertical, both".format(align))
+    print("Error:\tExiting...")
+    exit()
+
+def validate_firefox_backend(backend):
+    if backend in ("cli", "marionette"):
+        return
+
+    print("Error: \tUnknown Firefox backend {0}! Please use one of: cli, marionette".format(backend))
+    print("Error:\tExiting...")
+    exit()
+
 def validate_block_size(value, width):
     v = int(value) if type(value) is str else value
 
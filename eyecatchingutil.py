@@ -1,17 +1,86 @@
 import subprocess
 import os
+import io
+import json
 import sys
 import shutil
-import imagehash
+import importlib
 from PIL import Image
 from urllib.parse import urlparse
+from marionette import FirefoxSession
+
+
+class LazyModule:
+    """
+    Module which is imported on first attribute access.
+    Keeps heavy modules (numpy, cv2, imagehash) out of the CLI startup.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule("numpy")
+cv2 = LazyModule("cv2")
+imagehash = LazyModule("imagehash")
+
+def peak_memory():
+    """
+    Peak resident memory of this process in MB
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def last_error(log):
+    """
+    Message of the last error printed to log, None if there is none
+    """
+    messages = [line[len("Error:"):].strip() for line in log.splitlines() if line.startswith("Error:")]
+    # "Exiting..." closes the messages, it does not tell why
+    messages = [message for message in messages if message != "Exiting..."]
+    return messages[-1] if messages else None
+
+
+def merge_boxes(boxes):
+    """
+    Merge overlapping (x1, y1, x2, y2) boxes until none overlap
+    """
+    merged = []
+    for box in sorted(boxes):
+        (x1, y1, x2, y2) = box
+        i = 0
+        while i < len(merged):
+            (mx1, my1, mx2, my2) = merged[i]
+            if x1 < mx2 and mx1 < x2 and y1 < my2 and my1 < y2:
+                # grown box may now overlap others, check all again
+                (x1, y1, x2, y2) = (min(x1, mx1), min(y1, my1), max(x2, mx2), max(y2, my2))
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append((x1, y1, x2, y2))
+    return merged
+
 
 class MetaImage:
 
-    def __init__(self, imagename):
+    def __init__(self, imagename, image = None):
         self.imagename = imagename
         self.prefix = imagename.split(".")[0].split("_")[0]
-        self.image = Image.open(self.imagename)
+        # an already decoded image is used as is
+        self.image = Image.open(self.imagename) if image is None else image
         self.size = self.image.size
         self.width = self.image.size[0]
         self.height = self.image.size[1]
@@ -69,6 +138,9 @@ class MetaImage:
 
 
 class Coordinates:
+
+    __slots__ = ("x1", "y1", "x2", "y2", "width", "height", "mid_x", "mid_y")
+
     def __init__(self, l, t, r, b):
         self.x1 = l
         self.y1 = t
@@ -147,12 +219,321 @@ class Coordinates:
 
 
 
+class Region:
+    """
+    Connected region of dissimilar tiles
+    """
+
+    __slots__ = ("x1", "y1", "x2", "y2", "area", "tiles", "max_distance", "mean_distance")
+
+    def __init__(self, x1, y1, x2, y2, area, tiles, max_distance, mean_distance):
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.area = area
+        self.tiles = tiles
+        self.max_distance = max_distance
+        self.mean_distance = mean_distance
+
+    def as_tuple(self):
+        return (self.x1, self.y1, self.x2, self.y2)
+
+
+class MarkedTiles:
+    """
+    Marked tiles stored as rows (x1, y1, x2, y2, distance) of one
+    growable int32 array instead of an object per tile
+    """
+
+    def __init__(self, capacity = 1024):
+        self._data = np.empty((capacity, 5), dtype = np.int32)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, x1, y1, x2, y2, distance):
+        if self.count == len(self._data):
+            grown = np.empty((2 * len(self._data), 5), dtype = np.int32)
+            grown[:self.count] = self._data
+            self._data = grown
+        self._data[self.count] = (x1, y1, x2, y2, distance)
+        self.count += 1
+
+    def rows(self):
+        return self._data[:self.count]
+
+    def total_area(self):
+        t = self.rows()
+        return int(((t[:, 2] - t[:, 0]) * (t[:, 3] - t[:, 1])).sum())
+
+    def regions(self, size, cell):
+        """
+        Merge tiles into connected regions by labeling a grid of
+        cell x cell px, largest region first
+        """
+        if self.count == 0:
+            return []
+
+        width, height = size
+        t = self.rows()
+        grid = np.zeros((-(-height // cell), -(-width // cell)), dtype = np.uint8)
+        cx1 = t[:, 0] // cell
+        cy1 = t[:, 1] // cell
+        cx2 = -(-t[:, 2] // cell)
+        cy2 = -(-t[:, 3] // cell)
+        # tiles can span more than one cell in recursive mode
+        for i in range(self.count):
+            grid[cy1[i]:cy2[i], cx1[i]:cx2[i]] = 1
+
+        (n, labels) = cv2.connectedComponents(grid, connectivity = 8)
+        tile_labels = labels[cy1, cx1]
+        areas = (t[:, 2] - t[:, 0]) * (t[:, 3] - t[:, 1])
+
+        x1 = np.full(n, width, dtype = np.int64)
+        y1 = np.full(n, height, dtype = np.int64)
+        x2 = np.zeros(n, dtype = np.int64)
+        y2 = np.zeros(n, dtype = np.int64)
+        max_distance = np.zeros(n, dtype = np.int64)
+        np.minimum.at(x1, tile_labels, t[:, 0])
+        np.minimum.at(y1, tile_labels, t[:, 1])
+        np.maximum.at(x2, tile_labels, t[:, 2])
+        np.maximum.at(y2, tile_labels, t[:, 3])
+        np.maximum.at(max_distance, tile_labels, t[:, 4])
+        tiles = np.bincount(tile_labels, minlength = n)
+        area = np.bincount(tile_labels, weights = areas, minlength = n)
+        distance = np.bincount(tile_labels, weights = t[:, 4], minlength = n)
+
+        regions = []
+        for label in np.nonzero(tiles)[0]:
+            regions.append(Region(
+                int(x1[label]), int(y1[label]), int(x2[label]), int(y2[label]),
+                int(area[label]),
+                int(tiles[label]),
+                int(max_distance[label]),
+                float(distance[label] / tiles[label])
+            ))
+        regions.sort(key = lambda r: r.area, reverse = True)
+        return regions
+
+
+
+class IgnoreMask:
+    """
+    Regions of an image which are excluded from comparison.
+    Backed by a boolean pixel mask and its summed-area table, so the
+    masked area of any box is looked up in constant time.
+    """
+
+    def __init__(self, size):
+        self.width, self.height = size
+        self.mask = np.zeros((self.height, self.width), dtype = bool)
+        self._integral = None
+        self._empty = True
+
+    def add_box(self, box):
+        """
+        Mask a rectangle given as (x1, y1, x2, y2)
+        """
+        (x1, y1, x2, y2) = self._clip(box)
+        if x2 > x1 and y2 > y1:
+            self.mask[y1:y2, x1:x2] = True
+            self._integral = None
+            self._empty = False
+
+    def add_image(self, imagename):
+        """
+        Mask every non-black pixel of the given mask image
+        """
+        img = Image.open(imagename).convert("L")
+        w = min(img.width, self.width)
+        h = min(img.height, self.height)
+        pixels = np.asarray(img)[:h, :w]
+        self.mask[:h, :w] |= pixels > 0
+        img.close()
+        self._integral = None
+        self._empty = self._empty and not self.mask.any()
+
+    def is_empty(self):
+        return self._empty
+
+    def total_area(self):
+        return self.masked_area((0, 0, self.width, self.height))
+
+    def masked_area(self, box):
+        """
+        Number of masked pixels inside the box
+        """
+        (x1, y1, x2, y2) = self._clip(box)
+        if x2 <= x1 or y2 <= y1 or self._empty:
+            return 0
+        if self._integral is None:
+            # int32 holds the count of any page below 2^31 pixels
+            dtype = np.int32 if self.width * self.height < 2 ** 31 else np.int64
+            self._integral = np.zeros((self.height + 1, self.width + 1), dtype = dtype)
+            np.cumsum(self.mask, axis = 0, dtype = dtype, out = self._integral[1:, 1:])
+            np.cumsum(self._integral[1:, 1:], axis = 1, dtype = dtype, out = self._integral[1:, 1:])
+        ii = self._integral
+        return int(ii[y2, x2] - ii[y1, x2] - ii[y2, x1] + ii[y1, x1])
+
+    def intersects(self, box):
+        return self.masked_area(box) > 0
+
+    def covers(self, box):
+        """
+        True if every pixel of the box (inside the image) is masked
+        """
+        (x1, y1, x2, y2) = self._clip(box)
+        area = (x2 - x1) * (y2 - y1)
+        return area > 0 and self.masked_area(box) == area
+
+    def as_image(self):
+        return Image.fromarray(self.mask.astype(np.uint8) * 255, "L")
+
+    def _clip(self, box):
+        (x1, y1, x2, y2) = [int(v) for v in box]
+        return (
+            max(0, min(x1, self.width)),    max(0, min(y1, self.height)),
+            max(0, min(x2, self.width)),    max(0, min(y2, self.height))
+        )
+
+
+
+class ElementRegions:
+    """
+    Bounding boxes of visible DOM elements, deduplicated and ordered
+    innermost first, so a box is always visited before any box containing it.
+    """
+
+    def __init__(self, elements, size):
+        width, height = size
+        unique = {}
+        for element in elements:
+            (x1, y1, x2, y2) = element[:4]
+            name = element[4] if len(element) > 4 else "element"
+            box = (
+                max(0, min(int(x1), width)),    max(0, min(int(y1), height)),
+                max(0, min(int(x2), width)),    max(0, min(int(y2), height))
+            )
+            if box[2] - box[0] < 1 or box[3] - box[1] < 1:
+                continue
+            # identical boxes (wrappers): keep the deepest, i.e. last in document order
+            unique[box] = name
+
+        self.boxes = sorted(unique.keys(), key = lambda b: (b[2] - b[0]) * (b[3] - b[1]))
+        self.names = [unique[b] for b in self.boxes]
+        self._array = np.array(self.boxes, dtype = np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def ancestors(self, index):
+        """
+        Boolean array of boxes which contain the box at index
+        """
+        (x1, y1, x2, y2) = self.boxes[index]
+        a = self._array
+        contains = (a[:, 0] <= x1) & (a[:, 1] <= y1) & (a[:, 2] >= x2) & (a[:, 3] >= y2)
+        contains[index] = False
+        return contains
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as f:
+            return [tuple(box) for box in json.load(f).get("elements", [])]
+
+    @staticmethod
+    def save(filename, elements):
+        with open(filename, "w") as f:
+            json.dump({"elements": [list(box) for box in elements]}, f)
+
+
+
+class BandAligner:
+    """
+    Estimates offsets between two equally sized images band by band,
+    using FFT cross-correlation of row (and column) intensity profiles.
+    """
+
+    def __init__(self, ref_image, com_image, band_height = 200, max_shift = 50):
+        self.ref = np.asarray(ref_image.convert("L"))
+        self.com = np.asarray(com_image.convert("L"))
+        self.band_height = band_height
+        self.max_shift = max_shift
+
+    def offsets(self, horizontal = False):
+        """
+        List of (y1, y2, dx, dy): rows y1 - y2 of the reference image
+        are found at an offset of dx, dy in the comparable image
+        """
+        height = self.ref.shape[0]
+        m = self.max_shift
+        ref_rows = self.ref.mean(1)
+        com_rows = np.pad(self.com.mean(1), m, mode = "edge")
+        result = []
+        dx, dy = 0, 0
+
+        for y1 in range(0, height, self.band_height):
+            y2 = min(y1 + self.band_height, height)
+            # a flat band keeps the offset of the previous band
+            dy = self.best_shift(ref_rows[y1:y2], com_rows[y1:y2 + 2 * m], dy)
+            if horizontal:
+                c1 = max(0, min(y1 + dy, height - 1))
+                c2 = max(c1 + 1, min(y2 + dy, height))
+                ref_cols = self.ref[y1:y2].mean(0)
+                com_cols = np.pad(self.com[c1:c2].mean(0), m, mode = "edge")
+                dx = self.best_shift(ref_cols, com_cols, dx)
+            result.append((y1, y2, dx, dy))
+
+        return result
+
+    def best_shift(self, ref_profile, com_profile, fallback = 0):
+        """
+        Shift (-max_shift .. max_shift) of ref_profile inside the padded
+        com_profile with the highest normalized correlation of gradients
+        """
+        m = self.max_shift
+        r = np.diff(ref_profile)
+        c = np.diff(com_profile)
+        if len(r) == 0 or np.abs(r).max() < 1:
+            return fallback
+
+        n = len(r)
+        size = 1 << int(len(c) + n).bit_length()
+        corr = np.fft.irfft(np.fft.rfft(c, size) * np.conj(np.fft.rfft(r, size)), size)[:2 * m + 1]
+        # energy of each com window, so bright windows are not preferred
+        energy = np.concatenate(([0], np.cumsum(c * c)))
+        window = energy[n:n + 2 * m + 1] - energy[:2 * m + 1]
+        score = corr / np.sqrt(window + 1e-9)
+
+        best = int(np.argmax(score))
+        if score[fallback + m] >= 0.99 * score[best]:
+            return fallback
+        return best - m
+
+
+
 class ImageComparator:
 
+    hash_functions = {
+        'ahash': 'average_hash',
+        'phash': 'phash',
+        'dhash': 'dhash',
+        'whash': 'whash'
+    }
+
     def __init__(self, image1: Image.Image, image2: Image.Image):
         self.image1 = image1
         self.image2 = image2
 
+    @staticmethod
+    def image_hash(image: Image.Image, algorithm = "ahash"):
+        """
+        Perceptual hash of one image, to be cached and compared later
+        """
+        return getattr(imagehash, ImageComparator.hash_functions[algorithm])(image)
+
     def is_similar(self, algorithm = "ahash"):
         switcher = {
             'ahash': self.is_similar_a_hash,
@@ -216,10 +597,23 @@ class BrowserScreenshot:
     width = 1280
     height = 0
     ext = '.png'
+    browser = None              # browser the shot is taken with
+    export_elements = False
+    in_memory = False           # hand the image over without a file
+    persistent = False          # shot taken in-process, not by a command
+    save_screenshot = True      # save in-memory image to disk as well
 
     def __init__(self, name):
         self.name = name
         self.imagename = name + self.ext
+        # CSS selectors to be resolved to boxes during capture
+        self.ignore_selectors = []
+        # (x1, y1, x2, y2) boxes of the resolved selectors
+        self.ignore_boxes = []
+        # (x1, y1, x2, y2, name) boxes of visible DOM elements
+        self.element_boxes = []
+        # decoded image, only set in memory mode
+        self.image = None
 
     def size(self):
         return (self.width, self.height)
@@ -231,14 +625,36 @@ class BrowserScreenshot:
         Used to remove scrollbar pixels.
         """
         img = Image.open(self.imagename)
-        w, h = img.size
-        c = Coordinates(0, 0, w, h)
-        newimg = img.crop(c.add_to_right(-pixels))
+        newimg = self.crop_right(img, pixels)
         img.close()
         os.remove(self.imagename)
         newimg.save(self.imagename)
+
+    def crop_right(self, img, pixels:int):
+        """
+        Subtract given pixels from right side of an image in memory
+        """
+        w, h = img.size
+        c = Coordinates(0, 0, w, h)
+        newimg = img.crop(c.add_to_right(-pixels))
         self.height = newimg.size[1]
         print("Info: \tRemoved {0} pixels from the right side of image {1}".format(pixels, self.imagename))
+        return newimg
+
+    def abort(self):
+        """
+        Stop a shot which is still running in-process
+        """
+        pass
+
+    def keep_image(self, img):
+        """
+        Keep a decoded image in memory, saving it only if asked to
+        """
+        self.image = img
+        self.height = img.size[1]
+        if self.save_screenshot:
+            img.save(self.imagename)
 
 
     def extend_image(self, factor: int):
@@ -275,32 +691,93 @@ class BrowserScreenshot:
 
 
 class FirefoxScreenshot(BrowserScreenshot):
-    def __init__(self):
-        super().__init__('firefox')
 
-    def take_shot(self, url, height = 0):
+    executable = "firefox"
+    browser = "firefox"
+
+    def __init__(self, name = 'firefox'):
+        super().__init__(name)
+
+    def command(self, url, workdir = None):
         """
-        Take screenshot using Firefox
+        Command line to take screenshot using Firefox.
+        With a workdir, a separate profile is used there so that
+        several Firefox instances can run at the same time.
         """
-        print("Info: \tGetting screenshot from Firefox browser")
         # add 10 px for scrollbar
         window_size = "--window-size={0}".format(self.width + 10)
-        subprocess.call(["firefox",
-                        "-screenshot",
+        profile = [] if workdir is None else ["-no-remote", "-profile", workdir]
+        return [self.executable] + profile + ["-screenshot",
                         window_size,
-                        url])
-        # rename the output file
-        os.rename("screenshot.png", self.imagename)
-        # remove the scrolbar 
-        self.remove_pixels_right(10)
+                        url]
+
+    def take_shot(self, url, height = 0):
+        """
+        Take screenshot using Firefox
+        """
+        print("Info: \tGetting screenshot from Firefox browser")
+        subprocess.call(self.command(url))
+        self.finish_shot()
+
+    def finish_shot(self, workdir = ".", data = None):
+        """
+        Move the screenshot written to workdir and remove the scrollbar
+        """
+        shotname = os.path.join(workdir, "screenshot.png")
+        if self.in_memory:
+            # firefox can only write files, decode it once and crop in memory
+            img = Image.open(shotname)
+            img.load()
+            os.remove(shotname)
+            self.keep_image(self.crop_right(img, 10))
+        else:
+            # moved, the workdir may be on another filesystem
+            shutil.move(shotname, self.imagename)
+            # remove the scrolbar 
+            self.remove_pixels_right(10)
         print("Info: \tSaved screenshot from Firefox with name {0}".format(self.imagename))
         print("Info: \tInitial image size: {0} x {1}".format(self.width, self.height))
 
 
 
+class MarionetteFirefoxScreenshot(FirefoxScreenshot):
+    """
+    Firefox screenshot taken by one persistent headless Firefox,
+    driven through Marionette, instead of a cold start per URL
+    """
+
+    persistent = True
+
+    def take_shot(self, url, height = 0):
+        """
+        Take screenshot using the shared Firefox session
+        """
+        print("Info: \tGetting screenshot from Firefox browser (marionette)")
+        img = FirefoxSession.shared().screenshot(url, self.width)
+        # scrollbars are hidden, only crop if the page is still wider
+        if img.width > self.width:
+            img = self.crop_right(img, img.width - self.width)
+        if self.in_memory:
+            self.keep_image(img)
+        else:
+            img.save(self.imagename)
+            self.height = img.size[1]
+        print("Info: \tSaved screenshot from Firefox with name {0}".format(self.imagename))
+        print("Info: \tInitial image size: {0} x {1}".format(self.width, self.height))
+
+    def abort(self):
+        # kills Firefox, the next shot starts a new session
+        FirefoxSession.reset_shared()
+
+
+
 class ChromeScreenshot(BrowserScreenshot):
-    def __init__(self):
-        super().__init__('chrome')
+
+    executable = "node"
+    browser = "chrome"
+
+    def __init__(self, name = 'chrome'):
+        super().__init__(name)
 
     def take_shot_commandline(self, url, height):
         """
@@ -320,19 +797,74 @@ class ChromeScreenshot(BrowserScreenshot):
         print("Info: \tSaved screenshot from Chrome with name {0}".format(self.imagename))
         print("Info: \tInitial image size: {0} x {1}".format(self.width, self.height))
 
+    def command(self, url, workdir = None):
+        """
+        Command line to take screenshot using Puppeteer
+        """
+        # puppeteer.js lies next to this module and resolves its node_modules
+        # there, whatever the working directory (e.g. of a shard job) is
+        return [self.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "puppeteer.js"),
+                url,
+                str(self.width),
+                "0"] \
+                + ["--ignore=" + sel for sel in self.ignore_selectors] \
+                + (["--elements"] if self.export_elements else []) \
+                + (["--stdout"] if self.in_memory else [])
+
     def take_shot(self, url):
         """
         Take screenshot using Puppeteer
         """
         print("Info: \tGetting screenshot from Chrome browser")
-        # set width to class
-        subprocess.call(["node",
-                        "puppeteer.js",
-                        url,
-                        str(self.width)])
-        os.rename("screenshot.png", self.imagename)
-        self.height = Image.open(self.imagename).size[1]
+        if self.in_memory:
+            data = subprocess.run(self.command(url), stdout = subprocess.PIPE).stdout
+            self.finish_shot(data = data)
+        else:
+            subprocess.call(self.command(url))
+            self.finish_shot()
+
+    def finish_shot(self, workdir = ".", data = None):
+        """
+        Move the screenshot and exported boxes written to workdir,
+        or decode them from the data puppeteer.js wrote to stdout
+        """
+        if data is not None:
+            # JSON header line followed by the PNG bytes
+            header, _, png = data.partition(b"\n")
+            meta = json.loads(header.decode("utf-8"))
+            img = Image.open(io.BytesIO(png[:meta["length"]]))
+            img.load()
+            self.set_regions(meta.get("regions", {}))
+            self.keep_image(img)
+        else:
+            # moved, the workdir may be on another filesystem
+            shutil.move(os.path.join(workdir, "screenshot.png"), self.imagename)
+            self.read_regions(os.path.join(workdir, "screenshot.json"))
+            self.height = Image.open(self.imagename).size[1]
         print("Info: \tSaved screenshot from Chrome with name {0}".format(self.imagename))
-        print("Info: \tInitial image size: {0} x {1}".format(self.width, self.height))        
+        print("Info: \tInitial image size: {0} x {1}".format(self.width, self.height))
+
+    def read_regions(self, filename = "screenshot.json"):
+        """
+        Read element boxes exported by puppeteer.js next to the screenshot
+        """
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            regions = json.load(f)
+        os.remove(filename)
+        self.set_regions(regions)
+
+    def set_regions(self, regions):
+        self.ignore_boxes = [tuple(box) for box in regions.get("ignore", [])]
+        if len(self.ignore_boxes) > 0:
+            print("Info: \tResolved {0} ignored element(s) in {1}".format(len(self.ignore_boxes), self.imagename))
+
+        self.element_boxes = [tuple(box) for box in regions.get("elements", [])]
+        if len(self.element_boxes) > 0 and self.save_screenshot:
+            # keep boxes next to the screenshot for later manual compare
+            ElementRegions.save(self.name + ".json", self.element_boxes)
+            print("Info: \tExported {0} element boxes to {1}.json".format(len(self.element_boxes), self.name))
 
 
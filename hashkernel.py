@@ -0,0 +1,148 @@
+import math
+from functools import lru_cache
+from eyecatchingutil import LazyModule
+
+np = LazyModule("numpy")
+
+# fixed point precision of the resampling coefficients, as in Pillow
+PRECISION_BITS = 32 - 8 - 2
+# lobes of the Lanczos window, support of the filter
+LANCZOS_SUPPORT = 3.0
+
+
+def lanczos(x):
+    """
+    Lanczos window of 3 lobes, the ANTIALIAS filter imagehash resizes with
+    """
+    if not -LANCZOS_SUPPORT <= x < LANCZOS_SUPPORT:
+        return 0.0
+    return sinc(x) * sinc(x / LANCZOS_SUPPORT)
+
+
+def sinc(x):
+    if x == 0.0:
+        return 1.0
+    x = x * math.pi
+    return math.sin(x) / x
+
+
+@lru_cache(maxsize = None)
+def resample_coefficients(in_size, out_size):
+    """
+    (out_size, in_size) int64 matrix of fixed point coefficients which
+    resamples a row of in_size pixels to out_size pixels the way
+    Pillow's Image.resize with ANTIALIAS does
+    """
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = LANCZOS_SUPPORT * filter_scale
+    coefficients = np.zeros((out_size, in_size), dtype = np.int64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        weights = [lanczos((x - center + 0.5) / filter_scale) for x in range(xmin, xmax)]
+        total = sum(weights)
+        for (x, w) in zip(range(xmin, xmax), weights):
+            if total != 0.0:
+                w /= total
+            # rounded away from zero
+            coefficients[xx, x] = int(w * (1 << PRECISION_BITS) + (0.5 if w >= 0 else -0.5))
+    return coefficients
+
+
+def clip8(values):
+    """
+    Fixed point sums to uint8 pixels, rounded
+    """
+    values = values + (1 << (PRECISION_BITS - 1))
+    return np.clip(values >> PRECISION_BITS, 0, 255).astype(np.uint8)
+
+
+def downsample(pixels, edge, size):
+    """
+    Every edge x edge tile of a (height, width) uint8 array resampled
+    to size = (width, height), as (rows, columns, height, width) uint8.
+    Rows are resampled first, then columns, each rounded to uint8.
+    """
+    (out_width, out_height) = size
+    height, width = pixels.shape
+    kx = resample_coefficients(edge, out_width)
+    ky = resample_coefficients(edge, out_height)
+    # (height, columns, edge) @ (edge, out_width), on the strided rows of the tiles
+    horizontal = clip8(pixels.reshape(height, width // edge, edge).astype(np.int64) @ kx.T)
+    tiles = horizontal.reshape(height // edge, edge, width // edge, out_width).swapaxes(1, 2)
+    # (out_height, edge) @ (rows, columns, edge, out_width)
+    return clip8(ky @ tiles.astype(np.int64))
+
+
+def average_hash_bits(pixels, edge, hash_size = 8):
+    """
+    (rows, columns, hash_size, hash_size) bits of imagehash.average_hash
+    of every tile
+    """
+    small = downsample(pixels, edge, (hash_size, hash_size))
+    total = small.sum(axis = (2, 3), dtype = np.int64, keepdims = True)
+    # pixel > mean, without rounding
+    return small.astype(np.int64) * (hash_size * hash_size) > total
+
+
+def difference_hash_bits(pixels, edge, hash_size = 8):
+    """
+    (rows, columns, hash_size, hash_size) bits of imagehash.dhash of every tile
+    """
+    small = downsample(pixels, edge, (hash_size + 1, hash_size))
+    return small[..., 1:] > small[..., :-1]
+
+
+# algorithm: function computing the tile hash bits
+HASH_BITS = {
+    "ahash": average_hash_bits,
+    "dhash": difference_hash_bits,
+}
+
+
+def pack_bits(bits):
+    """
+    (..., n, n) bits to (..., words) uint64, first bit most significant,
+    as np.packbits of the flattened hash
+    """
+    shape = bits.shape[:-2]
+    flat = bits.reshape(shape + (-1,))
+    count = flat.shape[-1]
+    words = -(-count // 64)
+    if count != words * 64:
+        padded = np.zeros(shape + (words * 64,), dtype = bool)
+        padded[..., :count] = flat
+        flat = padded
+    packed = np.packbits(flat, axis = -1)
+    return packed.view(">u8").astype(np.uint64)
+
+
+def tile_hashes(pixels, edge, algorithm = "ahash", hash_size = 8):
+    """
+    (rows, columns, words) packed hashes of all tiles of a (height, width)
+    uint8 luminance array, height and width multiples of edge
+    """
+    return pack_bits(HASH_BITS[algorithm](np.ascontiguousarray(pixels), edge, hash_size))
+
+
+@lru_cache(maxsize = 1)
+def popcount_table():
+    """
+    Number of set bits of every 16 bit value
+    """
+    values = np.arange(1 << 16, dtype = np.uint32)
+    counts = np.zeros(1 << 16, dtype = np.uint8)
+    for bit in range(16):
+        counts += ((values >> bit) & 1).astype(np.uint8)
+    return counts
+
+
+def hamming(hashes1, hashes2):
+    """
+    Hamming distances of (..., words) packed hashes, summed over the words
+    """
+    diff = np.bitwise_xor(hashes1, hashes2).astype(np.uint64)
+    chunks = diff.view(np.uint16).reshape(diff.shape[:-1] + (-1,))
+    return popcount_table()[chunks].sum(axis = -1, dtype = np.int64)
@@ -0,0 +1,304 @@
+import contextlib
+import json
+import sqlite3
+import time
+from eyecatchingutil import LazyModule
+from hashkernel import hamming
+
+np = LazyModule("numpy")
+
+
+class ResultHistory:
+    """
+    Results of past comparisons in a local SQLite file: parameters,
+    summary, timings, dissimilar regions and, for linear comparisons,
+    the tile scores and packed 64 bit tile hashes. Runs are looked up
+    by URL, browser pair and width, newest first.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id              INTEGER PRIMARY KEY,
+            created         REAL NOT NULL,
+            url             TEXT,
+            ref_browser     TEXT,
+            com_browser     TEXT,
+            width           INTEGER,
+            method          TEXT,
+            algorithm       TEXT,
+            params          TEXT,
+            summary         TEXT,
+            timings         TEXT,
+            dissimilar_area REAL,
+            regions         INTEGER,
+            execution_time  REAL,
+            grid_rows       INTEGER,
+            grid_cols       INTEGER,
+            scores          BLOB,
+            hashed          BLOB,
+            ref_hashes      BLOB,
+            com_hashes      BLOB
+        );
+        CREATE TABLE IF NOT EXISTS regions (
+            run_id          INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+            x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER,
+            area            INTEGER,
+            tiles           INTEGER,
+            max_distance    INTEGER,
+            mean_distance   REAL
+        );
+        CREATE INDEX IF NOT EXISTS runs_page ON runs (url, ref_browser, com_browser, width, created);
+        CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+        CREATE INDEX IF NOT EXISTS regions_run ON regions (run_id);
+    """
+
+    timeout = 30    # seconds to wait for a concurrent writer
+
+    def __init__(self, filename):
+        self.filename = filename
+        with self.connect() as conn:
+            conn.executescript(self.schema)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Connection for one transaction. A connection per call keeps
+        the history usable from the comparison threads of batch runs.
+        """
+        conn = sqlite3.connect(self.filename, timeout = self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, controller):
+        """
+        Record the last comparison of a controller, returns the run id
+        """
+        summary = controller.summary
+        params = {
+            "block_size": controller.block_size,
+            "threshold": controller.threshold,
+            "grayscale": controller.grayscale,
+            "align": controller.align,
+            "ignore_boxes": [list(box) for box in controller.ignore_boxes],
+            "ignore_selectors": list(controller.ignore_selectors),
+            "ignore_mask": controller.ignore_mask,
+            "captures": controller.captures,
+        }
+        timings = {"compare": summary["execution_time"]}
+        if controller.capture_time is not None:
+            timings["capture"] = controller.capture_time
+
+        (ref_browser, com_browser) = (
+            shot.browser if shot is not None and shot.browser is not None else meta.name
+            for (shot, meta) in ((controller.ref_screenshot, controller.ref), (controller.com_screenshot, controller.com))
+        )
+        grid = self.pack_grid(controller)
+        # viewport width of captured pages, image width of compared files
+        width = controller.width if controller.url is not None else summary["width"]
+
+        with self.connect() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO runs (created, url, ref_browser, com_browser, width, method, algorithm,
+                    params, summary, timings, dissimilar_area, regions, execution_time,
+                    grid_rows, grid_cols, scores, hashed, ref_hashes, com_hashes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    time.time(), controller.url, ref_browser, com_browser, width,
+                    summary["method"], summary["algorithm"],
+                    json.dumps(params), json.dumps(summary), json.dumps(timings),
+                    summary["dissimilar_area"], summary["regions"], summary["execution_time"]
+                ) + grid
+            )
+            run_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id,) + region.as_tuple() + (region.area, region.tiles, region.max_distance, region.mean_distance)
+                    for region in controller.regions
+                ]
+            )
+        print("Done: \tRun {0} recorded in {1}".format(run_id, self.filename))
+        return run_id
+
+    def pack_grid(self, controller):
+        """
+        (rows, columns, scores, hashed, ref_hashes, com_hashes) of a
+        linear comparison as blobs, all None for other methods
+        """
+        scores = controller.tile_scores
+        if scores is None:
+            return (None,) * 6
+        (rows, cols) = scores.shape
+        metric = controller.metric
+        hashes = getattr(metric, "hashes", None)
+        if hashes is None:
+            return (rows, cols, self.pack_scores(scores), None, None, None)
+        return (
+            rows, cols, self.pack_scores(scores),
+            np.packbits(metric.hashed).tobytes(),
+            hashes[0].astype(">u8").tobytes(),
+            hashes[1].astype(">u8").tobytes(),
+        )
+
+    def pack_scores(self, scores):
+        # scores are 0 - 64, a byte per tile keeps the fraction in 1/4 steps
+        return np.round(np.clip(scores, 0, 64) * 3.98).astype(np.uint8).tobytes()
+
+    def unpack_grid(self, run):
+        """
+        (scores, hashed, ref_hashes, com_hashes) arrays of a run,
+        None where the run has no such matrix
+        """
+        if run["grid_rows"] is None:
+            return (None,) * 4
+        shape = (run["grid_rows"], run["grid_cols"])
+        scores = np.frombuffer(run["scores"], dtype = np.uint8).reshape(shape) / 3.98
+        if run["ref_hashes"] is None:
+            return (scores, None, None, None)
+        count = shape[0] * shape[1]
+        hashed = np.unpackbits(np.frombuffer(run["hashed"], dtype = np.uint8))[:count].reshape(shape).astype(bool)
+        return (
+            scores,
+            hashed,
+            np.frombuffer(run["ref_hashes"], dtype = ">u8").reshape(shape),
+            np.frombuffer(run["com_hashes"], dtype = ">u8").reshape(shape),
+        )
+
+    def runs(self, url = None, ref_browser = None, com_browser = None, width = None, limit = 20):
+        """
+        Matching runs, newest first
+        """
+        conditions = []
+        values = []
+        for (column, value) in (("url", url), ("ref_browser", ref_browser), ("com_browser", com_browser), ("width", width)):
+            if value is not None:
+                conditions.append("{0} = ?".format(column))
+                values.append(value)
+        where = "WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT * FROM runs {0} ORDER BY created DESC, id DESC LIMIT ?".format(where),
+                values + [limit]
+            ).fetchall()
+
+    def last_good(self, run, max_area = 0.0):
+        """
+        Newest earlier run of the same page, browsers, width, method and
+        algorithm with at most max_area % dissimilar area
+        """
+        with self.connect() as conn:
+            return conn.execute(
+                """
+                SELECT * FROM runs
+                WHERE url IS ? AND ref_browser IS ? AND com_browser IS ? AND width IS ?
+                    AND method = ? AND algorithm = ? AND created < ? AND dissimilar_area <= ?
+                ORDER BY created DESC, id DESC LIMIT 1
+                """,
+                (run["url"], run["ref_browser"], run["com_browser"], run["width"],
+                 run["method"], run["algorithm"], run["created"], max_area)
+            ).fetchone()
+
+    def first_after(self, run, good):
+        """
+        First run of the same page after the good run, the run the
+        page started to diverge with
+        """
+        with self.connect() as conn:
+            return conn.execute(
+                """
+                SELECT * FROM runs
+                WHERE url IS ? AND ref_browser IS ? AND com_browser IS ? AND width IS ?
+                    AND method = ? AND algorithm = ? AND created > ? AND created <= ?
+                ORDER BY created, id LIMIT 1
+                """,
+                (run["url"], run["ref_browser"], run["com_browser"], run["width"],
+                 run["method"], run["algorithm"], good["created"], run["created"])
+            ).fetchone()
+
+    def regions(self, run_id):
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT * FROM regions WHERE run_id = ? ORDER BY area DESC", (run_id,)
+            ).fetchall()
+
+    def tile_changes(self, run, good, threshold):
+        """
+        Tiles of a run which differ from the good run, from the stored
+        matrices: (newly dissimilar tiles, changed reference tiles,
+        changed comparable tiles), None where the runs cannot be compared
+        """
+        (scores, hashed, ref_hashes, com_hashes) = self.unpack_grid(run)
+        (good_scores, good_hashed, good_ref, good_com) = self.unpack_grid(good)
+        if scores is None or good_scores is None or scores.shape != good_scores.shape:
+            return (None, None, None)
+
+        new = (scores >= threshold) & (good_scores < threshold)
+        if ref_hashes is None or good_ref is None:
+            return (new, None, None)
+        both = hashed & good_hashed
+        return (
+            new,
+            (self.distances(ref_hashes, good_ref) >= threshold) & both,
+            (self.distances(com_hashes, good_com) >= threshold) & both,
+        )
+
+    def distances(self, hashes1, hashes2):
+        """
+        Hamming distances of two matrices of packed 64 bit hashes
+        """
+        return hamming(hashes1.astype(np.uint64)[..., None], hashes2.astype(np.uint64)[..., None])
+
+    def print_trend(self, runs):
+        print("Done: \tRuns: {0}".format(len(runs)))
+        for run in runs:
+            print("Done: \t{0:>5} {1}  {2:<9} {3:<5} {4:>5}px  {5} vs {6}  {7:6.2f}% dissimilar, {8} regions, {9:.2f}s\t{10}".format(
+                run["id"],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["created"])),
+                run["method"], run["algorithm"], run["width"] or 0,
+                run["ref_browser"], run["com_browser"],
+                run["dissimilar_area"], run["regions"], run["execution_time"],
+                run["url"] or ""
+            ))
+
+    def print_against_last_good(self, run, max_area = 0.0):
+        """
+        Compare a run with the last good run of its page, using the
+        stored results only
+        """
+        good = self.last_good(run, max_area)
+        if good is None:
+            print("Info: \tNo earlier run of run {0} with at most {1:.2f}% dissimilar area".format(run["id"], max_area))
+            return
+        if run["dissimilar_area"] <= max_area:
+            print("Done: \tRun {0} is good, last earlier good run is {1}".format(run["id"], good["id"]))
+            return
+
+        first = self.first_after(run, good)
+        print("Done: \tLast good run: {0} at {1}, {2:.2f}% dissimilar".format(
+            good["id"], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(good["created"])), good["dissimilar_area"]
+        ))
+        print("Done: \tDiverging since run {0} at {1}".format(
+            first["id"], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(first["created"]))
+        ))
+        print("Done: \tDissimilar area: {0:.2f}% -> {1:.2f}%, regions: {2} -> {3}".format(
+            good["dissimilar_area"], run["dissimilar_area"], good["regions"], run["regions"]
+        ))
+
+        threshold = json.loads(run["params"])["threshold"]
+        (new, ref_changed, com_changed) = self.tile_changes(run, good, threshold)
+        if new is not None:
+            print("Done: \tBlocks dissimilar now but not in the good run: {0}".format(int(new.sum())))
+        if ref_changed is not None:
+            print("Done: \tBlocks changed since the good run: {0} in {1}, {2} in {3}".format(
+                int(ref_changed.sum()), run["ref_browser"], int(com_changed.sum()), run["com_browser"]
+            ))
+        for region in self.regions(run["id"])[:5]:
+            print("Found: \tRegion {0}, area {1} px, max distance {2}".format(
+                (region["x1"], region["y1"], region["x2"], region["y2"]), region["area"], region["max_distance"]
+            ))
@@ -0,0 +1,217 @@
+import atexit
+import base64
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from PIL import Image
+
+
+class MarionetteError(RuntimeError):
+    pass
+
+
+class MarionetteClient:
+    """
+    Minimal client for the Marionette protocol of Firefox.
+    Messages are JSON, prefixed with their length: "<length>:<json>"
+    """
+
+    def __init__(self, host, port, timeout = 60):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.msgid = 0
+        # the server greets with its protocol version
+        self.hello = self._read()
+
+    def send(self, name, params = None):
+        self.msgid += 1
+        data = json.dumps([0, self.msgid, name, params or {}]).encode("utf-8")
+        self.sock.sendall("{0}:".format(len(data)).encode("ascii") + data)
+
+        while True:
+            msg = self._read()
+            # [1, id, error, result]
+            if msg[0] == 1 and msg[1] == self.msgid:
+                break
+        if msg[2]:
+            raise MarionetteError("{0}: {1}".format(name, msg[2].get("message", msg[2])))
+        return msg[3]
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _read(self):
+        length = b""
+        while True:
+            char = self._recv(1)
+            if char == b":":
+                break
+            length += char
+        return json.loads(self._recv(int(length)).decode("utf-8"))
+
+    def _recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise MarionetteError("connection closed by Firefox")
+            data += chunk
+        return data
+
+
+class FirefoxSession:
+    """
+    One headless Firefox instance, driven through Marionette,
+    which takes full-page screenshots of many URLs and widths.
+    """
+
+    executable = "firefox"
+    startup_timeout = 30        # seconds to wait for marionette
+    timeout = 60                # seconds per command
+    height = 800                # window height, px
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.proc = None
+        self.client = None
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.profile = tempfile.mkdtemp(prefix = "eyecatching_ff_")
+        port = self._free_port()
+        prefs = {
+            "marionette.port": port,
+            "browser.shell.checkDefaultBrowser": False,
+            "browser.startup.homepage_override.mstone": "ignore",
+            "datareporting.policy.dataSubmissionEnabled": False,
+            "toolkit.telemetry.reportingpolicy.firstRun": False,
+            "app.update.disabledForTesting": True,
+        }
+        with open(os.path.join(self.profile, "user.js"), "w") as f:
+            for key, value in prefs.items():
+                f.write("user_pref({0}, {1});\n".format(json.dumps(key), json.dumps(value)))
+
+        self.proc = subprocess.Popen([self.executable,
+                        "--marionette",
+                        "--headless",
+                        "-no-remote",
+                        "-profile",
+                        self.profile],
+                        stdout = subprocess.DEVNULL,
+                        stderr = subprocess.DEVNULL)
+
+        deadline = time.time() + self.startup_timeout
+        while True:
+            try:
+                self.client = MarionetteClient("127.0.0.1", port, self.timeout)
+                break
+            except (OSError, MarionetteError):
+                if time.time() > deadline or self.proc.poll() is not None:
+                    self.close()
+                    raise MarionetteError("Firefox did not start marionette on port {0}".format(port))
+                time.sleep(0.2)
+
+        self.client.send("WebDriver:NewSession", {
+            "capabilities": {"alwaysMatch": {"acceptInsecureCerts": True}}
+        })
+        print("Info: \tStarted headless Firefox (marionette port {0})".format(port))
+
+    def screenshot(self, url, width):
+        """
+        Full-page screenshot of url at the given viewport width,
+        with scrollbars hidden
+        """
+        with self.lock:
+            if self.client is None:
+                self.start()
+            self._set_viewport_width(width)
+            self.client.send("WebDriver:Navigate", {"url": url})
+            # hide scrollbars, so the viewport is the full window width
+            self.client.send("WebDriver:ExecuteScript", {
+                "script": "document.documentElement.style.scrollbarWidth = 'none';",
+                "args": []
+            })
+            result = self.client.send("WebDriver:TakeScreenshot", {
+                "full": True,
+                "hash": False,
+                "scroll": False
+            })
+
+        img = Image.open(io.BytesIO(base64.b64decode(result["value"])))
+        img.load()
+        return img
+
+    def _set_viewport_width(self, width):
+        self.client.send("WebDriver:SetWindowRect", {"width": width, "height": self.height})
+        inner = self.client.send("WebDriver:ExecuteScript", {
+            "script": "return window.innerWidth;",
+            "args": []
+        })["value"]
+        # the window may be wider than its viewport
+        if inner != width:
+            self.client.send("WebDriver:SetWindowRect", {
+                "width": width + (width - inner),
+                "height": self.height
+            })
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.send("Marionette:Quit", {"flags": ["eForceQuit"]})
+            except (OSError, MarionetteError):
+                pass
+            self.client.close()
+            self.client = None
+        if self.proc is not None:
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
+        if self.profile is not None:
+            shutil.rmtree(self.profile, ignore_errors = True)
+            self.profile = None
+
+    def _free_port(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    @classmethod
+    def shared(cls):
+        """
+        The Firefox session kept alive for the whole run
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                atexit.register(cls.reset_shared)
+            return cls._shared
+
+    @classmethod
+    def reset_shared(cls):
+        """
+        Close the shared session, e.g. after a timeout
+        """
+        with cls._shared_lock:
+            session = cls._shared
+            cls._shared = None
+        if session is not None:
+            # kill first so that a command waiting on the socket returns
+            if session.proc is not None:
+                session.proc.kill()
+            session.close()
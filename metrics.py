@@ -0,0 +1,407 @@
+from PIL import Image
+from eyecatchingutil import LazyModule
+from eyecatchingutil import ImageComparator
+from hashkernel import HASH_BITS
+from hashkernel import tile_hashes
+from hashkernel import hamming
+
+np = LazyModule("numpy")
+
+# name: Metric class, selectable with --algorithm
+METRICS = {}
+
+
+def register(metric):
+    METRICS[metric.name] = metric
+    return metric
+
+
+def get_metric(name):
+    return METRICS[name]()
+
+
+class Metric:
+    """
+    Scores how dissimilar the tiles of an image pair are. Scores are on
+    the scale of a 64 bit hash distance (0 - 64), so thresholds and
+    marking opacity work the same for every metric.
+    """
+
+    name = None
+    max_score = 64
+    band_height = 512       # rows per band of score_bands, px
+    scores_per_tile = True  # tiles are scored one by one, repeated tiles are worth skipping
+
+    def prepare(self, ref_image, com_image, cache = None, com_cache = None):
+        """
+        Called once per comparison, before any tile is scored.
+        Caches keep per-tile data of the reference and comparable image.
+        """
+        self.ref_image = ref_image
+        self.com_image = com_image
+
+    def score_grid(self, edge, skip = None):
+        """
+        Scores of all edge x edge tiles as a (rows, columns) array.
+        Tiles set in the boolean skip array are not scored.
+        """
+        return np.vstack([scores for (_, scores) in self.score_bands(edge, skip)])
+
+    def score_bands(self, edge, skip = None):
+        """
+        Scores of the tiles band by band, top to bottom, as
+        (first row, (rows, columns) scores) of each band
+        """
+        width, height = self.ref_image.size
+        rows = -(-height // edge)
+        cols = -(-width // edge)
+        step = max(1, self.band_height // edge)
+        for first in range(0, rows, step):
+            scores = np.zeros((min(step, rows - first), cols))
+            for ty in range(first, first + len(scores)):
+                for tx in range(cols):
+                    if skip is not None and skip[ty, tx]:
+                        continue
+                    x = tx * edge
+                    y = ty * edge
+                    scores[ty - first, tx] = self.score_box((x, y, x + edge, y + edge))
+            yield (first, scores)
+
+    def score_box(self, box):
+        """
+        Score of the tile (x1, y1, x2, y2)
+        """
+        raise NotImplementedError
+
+
+class HashMetric(Metric):
+    """
+    Hamming distance of perceptual hashes, computed per tile.
+    Tile hashes are kept in the caches if given. Hashes the hash
+    kernel implements are computed for whole bands at once instead.
+    """
+
+    keep_hashes = False     # keep the packed tile hashes of score_grid
+
+    def prepare(self, ref_image, com_image, cache = None, com_cache = None):
+        super().prepare(ref_image, com_image)
+        self.cache = cache
+        self.com_cache = com_cache
+        self.hashes = None
+
+    @property
+    def scores_per_tile(self):
+        return self.name not in HASH_BITS
+
+    def score_bands(self, edge, skip = None):
+        if self.name in HASH_BITS:
+            yield from self.kernel_bands(edge, skip)
+            return
+        if not self.keep_hashes:
+            yield from super().score_bands(edge, skip)
+            return
+
+        width, height = self.ref_image.size
+        shape = (-(-height // edge), -(-width // edge))
+        # (reference, comparable) 64 bit hashes and the tiles hashed
+        self.hashes = (np.zeros(shape, dtype = np.uint64), np.zeros(shape, dtype = np.uint64))
+        self.hashed = np.zeros(shape, dtype = bool)
+        todo = np.ones(shape, dtype = bool) if skip is None else ~skip
+        step = max(1, self.band_height // edge)
+        for first in range(0, shape[0], step):
+            band = todo[first:first + step]
+            # set per band, a comparison may stop before the last one
+            self.hashed[first:first + step] = band
+            scores = np.zeros(band.shape)
+            for (ty, tx) in np.argwhere(band).tolist():
+                (x, y) = (tx * edge, (first + ty) * edge)
+                box = (x, y, x + edge, y + edge)
+                ref_hash = self.tile_hash(self.ref_image, box, self.cache)
+                com_hash = self.tile_hash(self.com_image, box, self.com_cache)
+                scores[ty, tx] = abs(ref_hash - com_hash)
+                self.hashes[0][first + ty, tx] = self.pack(ref_hash)
+                self.hashes[1][first + ty, tx] = self.pack(com_hash)
+            yield (first, scores)
+
+    def kernel_bands(self, edge, skip = None):
+        """
+        score_bands with the hash kernel, equal to the tile by tile
+        hashes. Only the tiles from the first to the last unmasked row
+        and column of a band are hashed, fully masked bands are not.
+        """
+        width, height = self.ref_image.size
+        shape = (-(-height // edge), -(-width // edge))
+        if self.keep_hashes:
+            self.hashes = (np.zeros(shape, dtype = np.uint64), np.zeros(shape, dtype = np.uint64))
+            self.hashed = np.zeros(shape, dtype = bool)
+        step = max(1, self.band_height // edge)
+        for first in range(0, shape[0], step):
+            last = min(first + step, shape[0])
+            todo = np.ones((last - first, shape[1]), dtype = bool) if skip is None else ~skip[first:last]
+            scores = np.zeros(todo.shape)
+            if todo.any():
+                rows = np.nonzero(todo.any(axis = 1))[0]
+                cols = np.nonzero(todo.any(axis = 0))[0]
+                (r1, r2) = (rows[0], rows[-1] + 1)
+                (c1, c2) = (cols[0], cols[-1] + 1)
+                # cropping beyond the image pads with black, as for single tiles
+                box = (c1 * edge, (first + r1) * edge, c2 * edge, (first + r2) * edge)
+                ref_hashes = tile_hashes(self.luminance(self.ref_image, box), edge, self.name)
+                com_hashes = tile_hashes(self.luminance(self.com_image, box), edge, self.name)
+                scores[r1:r2, c1:c2] = hamming(ref_hashes, com_hashes)
+                scores[~todo] = 0
+                if self.keep_hashes:
+                    self.hashes[0][first + r1:first + r2, c1:c2] = ref_hashes[..., 0]
+                    self.hashes[1][first + r1:first + r2, c1:c2] = com_hashes[..., 0]
+            if self.keep_hashes:
+                self.hashed[first:last] = todo
+            yield (first, scores)
+
+    def luminance(self, image, box):
+        """
+        Luminance of a part of the image as a uint8 array
+        """
+        return np.asarray(image.crop(box).convert("L"))
+
+    def pack(self, image_hash):
+        """
+        64 bit hash as one unsigned integer
+        """
+        return np.packbits(image_hash.hash.ravel()).view(">u8")[0]
+
+    def score_box(self, box):
+        ref_hash = self.tile_hash(self.ref_image, box, self.cache)
+        com_hash = self.tile_hash(self.com_image, box, self.com_cache)
+        return abs(ref_hash - com_hash)
+
+    def tile_hash(self, image, box, cache):
+        if cache is None:
+            return ImageComparator.image_hash(image.crop(box), self.name)
+
+        # a padded image has different edge tiles
+        key = (self.name, image.size, box)
+        tile_hash = cache.get(key)
+        if tile_hash is None:
+            tile_hash = ImageComparator.image_hash(image.crop(box), self.name)
+            cache[key] = tile_hash
+        return tile_hash
+
+
+@register
+class AverageHash(HashMetric):
+    name = "ahash"
+
+
+@register
+class PerceptualHash(HashMetric):
+    name = "phash"
+
+
+@register
+class DifferenceHash(HashMetric):
+    name = "dhash"
+
+
+@register
+class WaveletHash(HashMetric):
+    name = "whash"
+
+
+class ArrayMetric(Metric):
+    """
+    Metric computed with NumPy over whole bands of the image at once,
+    from per-tile sums of per-pixel values
+    """
+
+    mode = "RGB"
+    scores_per_tile = False
+
+    def prepare(self, ref_image, com_image, cache = None, com_cache = None):
+        super().prepare(ref_image, com_image)
+        # luminance images are used as they are
+        mode = "L" if ref_image.mode == com_image.mode == "L" else self.mode
+        self.ref = np.asarray(ref_image.convert(mode)).reshape(ref_image.height, ref_image.width, -1)
+        self.com = np.asarray(com_image.convert(mode)).reshape(com_image.height, com_image.width, -1)
+
+    def scores(self, total, count):
+        """
+        Scores from total(fn), the tile sums of fn(ref, com) per pixel,
+        and count, the number of pixels per tile
+        """
+        raise NotImplementedError
+
+    def score_bands(self, edge, skip = None):
+        # bands bound the temporary memory
+        height = self.ref.shape[0]
+        rows = edge * max(1, self.band_height // edge)
+        for y in range(0, height, rows):
+            r = self.ref[y:y + rows]
+            c = self.com[y:y + rows]
+            count = self.grid_sums(np.ones(r.shape[:2]), edge)
+            scores = self.scores(
+                lambda fn: self.grid_sums(fn(r, c), edge),
+                np.maximum(count, 1)
+            )
+            if skip is not None:
+                # scored along with the band, but not reported
+                scores[skip[y // edge:y // edge + len(scores)]] = 0
+            yield (y // edge, scores)
+
+    def score_box(self, box):
+        (x1, y1, x2, y2) = box
+        r = self.ref[y1:y2, x1:x2]
+        c = self.com[y1:y2, x1:x2]
+        count = max(1, r.shape[0] * r.shape[1])
+        return float(self.scores(lambda fn: fn(r, c).sum(), count))
+
+    def grid_sums(self, values, edge):
+        """
+        Sum of a (height, width) array per edge x edge tile
+        """
+        height, width = values.shape
+        rows = -(-height // edge)
+        cols = -(-width // edge)
+        padded = np.zeros((rows * edge, cols * edge), dtype = np.float64)
+        padded[:height, :width] = values
+        return padded.reshape(rows, edge, cols, edge).sum(axis = (1, 3))
+
+
+@register
+class PixelDiff(ArrayMetric):
+    """
+    Share of pixels which are not exactly equal
+    """
+
+    name = "pixel"
+
+    def scores(self, total, count):
+        return self.max_score * total(lambda r, c: (r != c).any(axis = 2)) / count
+
+
+@register
+class MeanAbsoluteError(ArrayMetric):
+    """
+    Mean absolute difference of the colour channels
+    """
+
+    name = "mae"
+
+    def scores(self, total, count):
+        mae = total(lambda r, c: np.abs(r.astype(np.int16) - c).mean(axis = 2)) / count
+        return self.max_score * mae / 255
+
+
+@register
+class BlockSSIM(ArrayMetric):
+    """
+    Structural similarity of the luminance of each tile as a whole,
+    mapped from 1 (equal) - -1 to the score 0 - 64
+    """
+
+    name = "ssim"
+    mode = "L"
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def scores(self, total, count):
+        def x(r, c):
+            return r[..., 0].astype(np.float64)
+
+        def y(r, c):
+            return c[..., 0].astype(np.float64)
+
+        mean_x = total(x) / count
+        mean_y = total(y) / count
+        var_x = total(lambda r, c: x(r, c) ** 2) / count - mean_x ** 2
+        var_y = total(lambda r, c: y(r, c) ** 2) / count - mean_y ** 2
+        cov = total(lambda r, c: x(r, c) * y(r, c)) / count - mean_x * mean_y
+
+        ssim = ((2 * mean_x * mean_y + self.c1) * (2 * cov + self.c2)) \
+            / ((mean_x ** 2 + mean_y ** 2 + self.c1) * (var_x + var_y + self.c2))
+        return np.clip(self.max_score * (1 - ssim) / 2, 0, self.max_score)
+
+
+class StoredScores(Metric):
+    """
+    Tile scores computed elsewhere, e.g. band by band by shard workers.
+    Not selectable with --algorithm.
+    """
+
+    name = "stored"
+    scores_per_tile = False
+
+    def __init__(self, scores):
+        self.stored = scores
+
+    def score_bands(self, edge, skip = None):
+        step = max(1, self.band_height // edge)
+        for first in range(0, len(self.stored), step):
+            scores = np.array(self.stored[first:first + step], dtype = np.float64)
+            if skip is not None:
+                scores[skip[first:first + step]] = 0
+            yield (first, scores)
+
+
+class TileStability:
+    """
+    Per-tile scores of repeated captures of a page in one browser,
+    updated as each capture arrives. Every capture is scored against
+    the first one. Its phash and whash tile hashes are computed only
+    once, ahash and dhash hash whole bands in the kernel. A tile is
+    unstable if its largest score reaches the threshold: with two
+    captures there is one score per tile, too few for a variance, and
+    a tile which changed once may change in the comparison as well.
+    """
+
+    def __init__(self, metric, edge, threshold = 1):
+        self.metric = metric
+        self.edge = edge
+        self.threshold = threshold  # smallest score of an unstable tile
+        self.baseline = None
+        self.cache = {}
+        self.count = 0
+        self.max = None             # largest score of every tile so far
+
+    def add(self, image):
+        if self.baseline is None:
+            self.baseline = image
+            return
+
+        width, height = self.baseline.size
+        if image.size != self.baseline.size:
+            padded = Image.new(image.mode, self.baseline.size, "white")
+            padded.paste(image)
+            covered = image
+            image = padded
+        else:
+            covered = None
+
+        self.metric.prepare(self.baseline, image, self.cache)
+        scores = self.metric.score_grid(self.edge)
+        if covered is not None:
+            # tiles the capture does not reach are unstable
+            scores[-(-covered.height // self.edge):, :] = self.metric.max_score
+            scores[:, -(-covered.width // self.edge):] = self.metric.max_score
+
+        if self.count == 0:
+            self.max = np.zeros(scores.shape)
+        self.count += 1
+        np.maximum(self.max, scores, out = self.max)
+
+    def unstable(self):
+        """
+        Boolean (rows, columns) grid of the tiles which changed between captures
+        """
+        if self.count == 0:
+            return None
+        return self.max >= self.threshold
+
+    def boxes(self):
+        unstable = self.unstable()
+        if unstable is None:
+            return []
+        edge = self.edge
+        return [
+            (tx * edge, ty * edge, (tx + 1) * edge, (ty + 1) * edge)
+            for (ty, tx) in np.argwhere(unstable).tolist()
+        ]
@@ -0,0 +1,109 @@
+import json
+import time
+from eyecatchingutil import LazyModule
+from eyecatchingutil import MarkedTiles
+
+np = LazyModule("numpy")
+cv2 = LazyModule("cv2")
+
+
+class ProgressReporter:
+    """
+    Writes progress events of a comparison as they happen, one JSON
+    object per line (NDJSON). Every event has its name and the seconds
+    since the reporter was created.
+    """
+
+    interval = 0.5      # seconds between progress events of recursive comparisons
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.start_time = time.time()
+        self.phase_started = {}     # phase: start time
+
+    def emit(self, event, **fields):
+        record = {"event": event, "elapsed": round(time.time() - self.start_time, 4)}
+        record.update(fields)
+        self.stream.write(json.dumps(record) + "\n")
+        # a reader should see every event right away
+        self.stream.flush()
+
+    def start_phase(self, phase):
+        self.phase_started[phase] = time.time()
+
+    def end_phase(self, phase):
+        """
+        Emit the duration of a phase started with start_phase
+        """
+        started = self.phase_started.pop(phase, None)
+        if started is not None:
+            self.emit("phase", phase = phase, seconds = round(time.time() - started, 4))
+
+    def region(self, region):
+        self.emit(
+            "region",
+            box = list(region.as_tuple()),
+            area = region.area,
+            tiles = region.tiles,
+            max_distance = region.max_distance,
+            mean_distance = round(region.mean_distance, 2)
+        )
+
+
+class RegionTracker:
+    """
+    Connected regions of the dissimilar tiles of a comparison which
+    proceeds band by band, top to bottom. A region is complete as soon
+    as it does not reach the last row of the bands seen so far.
+    """
+
+    def __init__(self, size, edge):
+        self.width, self.height = size
+        self.edge = edge
+        self.first_row = 0      # tile row of pending[0]
+        # distance + 1 of the dissimilar tiles of incomplete regions, 0 elsewhere
+        self.pending = np.zeros((0, -(-self.width // edge)), dtype = np.int32)
+
+    def add_band(self, first, dissimilar, distances):
+        """
+        Add the (rows, columns) dissimilar tiles and their distances of
+        the band starting at tile row first, returns the completed Regions
+        """
+        band = np.where(dissimilar, np.round(distances).astype(np.int32) + 1, 0)
+        if len(self.pending) == 0:
+            self.first_row = first
+        self.pending = np.vstack([self.pending, band])
+        return self.complete_regions(last_band = (first + len(band)) * self.edge >= self.height)
+
+    def finish(self):
+        """
+        Regions not completed yet, for a comparison which stops early
+        """
+        return self.complete_regions(last_band = True)
+
+    def complete_regions(self, last_band):
+        if not self.pending.any():
+            self.pending = self.pending[:0]
+            return []
+
+        (_, labels) = cv2.connectedComponents((self.pending > 0).astype(np.uint8), connectivity = 8)
+        growing = np.zeros(labels.max() + 1, dtype = bool)
+        if not last_band:
+            # regions in the last row may continue in the next band
+            growing[labels[-1]] = True
+        growing[0] = True
+        complete = ~growing[labels]
+
+        edge = self.edge
+        tiles = MarkedTiles(max(1, int(complete.sum())))
+        for (ty, tx) in np.argwhere(complete).tolist():
+            (x, y) = (tx * edge, (self.first_row + ty) * edge)
+            tiles.append(x, y, min(x + edge, self.width), min(y + edge, self.height), self.pending[ty, tx] - 1)
+        self.pending[complete] = 0
+
+        # drop the leading rows without incomplete regions
+        rows = np.nonzero(self.pending.any(axis = 1))[0]
+        start = rows[0] if len(rows) > 0 else len(self.pending)
+        self.pending = self.pending[start:]
+        self.first_row += start
+        return tiles.regions((self.width, self.height), edge)
@@ -1,4 +1,5 @@
 const puppeteer = require('puppeteer');
+const fs = require('fs');
 
 (async () => {
     const browser = await puppeteer.launch();
@@ -6,6 +7,15 @@ const puppeteer = require('puppeteer');
     const url = process.argv[2];
     const width = parseInt(process.argv[3]);
     const height = parseInt(process.argv[4]);
+    const options = process.argv.slice(5);
+    // CSS selectors of elements to be ignored in comparison
+    const ignoreSelectors = options
+        .filter((arg) => arg.startsWith('--ignore='))
+        .map((arg) => arg.substring('--ignore='.length));
+    // export boxes of all visible elements
+    const exportElements = options.includes('--elements');
+    // write a JSON header line and the PNG bytes to stdout instead of files
+    const toStdout = options.includes('--stdout');
 
     await page.goto(url);
 
@@ -20,8 +30,74 @@ const puppeteer = require('puppeteer');
 
     await page.setViewport({width: width, height: dimensions.height})
 
+    // Resolve selectors to page coordinates (x1, y1, x2, y2)
+    const regions = {};
+    if (ignoreSelectors.length > 0) {
+        regions.ignore = await page.evaluate((selectors) => {
+            const boxes = [];
+            for (const selector of selectors) {
+                for (const el of document.querySelectorAll(selector)) {
+                    const r = el.getBoundingClientRect();
+                    if (r.width === 0 || r.height === 0) {
+                        continue;
+                    }
+                    boxes.push([
+                        Math.floor(r.left + window.scrollX),
+                        Math.floor(r.top + window.scrollY),
+                        Math.ceil(r.right + window.scrollX),
+                        Math.ceil(r.bottom + window.scrollY)
+                    ]);
+                }
+            }
+            return boxes;
+        }, ignoreSelectors);
+    }
 
-    await page.screenshot({path: 'screenshot.png', fullPage: true});
+    if (exportElements) {
+        regions.elements = await page.evaluate(() => {
+            const boxes = [];
+            for (const el of document.body.querySelectorAll('*')) {
+                const style = window.getComputedStyle(el);
+                if (style.display === 'none'
+                    || style.visibility === 'hidden'
+                    || parseFloat(style.opacity) === 0) {
+                    continue;
+                }
+                const r = el.getBoundingClientRect();
+                if (r.width < 1 || r.height < 1) {
+                    continue;
+                }
+                let name = el.tagName.toLowerCase();
+                if (el.id) {
+                    name += '#' + el.id;
+                }
+                if (el.classList.length > 0) {
+                    name += '.' + Array.from(el.classList).join('.');
+                }
+                boxes.push([
+                    Math.floor(r.left + window.scrollX),
+                    Math.floor(r.top + window.scrollY),
+                    Math.ceil(r.right + window.scrollX),
+                    Math.ceil(r.bottom + window.scrollY),
+                    name
+                ]);
+            }
+            return boxes;
+        });
+    }
+
+    if (toStdout) {
+        const png = await page.screenshot({fullPage: true});
+        const header = JSON.stringify({regions: regions, length: png.length});
+        process.stdout.write(header + '\n');
+        process.stdout.write(png);
+    } else {
+        await page.screenshot({path: 'screenshot.png', fullPage: true});
+
+        if (Object.keys(regions).length > 0) {
+            fs.writeFileSync('screenshot.json', JSON.stringify(regions));
+        }
+    }
 
     await browser.close();
-})(); 
+})();
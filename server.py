@@ -0,0 +1,244 @@
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import signal
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from PIL import Image
+from controller import Controller
+from eyecatchingutil import ChromeScreenshot
+from eyecatchingutil import FirefoxScreenshot
+from eyecatchingutil import last_error
+from eyecatching import validate_block_size
+from eyecatching import validate_threshold
+from eyecatching import validate_width
+from metrics import METRICS
+from metrics import get_metric
+
+
+class ComparisonAborted(ValueError):
+    """
+    The controller exited on invalid input, after printing why to the log
+    """
+
+    def __init__(self, log):
+        super().__init__(last_error(log) or "Comparison aborted")
+        self.log = log.splitlines()
+
+
+class ComparisonWorker:
+    """
+    Runs comparisons inside one worker process. Keeps the most recently
+    used reference images decoded, together with their tile hashes.
+    """
+
+    max_baselines = 16
+
+    def __init__(self):
+        # digest: (decoded image, hash cache)
+        self.baselines = OrderedDict()
+
+    def warm_up(self):
+        """
+        Import and initialize the heavy modules before the first request
+        """
+        tile = Image.new("L", (16, 16), "white")
+        for algorithm in METRICS:
+            metric = get_metric(algorithm)
+            metric.prepare(tile, tile)
+            metric.score_grid(8)
+        Controller().blend_image(tile, 0.5)
+
+    def baseline(self, data):
+        """
+        Decoded reference image and its hash cache, by content digest
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in self.baselines:
+            self.baselines.move_to_end(digest)
+            return self.baselines[digest]
+
+        image = self.decode(data)
+        self.baselines[digest] = (image, {})
+        if len(self.baselines) > self.max_baselines:
+            self.baselines.popitem(last = False)
+        return self.baselines[digest]
+
+    def decode(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    def compare(self, params):
+        """
+        Compare the image pair (or the screenshots of a URL) given in params.
+        Returns the summary, regions, log and the output image as base64 PNG.
+        """
+        controller = Controller()
+        controller.algorithm = params.get("algorithm", "ahash")
+        controller.block_size = int(params.get("block_size", 10))
+        controller.threshold = int(params.get("threshold", 10))
+        controller.width = int(params.get("width", 1280))
+        controller.output_id = params.get("output_id", "_")
+        controller.save_outputs = False
+        controller.grayscale = bool(params.get("grayscale", False))
+        method = params.get("method", "linear")
+        if method not in ("linear", "recursive", "element"):
+            raise ValueError("Unknown method {0}".format(method))
+        if controller.algorithm not in METRICS:
+            raise ValueError("Unknown algorithm {0}".format(controller.algorithm))
+
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                # the checks of the command line, they exit on invalid values
+                validate_width(controller.width)
+                validate_threshold(controller.threshold)
+                validate_block_size(controller.block_size, controller.width)
+
+                if "url" in params:
+                    (ref_name, com_name) = self.capture(controller, params, method)
+                else:
+                    (ref_name, com_name) = ("reference.png", "comparable.png")
+                    (ref_image, controller.hash_cache) = self.baseline(self.read_image(params, "ref"))
+                    com_image = self.decode(self.read_image(params, "com"))
+                    controller.images = {ref_name: ref_image, com_name: com_image}
+
+                if method == "linear":
+                    output = controller.linear(ref_name, com_name)
+                if method == "recursive":
+                    output = controller.recursive(ref_name, com_name)
+                if method == "element":
+                    output = controller.element(ref_name, com_name)
+        except SystemExit:
+            raise ComparisonAborted(log.getvalue())
+
+        buffer = io.BytesIO()
+        output.save(buffer, "PNG")
+        return {
+            "summary": controller.summary,
+            "regions": [
+                {
+                    "box": region.as_tuple(),
+                    "area": region.area,
+                    "tiles": region.tiles,
+                    "max_distance": region.max_distance,
+                    "mean_distance": region.mean_distance,
+                }
+                for region in controller.regions
+            ],
+            "log": log.getvalue().splitlines(),
+            "output": base64.b64encode(buffer.getvalue()).decode("ascii"),
+        }
+
+    def read_image(self, params, key):
+        """
+        Image bytes given as base64 (key) or as a local file (key_path)
+        """
+        if key in params:
+            return base64.b64decode(params[key])
+        if key + "_path" in params:
+            with open(params[key + "_path"], "rb") as f:
+                return f.read()
+        raise ValueError("Missing image: {0} or {0}_path".format(key))
+
+    def capture(self, controller, params, method):
+        """
+        Take both screenshots of the URL in memory
+        """
+        controller.url = params["url"]
+        controller.in_memory = True
+        controller.save_screenshots = False
+        controller.export_elements = method == "element"
+        if params.get("ref_browser", "chrome") == "firefox":
+            controller.ref_screenshot = FirefoxScreenshot()
+            controller.com_screenshot = ChromeScreenshot()
+        else:
+            controller.ref_screenshot = ChromeScreenshot()
+            controller.com_screenshot = FirefoxScreenshot()
+        controller.get_screenshot(controller.url)
+        return (controller.ref_screenshot.imagename, controller.com_screenshot.imagename)
+
+
+class ComparisonHandler(BaseHTTPRequestHandler):
+    """
+    POST /compare   JSON parameters, returns JSON result
+    GET  /health    worker status
+    """
+
+    worker = None   # ComparisonWorker of this process
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": "Not found"})
+        self.send_json(200, {
+            "status": "ok",
+            "pid": os.getpid(),
+            "baselines": len(self.worker.baselines)
+        })
+
+    def do_POST(self):
+        if self.path != "/compare":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length).decode("utf-8"))
+            result = self.worker.compare(params)
+        except ComparisonAborted as e:
+            return self.send_json(400, {"error": str(e), "log": e.log})
+        except (ValueError, KeyError, OSError) as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            return self.send_json(500, {"error": "{0}: {1}".format(type(e).__name__, e)})
+        self.send_json(200, result)
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print("Info: \t[{0}] {1}".format(os.getpid(), format % args))
+
+
+def serve(host = "127.0.0.1", port = 8765, workers = 2):
+    """
+    Bind once, then fork workers which all accept on the same socket
+    """
+    server = HTTPServer((host, port), ComparisonHandler)
+    children = []
+
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            ComparisonHandler.worker = ComparisonWorker()
+            ComparisonHandler.worker.warm_up()
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    print("Info: \tServing on http://{0}:{1} with {2} workers".format(host, port, workers))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        server.server_close()
+        print("Info: \tServer stopped")
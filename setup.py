@@ -11,7 +11,6 @@ setup(
         'Numpy',
         'Scipy',
         'opencv-python',
-        'pandas',
         'imagehash'
     ],
     entry_points='''
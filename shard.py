@@ -0,0 +1,528 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import time
+import uuid
+from PIL import Image
+from controller import Controller
+from eyecatchingutil import LazyModule
+from eyecatchingutil import last_error
+from metrics import get_metric
+
+np = LazyModule("numpy")
+
+
+@contextlib.contextmanager
+def working_directory(directory):
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+class Tee:
+    """
+    Stream which writes to several streams
+    """
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+class WorkQueue:
+    """
+    Jobs as JSON files in a directory shared by all nodes. A job moves
+    from pending/ to claimed/ to done/ or failed/ by renames, which are
+    atomic, so exactly one worker gets each job. Results are written
+    to results/ before a job is moved to done/. Paths in jobs are
+    relative to the queue directory, which may be mounted anywhere.
+    """
+
+    states = ("pending", "claimed", "done", "failed")
+    stale_after = 1800      # seconds until a claimed job is given to another worker
+    retries = 1             # extra attempts of a failed job
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def exists(self):
+        return os.path.exists(self.path("plan.json"))
+
+    def create(self, plan):
+        for state in self.states + ("results", "inputs"):
+            os.makedirs(self.path(state), exist_ok = True)
+        plan["created"] = time.time()
+        self.write_json(self.path("plan.json"), plan)
+
+    def plan(self):
+        return self.read_json(self.path("plan.json"))
+
+    def write_json(self, filename, data):
+        # a reader on another node never sees half a file
+        temp = "{0}.{1}.tmp".format(filename, uuid.uuid4().hex)
+        with open(temp, "w") as f:
+            json.dump(data, f, indent = 1)
+        os.replace(temp, filename)
+
+    def read_json(self, filename):
+        with open(filename) as f:
+            return json.load(f)
+
+    def add_input(self, filename, folder):
+        """
+        Path of a file for jobs, relative to the queue. Files outside
+        the queue are copied to inputs/folder, so that every node finds them.
+        """
+        filename = os.path.abspath(filename)
+        if os.path.commonpath([filename, self.directory]) == self.directory:
+            return os.path.relpath(filename, self.directory)
+        name = os.path.join("inputs", folder, os.path.basename(filename))
+        os.makedirs(self.path("inputs", folder), exist_ok = True)
+        shutil.copyfile(filename, self.path(name))
+        return name
+
+    def submit(self, job):
+        job.setdefault("attempts", 0)
+        self.write_json(self.path("pending", job["id"] + ".json"), job)
+
+    def claim(self):
+        """
+        Next pending job, or None if there is none
+        """
+        for name in sorted(os.listdir(self.path("pending"))):
+            if not name.endswith(".json"):
+                continue
+            claimed = self.path("claimed", name)
+            try:
+                os.rename(self.path("pending", name), claimed)
+            except FileNotFoundError:
+                # claimed by another worker first
+                continue
+            return self.read_json(claimed)
+        return None
+
+    def move(self, job_id, source, target):
+        try:
+            os.rename(self.path(source, job_id + ".json"), self.path(target, job_id + ".json"))
+        except FileNotFoundError:
+            # given to another worker as stale meanwhile, its result is the same
+            pass
+
+    def complete(self, job, result):
+        self.write_json(self.path("results", job["id"] + ".json"), result)
+        self.move(job["id"], "claimed", "done")
+
+    def fail(self, job, error):
+        """
+        Retry a failed job, or record it as failed after the last attempt
+        """
+        if job["attempts"] < self.retries:
+            job = dict(job, attempts = job["attempts"] + 1)
+            self.write_json(self.path("claimed", job["id"] + ".json"), job)
+            self.move(job["id"], "claimed", "pending")
+            return
+        self.write_json(self.path("results", job["id"] + ".json"), {"id": job["id"], "error": error})
+        self.move(job["id"], "claimed", "failed")
+
+    def release(self, job):
+        """
+        Give a claimed job back, e.g. when its worker is interrupted
+        """
+        self.move(job["id"], "claimed", "pending")
+
+    def requeue_stale(self):
+        """
+        Give jobs back whose worker has not finished them in stale_after seconds
+        """
+        now = time.time()
+        for name in os.listdir(self.path("claimed")):
+            try:
+                # the rename of the claim sets ctime, mtime is still the time of submission
+                age = now - os.stat(self.path("claimed", name)).st_ctime
+            except FileNotFoundError:
+                continue
+            if name.endswith(".json") and age > self.stale_after:
+                print("Warning: \tJob {0} claimed {1:.0f} seconds ago, queued again".format(name[:-5], age))
+                self.move(name[:-5], "claimed", "pending")
+
+    def status(self):
+        """
+        state: job ids in that state
+        """
+        return {
+            state: sorted(name[:-5] for name in os.listdir(self.path(state)) if name.endswith(".json"))
+            for state in self.states
+        }
+
+    def finished(self):
+        status = self.status()
+        return len(status["pending"]) == 0 and len(status["claimed"]) == 0
+
+    def result(self, job_id):
+        filename = self.path("results", job_id + ".json")
+        if not os.path.exists(filename):
+            return None
+        return self.read_json(filename)
+
+
+def plan_comparisons(queue, params, pairs = (), urls = (), widths = (1280,), algorithms = ("ahash",)):
+    """
+    One job per image pair and algorithm, and per URL, width and algorithm
+    """
+    # copied once for all algorithms
+    pairs = [
+        (queue.add_input(ref, "pair{0}".format(i + 1)), queue.add_input(com, "pair{0}".format(i + 1)))
+        for (i, (ref, com)) in enumerate(pairs)
+    ]
+    jobs = []
+    for algorithm in algorithms:
+        for (ref, com) in pairs:
+            jobs.append({"ref": ref, "com": com, "algorithm": algorithm})
+        for url in urls:
+            for width in widths:
+                jobs.append({"url": url, "width": width, "algorithm": algorithm})
+
+    queue.create({"kind": "comparisons", "params": params, "jobs": job_ids(len(jobs))})
+    for (job_id, job) in zip(job_ids(len(jobs)), jobs):
+        job.update(params)
+        job.update(id = job_id, kind = "compare")
+        queue.submit(job)
+    print("Info: \tQueued {0} comparisons in {1}".format(len(jobs), queue.directory))
+
+
+def plan_bands(queue, params, ref, com, band_height):
+    """
+    One job per band of rows of a linear comparison of one image pair.
+    The bands are cut from the images once, so that every worker
+    decodes only its own band.
+    """
+    edge = params["block_size"]
+    ref_image = Image.open(ref)
+    com_image = Image.open(com)
+    # padded as the controller pads them
+    size = (max(ref_image.width, com_image.width), max(ref_image.height, com_image.height))
+    ref_image = padded(ref_image, size)
+    com_image = padded(com_image, size)
+    if params.get("grayscale"):
+        ref_image = ref_image.convert("L")
+        com_image = com_image.convert("L")
+
+    rows = -(-size[1] // edge)
+    step = max(1, band_height // edge)
+    firsts = list(range(0, rows, step))
+    queue.create({
+        "kind": "bands",
+        "params": params,
+        # the merge marks the whole page
+        "ref": queue.add_input(ref, "page"),
+        "com": queue.add_input(com, "page"),
+        "size": list(size),
+        "rows": rows,
+        "jobs": job_ids(len(firsts)),
+    })
+    for (job_id, first) in zip(job_ids(len(firsts)), firsts):
+        box = (0, first * edge, size[0], min((first + step) * edge, size[1]))
+        names = []
+        for (image, role) in ((ref_image, "ref"), (com_image, "com")):
+            name = os.path.join("inputs", "{0}_{1}.png".format(job_id, role))
+            # written once, read once, speed matters more than size
+            image.crop(box).save(queue.path(name), compress_level = 1)
+            names.append(name)
+        job = dict(params, id = job_id, kind = "band", first_row = first, ref = names[0], com = names[1])
+        queue.submit(job)
+    print("Info: \tQueued {0} bands of {1} rows of {2}x{3} pixels in {4}".format(
+        len(firsts), step, size[0], size[1], queue.directory
+    ))
+
+
+def job_ids(count):
+    return ["j{0:05d}".format(i + 1) for i in range(count)]
+
+
+def padded(image, size):
+    """
+    Image on a white background of size, as normalize_images pads
+    """
+    if image.size == size:
+        return image
+    newimg = Image.new("RGB", size, "white")
+    newimg.paste(image)
+    return newimg
+
+
+def image_names(ref, com):
+    """
+    Names the images of a job are compared under, distinct
+    """
+    names = (os.path.basename(ref), os.path.basename(com))
+    if names[0] == names[1]:
+        names = ("ref-" + names[0], "com-" + names[1])
+    return names
+
+
+class ShardWorker:
+    """
+    Takes jobs from a WorkQueue until there are none left, or with
+    wait until every job of the plan is done
+    """
+
+    poll = 2    # seconds between looks at an empty queue
+
+    def __init__(self, queue, name = None, make_screenshots = None):
+        self.queue = queue
+        self.name = name or "{0}-{1}".format(socket.gethostname(), os.getpid())
+        # ref_browser: (reference, comparable) BrowserScreenshot, for URL jobs
+        self.make_screenshots = make_screenshots
+
+    def run(self, wait = False, max_jobs = None):
+        """
+        Process jobs, returns how many
+        """
+        count = 0
+        while max_jobs is None or count < max_jobs:
+            self.queue.requeue_stale()
+            job = self.queue.claim()
+            if job is None:
+                if not wait or self.queue.finished():
+                    break
+                time.sleep(self.poll)
+                continue
+            self.process(job)
+            count += 1
+        print("Done: \tWorker {0} processed {1} jobs".format(self.name, count))
+        return count
+
+    def process(self, job):
+        print("Info: \tWorker {0} took job {1} ({2})".format(self.name, job["id"], job["kind"]))
+        start_time = time.time()
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(Tee(sys.stdout, log)):
+                if job["kind"] == "band":
+                    result = self.score_band(job)
+                else:
+                    result = self.compare(job)
+        except KeyboardInterrupt:
+            self.queue.release(job)
+            raise
+        except SystemExit as e:
+            # the controller exits on errors it has printed already
+            return self.fail(job, last_error(log.getvalue()) or "Exited with code {0}".format(e.code))
+        except Exception as e:
+            return self.fail(job, str(e) or type(e).__name__)
+        result.update(id = job["id"], worker = self.name, seconds = time.time() - start_time)
+        self.queue.complete(job, result)
+
+    def fail(self, job, error):
+        print("Error: \tJob {0} failed: {1}".format(job["id"], error))
+        self.queue.fail(job, error)
+
+    def score_band(self, job):
+        """
+        Tile scores of one band, saved as .npy for the merge
+        """
+        ref = Image.open(self.queue.path(job["ref"]))
+        com = Image.open(self.queue.path(job["com"]))
+        metric = get_metric(job["algorithm"])
+        metric.prepare(ref, com)
+        scores = metric.score_grid(job["block_size"])
+        name = os.path.join("results", job["id"] + ".npy")
+        temp = self.queue.path(name + "." + uuid.uuid4().hex + ".tmp")
+        with open(temp, "wb") as f:
+            np.save(f, scores)
+        os.replace(temp, self.queue.path(name))
+        return {"scores": name, "first_row": job["first_row"], "rows": len(scores)}
+
+    def compare(self, job):
+        """
+        One comparison, in a directory of its own where the controller
+        saves its screenshots and output image
+        """
+        directory = self.queue.path("results", job["id"])
+        os.makedirs(directory, exist_ok = True)
+        controller = job_controller(self.queue, job)
+        controller.output_id = job["id"]
+        with working_directory(directory):
+            if "url" in job:
+                (controller.ref_screenshot, controller.com_screenshot) = self.make_screenshots(job["ref_browser"])
+                controller.width = job["width"]
+                controller.url = job["url"]
+                controller.get_screenshot(job["url"])
+                names = (controller.ref_screenshot.imagename, controller.com_screenshot.imagename)
+            else:
+                names = image_names(job["ref"], job["com"])
+                controller.images = {
+                    names[0]: Image.open(self.queue.path(job["ref"])),
+                    names[1]: Image.open(self.queue.path(job["com"])),
+                }
+            if job["method"] == "recursive":
+                controller.recursive(*names)
+            else:
+                controller.linear(*names)
+
+        summary = controller.summary
+        if summary["output"] is not None:
+            summary["output"] = os.path.join("results", job["id"], summary["output"])
+        return {
+            "summary": summary,
+            "regions": [
+                dict(box = list(region.as_tuple()), area = region.area, max_distance = region.max_distance)
+                for region in controller.regions
+            ],
+        }
+
+
+def job_controller(queue, params):
+    """
+    Controller set up with the comparison parameters of a plan
+    """
+    controller = Controller()
+    controller.algorithm = params["algorithm"]
+    controller.block_size = params["block_size"]
+    controller.threshold = params["threshold"]
+    controller.grayscale = params["grayscale"]
+    controller.ignore_boxes = [tuple(box) for box in params["ignore_boxes"]]
+    controller.ignore_selectors = list(params["ignore_selectors"])
+    controller.ignore_mask = queue.path(params["ignore_mask"]) if params["ignore_mask"] else None
+    return controller
+
+
+class ShardMerge:
+    """
+    Assembles the results of the workers: the summaries of a plan of
+    comparisons, or the comparison of a page pair split into bands
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.plan = queue.plan()
+
+    def run(self, output_dir = ".", report = "shard_report.json", history = None):
+        status = self.queue.status()
+        unfinished = status["pending"] + status["claimed"]
+        if len(unfinished) > 0:
+            print("Warning: \t{0} of {1} jobs are not done yet: {2}".format(
+                len(unfinished), len(self.plan["jobs"]), ", ".join(unfinished[:10])
+            ))
+        os.makedirs(output_dir, exist_ok = True)
+        if self.plan["kind"] == "bands":
+            entries = self.merge_bands(output_dir, history)
+        else:
+            entries = self.merge_comparisons(output_dir)
+        if entries is None:
+            return None
+
+        merged = {
+            "queue": self.queue.directory,
+            "kind": self.plan["kind"],
+            "jobs": len(self.plan["jobs"]),
+            "jobs_done": len(status["done"]),
+            "jobs_failed": len(status["failed"]),
+            "jobs_unfinished": len(unfinished),
+            "results": entries,
+        }
+        filename = os.path.join(output_dir, report)
+        with open(filename, "w") as f:
+            json.dump(merged, f, indent = 2)
+        print("Done: \tReport saved as: {0}".format(filename))
+        return merged
+
+    def merge_comparisons(self, output_dir):
+        """
+        Summaries of the comparisons, output images copied to output_dir
+        """
+        entries = []
+        for job_id in self.plan["jobs"]:
+            job = self.queue.read_json(self.job_file(job_id))
+            result = self.queue.result(job_id) or {}
+            entry = {key: job[key] for key in ("id", "url", "width", "ref", "com", "algorithm") if key in job}
+            entry["worker"] = result.get("worker")
+            entry["error"] = result.get("error")
+            entry["summary"] = result.get("summary")
+            entries.append(entry)
+            if "url" in job:
+                label = "{0} at {1}px".format(job["url"], job["width"])
+            else:
+                label = "{0} {1}".format(job["ref"], job["com"])
+            if entry["summary"] is None:
+                print("Error: \t{0} not compared: {1}\t{2}".format(job_id, entry["error"] or "not done yet", label))
+                continue
+
+            summary = entry["summary"]
+            if summary["output"] is not None:
+                target = os.path.join(output_dir, os.path.basename(summary["output"]))
+                shutil.copyfile(self.queue.path(summary["output"]), target)
+                summary["output"] = target
+            print("Done: \t{0} {1:6.2f}% dissimilar, {2} regions, {3}\t{4}".format(
+                job_id, summary["dissimilar_area"], summary["regions"], job["algorithm"], label
+            ))
+        return entries
+
+    def job_file(self, job_id):
+        for state in WorkQueue.states:
+            filename = self.queue.path(state, job_id + ".json")
+            if os.path.exists(filename):
+                return filename
+        raise FileNotFoundError("Job {0} not found in {1}".format(job_id, self.queue.directory))
+
+    def merge_bands(self, output_dir, history = None):
+        """
+        Linear comparison of the page pair from the tile scores of the bands
+        """
+        plan = self.plan
+        scores = []
+        workers = set()
+        worker_time = 0
+        for job_id in plan["jobs"]:
+            result = self.queue.result(job_id)
+            if result is None or "scores" not in result:
+                print("Error: \tBand {0} has no scores ({1}), the page cannot be merged!".format(
+                    job_id, (result or {}).get("error", "not done yet")
+                ))
+                return None
+            scores.append(np.load(self.queue.path(result["scores"])))
+            workers.add(result["worker"])
+            worker_time += result["seconds"]
+        scores = np.vstack(scores)
+
+        params = plan["params"]
+        controller = job_controller(self.queue, params)
+        controller.output_id = params["output_id"]
+        controller.stored_scores = scores
+        ref = self.queue.path(plan["ref"])
+        com = self.queue.path(plan["com"])
+        names = image_names(ref, com)
+        controller.images = {names[0]: Image.open(ref), names[1]: Image.open(com)}
+        with working_directory(output_dir):
+            controller.linear(*names)
+
+        summary = controller.summary
+        if summary["output"] is not None:
+            summary["output"] = os.path.join(output_dir, summary["output"])
+        summary["workers"] = len(workers)
+        summary["worker_time"] = worker_time
+        # recorded outside output_dir, with the work of the bands
+        controller.history = history
+        controller.record_history()
+        print("Done: \tScored by {0} workers in {1} bands, {2:.4f} seconds of work".format(
+            len(workers), len(plan["jobs"]), worker_time
+        ))
+        return [{"ref": plan["ref"], "com": plan["com"], "summary": summary}]
@@ -0,0 +1,232 @@
+import os
+import time
+from PIL import Image
+from eyecatchingutil import MetaImage
+from eyecatchingutil import MarkedTiles
+from eyecatchingutil import IgnoreMask
+from eyecatchingutil import LazyModule
+from metrics import get_metric
+
+np = LazyModule("numpy")
+
+
+class ComparisonWatcher:
+    """
+    Compares an image pair block by block whenever one of the files
+    changes. Decoded images, tile hashes and scores stay in memory,
+    only tiles whose pixels changed are scored again.
+    """
+
+    interval = 0.5      # seconds between checks for changes
+    full_update = 0.5   # share of changed tiles from which all tiles are scored at once
+
+    def __init__(self, controller, ref_imagename, com_imagename):
+        self.controller = controller
+        self.names = (ref_imagename, com_imagename)
+        self.stats = {}         # imagename: (mtime, size) of the loaded file
+        self.originals = {}     # imagename: decoded image as on disk
+        self.working = {}       # imagename: image padded to the common size
+        self.pixels = {}        # imagename: pixels of the working image
+        self.caches = {ref_imagename: {}, com_imagename: {}}
+        self.size = None
+        self.scores = None      # (rows, columns) tile scores
+        self.skip = None        # (rows, columns) masked tiles
+        self.colour_ref = None  # padded colour reference
+        self.output = None      # marked output, repainted where tiles changed
+        self.metric = get_metric(controller.algorithm)
+        # fast compression, the output is written on every change
+        controller.output_options = {"compress_level": 1}
+
+    def run(self):
+        print("Info: \tWatching {0} and {1}, press Ctrl+C to stop".format(*self.names))
+        try:
+            while True:
+                changed = [name for name in self.names if self.file_stat(name) != self.stats.get(name)]
+                if len(changed) > 0:
+                    self.update(changed)
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print("Done: \tStopped watching")
+
+    def file_stat(self, imagename):
+        try:
+            st = os.stat(imagename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def update(self, changed):
+        """
+        Decode the changed files and score the tiles which changed
+        """
+        start_time = time.time()
+        loaded = {}
+        for name in changed:
+            stat = self.file_stat(name)
+            try:
+                image = Image.open(name)
+                image.load()
+            except (OSError, SyntaxError) as e:
+                # the file may still be written, try again on the next check
+                print("Warning: \tCould not read {0}: {1}".format(name, e))
+                return
+            loaded[name] = (stat, image)
+
+        for name, (stat, image) in loaded.items():
+            self.stats[name] = stat
+            self.originals[name] = image
+        if len(self.originals) < len(self.names):
+            return
+
+        edge = int(self.controller.block_size)
+        size = (
+            max(image.width for image in self.originals.values()),
+            max(image.height for image in self.originals.values())
+        )
+        resized = size != self.size
+        if resized:
+            self.size = size
+            self.set_mask()
+            self.scores = np.zeros(self.skip.shape)
+
+        changed_tiles = np.zeros(self.skip.shape, dtype = bool)
+        for name in self.names:
+            if name not in loaded and not resized:
+                continue
+            working = self.pad(self.originals[name], "L" if self.controller.grayscale else "RGB")
+            pixels = np.asarray(working)
+            if resized or name not in self.pixels:
+                self.caches[name].clear()
+                changed_tiles[:] = True
+            else:
+                tiles = self.tile_changes(self.pixels[name], pixels, edge)
+                self.forget(name, tiles, edge)
+                changed_tiles |= tiles
+            self.working[name] = working
+            self.pixels[name] = pixels
+
+        (ref, com) = self.names
+        self.metric.prepare(self.working[ref], self.working[com], self.caches[ref], self.caches[com])
+        todo = changed_tiles & ~self.skip
+        if todo.mean() >= self.full_update:
+            self.scores = self.metric.score_grid(edge, self.skip)
+        else:
+            for (ty, tx) in np.argwhere(todo).tolist():
+                (x, y) = (tx * edge, ty * edge)
+                self.scores[ty, tx] = self.metric.score_box((x, y, x + edge, y + edge))
+
+        rebuild = resized or ref in loaded
+        if not rebuild and not changed_tiles.any():
+            print("Info: \tNo tiles changed")
+            return
+        if rebuild:
+            self.colour_ref = self.working[ref] if not self.controller.grayscale else self.pad(self.originals[ref], "RGB")
+        self.report(int(todo.sum()), changed_tiles, rebuild, start_time)
+
+    def set_mask(self):
+        """
+        Ignore mask and masked tiles for the current size
+        """
+        controller = self.controller
+        controller.mask = IgnoreMask(self.size)
+        for box in controller.ignore_boxes:
+            controller.mask.add_box(box)
+        if controller.ignore_mask is not None:
+            controller.mask.add_image(controller.ignore_mask)
+        self.skip = controller.masked_tiles(self.size, int(controller.block_size))
+
+    def pad(self, image, mode):
+        """
+        Image in the given mode, padded with white to the common size
+        """
+        if image.size == self.size:
+            return image.convert(mode)
+        padded = Image.new(mode, self.size, "white")
+        padded.paste(image.convert(mode))
+        return padded
+
+    def tile_changes(self, old, new, edge):
+        """
+        Boolean (rows, columns) grid of the tiles with any changed pixel
+        """
+        (rows, cols) = self.skip.shape
+        changes = np.zeros((rows, cols), dtype = bool)
+        width = old.shape[1]
+        for ty in range(rows):
+            band_old = old[ty * edge:(ty + 1) * edge]
+            band_new = new[ty * edge:(ty + 1) * edge]
+            # comparing bytes is much faster than comparing elements
+            if band_old.tobytes() == band_new.tobytes():
+                continue
+            diff = band_old != band_new
+            if diff.ndim == 3:
+                diff = diff.any(axis = 2)
+            padded = np.zeros((edge, cols * edge), dtype = bool)
+            padded[:diff.shape[0], :width] = diff
+            changes[ty] = padded.reshape(edge, cols, edge).any(axis = (0, 2))
+        return changes
+
+    def forget(self, imagename, tiles, edge):
+        """
+        Drop the cached hashes of changed tiles
+        """
+        cache = self.caches[imagename]
+        for (ty, tx) in np.argwhere(tiles).tolist():
+            (x, y) = (tx * edge, ty * edge)
+            cache.pop((self.metric.name, self.size, (x, y, x + edge, y + edge)), None)
+
+    def report(self, rescored, changed_tiles, rebuild, start_time):
+        """
+        Mark the dissimilar tiles on the colour reference, save the
+        output and print the summary. Unless rebuild is set, only the
+        changed tiles of the previous output are painted again.
+        """
+        controller = self.controller
+        (ref, com) = self.names
+        edge = int(controller.block_size)
+        width, height = self.size
+
+        dissimilar = (self.scores >= controller.threshold) & ~self.skip
+        if rebuild:
+            self.output = self.colour_ref.copy()
+            repaint = dissimilar
+        else:
+            for (ty, tx) in np.argwhere(changed_tiles).tolist():
+                coords = (tx * edge, ty * edge, (tx + 1) * edge, (ty + 1) * edge)
+                self.output.paste(self.colour_ref.crop(coords), coords)
+            repaint = dissimilar & changed_tiles
+        output = self.output
+        for (ty, tx) in np.argwhere(repaint).tolist():
+            coords = (tx * edge, ty * edge, (tx + 1) * edge, (ty + 1) * edge)
+            distance = float(self.scores[ty, tx])
+            output.paste(controller.blend_image(output.crop(coords), distance / 64), coords)
+
+        marked = MarkedTiles()
+        for (ty, tx) in np.argwhere(dissimilar).tolist():
+            (x, y) = (tx * edge, ty * edge)
+            marked.append(x, y, min(x + edge, width), min(y + edge, height), round(float(self.scores[ty, tx])))
+
+        controller.ref = MetaImage(ref, output)
+        controller.com = MetaImage(com, self.working[com])
+        controller.marked = marked
+        controller.regions = marked.regions(self.size, edge)
+        output_filename = controller.save_output(output, "watch")
+        stop_time = time.time()
+
+        compared = int((~self.skip).sum())
+        masked_area = controller.mask.masked_area((0, 0, width, height))
+        avg_dissimilarity = round(float(self.scores[~self.skip].mean()) * 100 / 64, 2) if compared != 0 else 0
+        controller.summary = controller.make_summary("watch", {
+            "blocks_compared": compared,
+            "blocks_rescored": rescored,
+            "blocks_dissimilar": len(marked),
+            "average_dissimilarity": avg_dissimilarity,
+            "dissimilar_area": controller.percent_of_unmasked(marked.total_area(), masked_area),
+        }, masked_area, stop_time - start_time, output_filename)
+
+        controller.report_regions(limit = 5)
+        print("Done: \tBlocks scored again: {0} of {1}".format(rescored, compared))
+        print("Done: \tNumber of blocks with dissimilarity: {0}".format(len(marked)))
+        print("Done: \tAverage dissimilarity {0:.2f}%.".format(avg_dissimilarity))
+        print("Done: \tDissimilar area: {0:.2f}%".format(controller.summary["dissimilar_area"]))
+        print("Done: \tUpdate time: {0:.4f} seconds".format(stop_time - start_time))